@@ -1,4 +1,6 @@
 from .context import Contextd
+from .registry import ContextRegistry
 from .backends.redis_backend import RedisBackend, RedisNotification
 from .backends.mongodb_backend import MongoDBBackend
-from .backends.s3_backend import S3Backend
\ No newline at end of file
+from .backends.s3_backend import S3Backend
+from .backends.memory_backend import MemoryBackend
@@ -1,26 +1,201 @@
 from abc import ABC, abstractmethod
+import asyncio
+import uuid
+from common.codec import default_codec
+from common.lock_wait import ExponentialBackoff
+from common.operations import apply_operations
+
+class LockLostError(Exception):
+    # Raised by a fenced write when another owner took one of the writer's
+    # locks after the writer's lease expired
+    pass
 
 class StorageBackend(ABC):
+    # Backends that can persist individual context keys without rewriting
+    # the whole context set this to True.
+    field_level = False
+    # Backends whose publish_update cannot deliver arbitrary messages, only
+    # notifications of their own writes, set this to False.
+    supports_publish = True
+    # Serializes stored values for backends that store bytes (see common.codec)
+    codec = default_codec
+
     @abstractmethod
     async def load_context(self, context_key: str):
         pass
 
+    # save_context and save_keys return the new context version, or None if
+    # the backend does not track versions.
     @abstractmethod
     async def save_context(self, context_key: str, context: dict):
         pass
 
+    async def load_versioned(self, context_key: str):
+        # Returns the context together with its version. Backends that do not
+        # track versions return None, which makes every reload a full load.
+        return await self.load_context(context_key), None
+
+    async def get_version(self, context_key: str):
+        return None
+
+    async def load_keys(self, context_key: str, keys):
+        # Returns ({key: value} for the given keys that exist, version).
+        # Backends that can read single keys override this; the fallback
+        # loads the whole context.
+        context, version = await self.load_versioned(context_key)
+        return {key: context[key] for key in keys if key in context}, version
+
+    async def changes_since(self, context_key: str, version: int):
+        # Returns the update messages (see backends.notifications.update_message)
+        # for every version after the given one, oldest first, from the
+        # backend's change log. Returns None if the log does not reach back to
+        # the version, or the backend keeps no change log; callers then load
+        # the full context instead.
+        return None
+
+    async def compact_change_log(self, context_key: str):
+        # Drops change log entries the backend no longer needs to keep
+        pass
+
+    async def store_snapshot(self, context_key: str, context: dict, version: int):
+        # Writes a full context under an explicit version, e.g. to hydrate a
+        # cache tier with what was read from another tier. Backends that
+        # cannot set versions just save the context.
+        return await self.save_context(context_key, context)
+
+    # fence maps lock names to the fencing tokens returned by acquire_lock.
+    # Backends that support fencing reject the write with LockLostError if a
+    # newer owner has taken one of the locks since; others ignore it.
+    async def save_keys(self, context_key: str, changed: dict, deleted: set, context: dict = None, fence: dict = None):
+        # Fallback for backends without a field-level layout: rewrite the full
+        # context, loading it first if the caller did not pass it along.
+        if context is None:
+            context = await self.load_context(context_key)
+            context.update(changed)
+            for key in deleted:
+                context.pop(key, None)
+        return await self.save_context(context_key, context)
+
+    async def load_many(self, context_keys):
+        # Returns {context_key: (context, version)}. Backends that can read
+        # several contexts in one round trip override this.
+        results = await asyncio.gather(*(self.load_versioned(context_key) for context_key in context_keys))
+        return dict(zip(context_keys, results))
+
+    async def save_many(self, changes: dict, fences: dict = None):
+        # changes maps context keys to (changed, deleted, context) as passed to
+        # save_keys, and fences maps them to the fence of their write.
+        # Returns {context_key: version}.
+        fences = fences or {}
+        versions = await asyncio.gather(*(
+            self.save_keys(context_key, changed, deleted, context, fence=fences.get(context_key))
+            for context_key, (changed, deleted, context) in changes.items()
+        ))
+        return dict(zip(changes, versions))
+
+    async def compare_and_save(self, context_key: str, changed: dict, deleted: set, expected_version: int, context: dict = None):
+        # Like save_keys, but only commits if the stored version still equals
+        # expected_version. Returns the new version, or None on a conflict.
+        raise NotImplementedError(f"{type(self).__name__} does not support compare-and-save writes")
+
+    # Rounds of the compare-and-save loop apply_operations tries before
+    # giving up on a contended context
+    max_operation_retries = 20
+    # Lease, in ms, of the context lock apply_operations takes on backends
+    # without compare-and-save
+    operation_lock_timeout = 10000
+
+    async def apply_operations(self, context_key: str, operations):
+        # Runs atomic operations (see common.operations) against the stored
+        # context without a lock. Returns (version, results, changed, deleted),
+        # where changed maps the modified top-level keys to their new values.
+        # Backends that can run the operations server-side override this; the
+        # fallback retries a compare-and-save until no other write got between
+        # its read and its write.
+        if type(self).compare_and_save is StorageBackend.compare_and_save:
+            return await self._apply_operations_locked(context_key, operations)
+        for _ in range(self.max_operation_retries):
+            context, version = await self.load_versioned(context_key)
+            results, changed_keys, deleted = apply_operations(context, operations)
+            if not changed_keys and not deleted:
+                return version, results, {}, deleted
+            changed = {key: context[key] for key in changed_keys}
+            new_version = await self.compare_and_save(context_key, changed, deleted, version, context)
+            if new_version is not None:
+                return new_version, results, changed, deleted
+        raise Exception(f"Failed to apply operations to {context_key} due to repeated version conflicts")
+
+    async def _apply_operations_locked(self, context_key: str, operations):
+        # Without compare-and-save the read and the write are serialized by
+        # the context lock, the same one Contextd takes in context lock mode
+        lock_key = f"{context_key}_lock"
+        lock_value = str(uuid.uuid4())
+        delays = ExponentialBackoff().delays()
+        while not (fence := await self.acquire_lock(lock_key, lock_value, self.operation_lock_timeout)):
+            delay = next(delays, None)
+            if delay is None:
+                raise Exception(f"Failed to lock {context_key} to apply operations")
+            await asyncio.sleep(delay)
+        try:
+            context, version = await self.load_versioned(context_key)
+            results, changed_keys, deleted = apply_operations(context, operations)
+            if not changed_keys and not deleted:
+                return version, results, {}, deleted
+            changed = {key: context[key] for key in changed_keys}
+            new_version = await self.save_keys(context_key, changed, deleted, context, fence={lock_key: fence})
+            return new_version, results, changed, deleted
+        finally:
+            await self.release_lock(lock_key, lock_value)
+
     @abstractmethod
-    async def publish_update(self, channel: str):
+    async def publish_update(self, channel: str, message: dict = None):
         pass
 
+    # Returns once subscribed, optionally with a handle (such as the task
+    # delivering messages) whose cancel() ends the subscription.
+    # callback receives the decoded update message (see
+    # backends.notifications.update_message), or None when the notification
+    # carries no details and the context has to be reloaded.
     @abstractmethod
     async def subscribe_to_updates(self, channel: str, callback):
         pass
 
+    # Locks are leases: they expire after lock_timeout ms unless renewed, and
+    # an expired lock can be taken by the next owner. acquire_lock returns a
+    # truthy fencing token that increases with every new owner of the lock,
+    # or False.
     @abstractmethod
     async def acquire_lock(self, key: str, lock_value: str, lock_timeout: int):
         pass
 
+    async def renew_lock(self, key: str, lock_value: str, lock_timeout: int):
+        # Extends the lease if lock_value still holds the lock. Returns False
+        # if the lock was lost or the backend cannot extend leases.
+        return False
+
     @abstractmethod
     async def release_lock(self, key: str, lock_value: str):
+        pass
+
+    async def acquire_locks(self, keys, lock_value: str, lock_timeout: int):
+        # Takes all of the locks or none of them. Returns {key: fencing
+        # token}, or False.
+        acquired = {}
+        for key in keys:
+            token = await self.acquire_lock(key, lock_value, lock_timeout)
+            if not token:
+                await self.release_locks(list(acquired), lock_value)
+                return False
+            acquired[key] = token
+        return acquired
+
+    async def release_locks(self, keys, lock_value: str):
+        await asyncio.gather(*(self.release_lock(key, lock_value) for key in keys))
+
+    async def acquire_lock_fair(self, key: str, lock_value: str, lock_timeout: int):
+        # Backends with a server-side waiter queue only grant the lock to the
+        # longest waiting owner. Others fall back to plain acquisition.
+        return await self.acquire_lock(key, lock_value, lock_timeout)
+
+    async def leave_lock_queue(self, key: str, lock_value: str):
         pass
\ No newline at end of file
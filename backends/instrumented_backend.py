@@ -0,0 +1,37 @@
+import inspect
+from common.metrics import MeteredCodec, Metrics
+
+class InstrumentedBackend:
+    # Wraps a storage backend and reports every backend call to metrics:
+    # contextd_backend_seconds{backend, operation} for its duration and
+    # contextd_backend_errors_total{backend, operation, error} for failures.
+    # The backend's codec is replaced by a MeteredCodec, so payload sizes are
+    # reported as contextd_payload_bytes{backend, direction}. Everything else
+    # is forwarded unchanged, so the wrapper can be passed to Contextd or
+    # ContextRegistry in place of the backend.
+    def __init__(self, backend, metrics: Metrics):
+        self.backend = backend
+        self.metrics = metrics
+        self.backend_name = type(backend).__name__
+        if getattr(backend, "codec", None) is not None and not isinstance(backend.codec, MeteredCodec):
+            backend.codec = MeteredCodec(backend.codec, metrics, backend=self.backend_name)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.backend, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+
+        async def timed(*args, **kwargs):
+            started = self.metrics.start()
+            try:
+                return await attribute(*args, **kwargs)
+            except Exception as error:
+                if self.metrics.observers:
+                    self.metrics.count("contextd_backend_errors_total", backend=self.backend_name, operation=name, error=type(error).__name__)
+                raise
+            finally:
+                self.metrics.elapsed("contextd_backend_seconds", started, backend=self.backend_name, operation=name)
+
+        # Cached on the instance, so later calls skip __getattr__
+        self.__dict__[name] = timed
+        return timed
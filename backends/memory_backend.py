@@ -0,0 +1,347 @@
+import json
+import time
+import random
+import asyncio
+from collections import Counter, deque
+from backends.base import LockLostError, StorageBackend
+from backends.notifications import Subscription, contiguous_changes, update_message
+from common.codec import default_codec
+from common.operations import apply_operations
+from common.logger import configure_logging
+
+logger = configure_logging()
+
+class InjectedFailure(ConnectionError):
+    # Raised by MemoryBackend calls picked to fail by its failure_rate
+    pass
+
+class MemoryStore:
+    # The state shared by MemoryBackend instances. Backends created on the
+    # same store see the same contexts, versions, change logs and locks, like
+    # instances connected to one server.
+    def __init__(self):
+        self.contexts = {}  # context key -> {key: encoded value}
+        self.versions = {}
+        self.change_logs = {}  # context key -> deque of (version, entry)
+        self.locks = {}  # lock key -> (lock value, expiry on time.monotonic())
+        self.fences = {}
+        self.lock_queues = {}  # lock key -> {lock value: last attempt}, in arrival order
+
+class BusSubscription(Subscription):
+    # Each subscription delivers its messages in publish order from its own task
+    def __init__(self, bus, channel: str, callback):
+        super().__init__(bus, channel, callback)
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(bus._deliver(self))
+
+class MemoryBus:
+    # In-process pub/sub for MemoryBackend instances. A message reaches each
+    # subscriber latency plus up to jitter seconds after it was published, and
+    # drop_rate loses messages the way a broken pub/sub connection would.
+    def __init__(self, latency=0.0, jitter=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self._handlers = {}
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+    async def publish_update(self, channel: str, message: dict = None):
+        # Messages are serialized like on the wire, so subscribers never share
+        # objects with the publisher
+        payload = json.dumps({**message, "sent": time.time()}) if message else "update"
+        self.stats["published"] += 1
+        due = asyncio.get_running_loop().time() + self.latency
+        for subscription in list(self._handlers.get(channel, ())):
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.stats["dropped"] += 1
+                continue
+            subscription.queue.put_nowait((due + self.jitter * self.random.random(), payload))
+
+    async def subscribe_to_updates(self, channel: str, callback):
+        subscription = BusSubscription(self, channel, callback)
+        self._handlers.setdefault(channel, []).append(subscription)
+        return subscription
+
+    async def _deliver(self, subscription: BusSubscription):
+        loop = asyncio.get_running_loop()
+        while True:
+            due, payload = await subscription.queue.get()
+            try:
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                message = None if payload == "update" else json.loads(payload)
+                await subscription.callback(message)
+                self.stats["delivered"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f"Update callback for {subscription.channel} failed: {error!r}")
+            finally:
+                subscription.queue.task_done()
+
+    def _remove(self, subscription: Subscription):
+        handlers = self._handlers.get(subscription.channel, [])
+        if subscription in handlers:
+            handlers.remove(subscription)
+        if not handlers:
+            self._handlers.pop(subscription.channel, None)
+        subscription.task.cancel()
+
+    def channel_count(self):
+        return len(self._handlers)
+
+    async def join(self):
+        # Waits until every published message has been delivered or dropped
+        for handlers in list(self._handlers.values()):
+            for subscription in list(handlers):
+                await subscription.queue.join()
+
+    async def close(self):
+        for handlers in list(self._handlers.values()):
+            for subscription in list(handlers):
+                subscription.cancelled = True
+                subscription.task.cancel()
+        self._handlers.clear()
+
+class MemoryBackend(StorageBackend):
+    # Keeps contexts in process memory, with versions, a change log, leased
+    # locks and fencing like the server backends. Backends sharing a store and
+    # a bus act as instances of one cluster, so many Contextd instances in one
+    # event loop can simulate several processes. Every call waits latency plus
+    # up to jitter seconds and fails with InjectedFailure at failure_rate.
+    field_level = True
+
+    def __init__(self, store=None, bus=None, enable_notifications=True, codec=None, change_log_length=None, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        self.store = store or MemoryStore()
+        self.notification = bus or MemoryBus()
+        self._owns_bus = bus is None
+        self.enable_notifications = enable_notifications
+        self.codec = codec or default_codec
+        self.change_log_length = change_log_length  # Entries kept per context, None disables the change log
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()  # Round trips by operation
+        self.failures = Counter()
+
+    async def _round_trip(self, operation: str):
+        # Always yields to the event loop, like a network call would
+        self.calls[operation] += 1
+        await asyncio.sleep(self.latency + self.jitter * self.random.random())
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures[operation] += 1
+            raise InjectedFailure(f"Injected failure in {operation}")
+
+    def _read(self, context_key: str):
+        fields = self.store.contexts.get(context_key, {})
+        context = {key: self.codec.decode(value) for key, value in fields.items()}
+        return context, self.store.versions.get(context_key, 0)
+
+    def _write(self, context_key: str, changed: dict, deleted, replace=False):
+        # Encodes everything before touching the store, so a value that cannot
+        # be serialized leaves the context unchanged
+        encoded = {key: self.codec.encode(value) for key, value in changed.items()}
+        entry = json.dumps({"changed": changed, "deleted": list(deleted)}) if self.change_log_length and not replace else ""
+        fields = self.store.contexts.setdefault(context_key, {})
+        if replace:
+            fields.clear()
+        fields.update(encoded)
+        for key in deleted:
+            fields.pop(key, None)
+        version = self.store.versions.get(context_key, 0) + 1
+        self.store.versions[context_key] = version
+        if self.change_log_length:
+            log = self.store.change_logs.setdefault(context_key, deque())
+            log.append((version, entry))
+            while len(log) > self.change_log_length:
+                log.popleft()
+        return version
+
+    def _check_fence(self, context_key: str, fence: dict = None):
+        for lock_name, token in (fence or {}).items():
+            if self.store.fences.get(lock_name) != token:
+                raise LockLostError(f"Lost a lock of {context_key} before writing it")
+
+    async def _publish(self, context_key: str, message: dict):
+        if self.enable_notifications:
+            await self.notification.publish_update(context_key, message)
+
+    async def load_context(self, context_key: str):
+        context, _ = await self.load_versioned(context_key)
+        return context
+
+    async def load_versioned(self, context_key: str):
+        await self._round_trip("load_versioned")
+        return self._read(context_key)
+
+    async def load_keys(self, context_key: str, keys):
+        await self._round_trip("load_keys")
+        fields = self.store.contexts.get(context_key, {})
+        values = {key: self.codec.decode(fields[key]) for key in keys if key in fields}
+        return values, self.store.versions.get(context_key, 0)
+
+    async def load_many(self, context_keys):
+        context_keys = list(context_keys)
+        if not context_keys:
+            return {}
+        await self._round_trip("load_many")
+        return {context_key: self._read(context_key) for context_key in context_keys}
+
+    async def get_version(self, context_key: str):
+        await self._round_trip("get_version")
+        return self.store.versions.get(context_key, 0)
+
+    async def changes_since(self, context_key: str, version: int):
+        if not self.change_log_length:
+            return None
+        await self._round_trip("changes_since")
+        messages = []
+        for entry_version, entry in self.store.change_logs.get(context_key, ()):
+            if entry_version <= version:
+                continue
+            if entry:
+                change = json.loads(entry)
+                messages.append(update_message(entry_version, change["changed"], change["deleted"]))
+            else:
+                messages.append(update_message(entry_version))
+        return contiguous_changes(version, self.store.versions.get(context_key, 0), messages)
+
+    async def compact_change_log(self, context_key: str):
+        # Writes already keep the log at change_log_length entries
+        pass
+
+    async def save_context(self, context_key: str, context: dict):
+        await self._round_trip("save_context")
+        version = self._write(context_key, context, (), replace=True)
+        await self._publish(context_key, update_message(version))
+        return version
+
+    async def save_keys(self, context_key: str, changed: dict, deleted: set, context: dict = None, fence: dict = None):
+        if not changed and not deleted:
+            return await self.get_version(context_key)
+        await self._round_trip("save_keys")
+        self._check_fence(context_key, fence)
+        version = self._write(context_key, changed, deleted)
+        await self._publish(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def save_many(self, changes: dict, fences: dict = None):
+        if not changes:
+            return {}
+        await self._round_trip("save_many")
+        for context_key, fence in (fences or {}).items():
+            self._check_fence(context_key, fence)
+        versions = {
+            context_key: self._write(context_key, changed, deleted)
+            for context_key, (changed, deleted, _) in changes.items()
+        }
+        for context_key, (changed, deleted, _) in changes.items():
+            await self._publish(context_key, update_message(versions[context_key], changed, deleted))
+        return versions
+
+    async def store_snapshot(self, context_key: str, context: dict, version: int):
+        await self._round_trip("store_snapshot")
+        self.store.contexts[context_key] = {key: self.codec.encode(value) for key, value in context.items()}
+        self.store.versions[context_key] = version
+        self.store.change_logs.pop(context_key, None)
+        return version
+
+    async def compare_and_save(self, context_key: str, changed: dict, deleted: set, expected_version: int, context: dict = None):
+        await self._round_trip("compare_and_save")
+        if self.store.versions.get(context_key, 0) != expected_version:
+            return None
+        version = self._write(context_key, changed, deleted)
+        await self._publish(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def apply_operations(self, context_key: str, operations):
+        await self._round_trip("apply_operations")
+        fields = self.store.contexts.get(context_key, {})
+        touched = {path[0] for _, path, _ in operations}
+        context = {key: self.codec.decode(fields[key]) for key in touched if key in fields}
+        results, changed_keys, deleted = apply_operations(context, operations)
+        if not changed_keys and not deleted:
+            return self.store.versions.get(context_key, 0), results, {}, deleted
+        changed = {key: context[key] for key in changed_keys}
+        version = self._write(context_key, changed, deleted)
+        await self._publish(context_key, update_message(version, changed, deleted))
+        return version, results, changed, deleted
+
+    async def publish_update(self, channel: str, message: dict = None):
+        await self._publish(channel, message)
+
+    async def subscribe_to_updates(self, channel: str, callback):
+        if self.enable_notifications:
+            return await self.notification.subscribe_to_updates(channel, callback)
+
+    def _lock_holder(self, key: str):
+        lock = self.store.locks.get(key)
+        if lock is not None and lock[1] <= time.monotonic():
+            del self.store.locks[key]
+            lock = None
+        return lock[0] if lock else None
+
+    def _grant_lock(self, key: str, lock_value: str, lock_timeout: int):
+        self.store.locks[key] = (lock_value, time.monotonic() + lock_timeout / 1000)
+        self.store.fences[key] = self.store.fences.get(key, 0) + 1
+        return self.store.fences[key]
+
+    async def acquire_lock(self, key: str, lock_value: str, lock_timeout: int):
+        await self._round_trip("acquire_lock")
+        if self._lock_holder(key) is not None:
+            return False
+        return self._grant_lock(key, lock_value, lock_timeout)
+
+    async def renew_lock(self, key: str, lock_value: str, lock_timeout: int):
+        await self._round_trip("renew_lock")
+        if self._lock_holder(key) != lock_value:
+            return False
+        self.store.locks[key] = (lock_value, time.monotonic() + lock_timeout / 1000)
+        return True
+
+    async def release_lock(self, key: str, lock_value: str):
+        await self._round_trip("release_lock")
+        if self._lock_holder(key) != lock_value:
+            return False
+        del self.store.locks[key]
+        return True
+
+    async def acquire_locks(self, keys, lock_value: str, lock_timeout: int):
+        keys = list(keys)
+        await self._round_trip("acquire_locks")
+        if any(self._lock_holder(key) is not None for key in keys):
+            return False
+        return {key: self._grant_lock(key, lock_value, lock_timeout) for key in keys}
+
+    async def release_locks(self, keys, lock_value: str):
+        await self._round_trip("release_locks")
+        for key in keys:
+            if self._lock_holder(key) == lock_value:
+                del self.store.locks[key]
+
+    async def acquire_lock_fair(self, key: str, lock_value: str, lock_timeout: int, stale_waiter_timeout: int = 2000):
+        # Same queue as the Redis script: waiters are served in arrival order,
+        # and waiters that stopped polling are dropped from the head
+        await self._round_trip("acquire_lock_fair")
+        now = time.monotonic()
+        queue = self.store.lock_queues.setdefault(key, {})
+        queue[lock_value] = now
+        for waiter, last_attempt in list(queue.items()):
+            if waiter == lock_value or now - last_attempt <= stale_waiter_timeout / 1000:
+                break
+            del queue[waiter]
+        if next(iter(queue)) != lock_value or self._lock_holder(key) is not None:
+            return False
+        del queue[lock_value]
+        return self._grant_lock(key, lock_value, lock_timeout)
+
+    async def leave_lock_queue(self, key: str, lock_value: str):
+        await self._round_trip("leave_lock_queue")
+        self.store.lock_queues.get(key, {}).pop(lock_value, None)
+
+    async def close(self):
+        # A shared bus outlives the backends using it
+        if self._owns_bus:
+            await self.notification.close()
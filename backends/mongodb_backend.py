@@ -1,46 +1,430 @@
 import motor.motor_asyncio
 import json
-from datetime import datetime, timedelta
+import uuid
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
 
-from backends.base import StorageBackend
-from backends.notifications import MongoNotification
+from backends.base import LockLostError, StorageBackend
+from backends.notifications import MongoNotification, contiguous_changes, update_message
+
+# Seconds the TTL index keeps lock documents after their lease ended
+LOCK_TTL_GRACE_SECONDS = 60
+
+# Error codes of an operations pipeline meaning that a value had the wrong
+# type: $add, $concatArrays, $mergeObjects, $size and TypeMismatch
+OPERATION_TYPE_ERRORS = {16554, 28664, 40400, 17124, 14}
+
+# Operations that may leave the context unchanged, see common.operations
+CONDITIONAL_OPERATIONS = ("set_if_absent", "delete")
 
 class MongoDBBackend(StorageBackend):
-    def __init__(self, mongo_uri, db_name, enable_notifications=True):
+    # Context keys are addressed as `context.<key>` sub-fields of the document.
+    field_level = True
+    # Subscribers are notified by the change stream, see MongoNotification
+    supports_publish = False
+
+    def __init__(self, mongo_uri, db_name, enable_notifications=True, change_log_length=None, change_log_size=64 * 1024 * 1024, resume_token_id=None):
         self.client = motor.motor_asyncio.AsyncIOMotorClient(mongo_uri)
         self.db = self.client[db_name]
         self.enable_notifications = enable_notifications
-        self.notification = MongoNotification(mongo_uri, db_name)
+        # resume_token_id names this process's change stream position, which
+        # is stored so that a restart continues where the stream stopped
+        self.notification = MongoNotification(mongo_uri, db_name, client=self.client, resume_token_id=resume_token_id)
+        self._unique_index_ready = False
+        self._lock_index_ready = False
+        # Committed changes are recorded in a capped collection of
+        # change_log_size bytes, and compaction keeps change_log_length
+        # entries per context. None disables the change log.
+        self.change_log_length = change_log_length
+        self.change_log_size = change_log_size
+        self._change_log_ready = False
 
     async def load_context(self, context_key: str):
         document = await self.db.contexts.find_one({"context_key": context_key})
         return document.get('context', {}) if document else {}
 
+    async def load_versioned(self, context_key: str):
+        document = await self.db.contexts.find_one({"context_key": context_key})
+        if not document:
+            return {}, 0
+        return document.get('context', {}), document.get('version', 0)
+
+    async def load_keys(self, context_key: str, keys):
+        keys = list(keys)
+        if not all(self._is_addressable(key) for key in keys):
+            return await super().load_keys(context_key, keys)
+        # The projection returns only the requested sub-fields of the context
+        document = await self.db.contexts.find_one(
+            {"context_key": context_key},
+            projection={"_id": False, "version": True, **{f"context.{key}": True for key in keys}}
+        )
+        if not document:
+            return {}, 0
+        context = document.get('context', {})
+        return {key: context[key] for key in keys if key in context}, document.get('version', 0)
+
+    async def load_many(self, context_keys):
+        context_keys = list(context_keys)
+        loaded = {context_key: ({}, 0) for context_key in context_keys}
+        cursor = self.db.contexts.find(
+            {"context_key": {"$in": context_keys}},
+            projection={"_id": False, "context_key": True, "context": True, "version": True}
+        )
+        async for document in cursor:
+            loaded[document["context_key"]] = (document.get('context', {}), document.get('version', 0))
+        return loaded
+
+    async def get_version(self, context_key: str):
+        document = await self.db.contexts.find_one(
+            {"context_key": context_key},
+            projection={"_id": False, "version": True}
+        )
+        return document.get('version', 0) if document else 0
+
     async def save_context(self, context_key: str, context: dict):
+        version = await self._write(context_key, {"$set": {"context": context}})
+        await self._log_change(context_key, version)
+        if self.enable_notifications:
+            await self.notification.publish_update(context_key, update_message(version))
+        return version
+
+    async def store_snapshot(self, context_key: str, context: dict, version: int):
         await self.db.contexts.update_one(
             {"context_key": context_key},
-            {"$set": {"context": context}},
+            {"$set": {"context": context, "version": version}},
             upsert=True
         )
+        if self.change_log_length:
+            await self.db.changes.delete_many({"context_key": context_key})
+        return version
+
+    async def changes_since(self, context_key: str, version: int):
+        if not self.change_log_length:
+            return None
+        current_version = await self.get_version(context_key)
+        cursor = self.db.changes.find(
+            {"context_key": context_key, "version": {"$gt": version, "$lte": current_version}}
+        ).sort("version", 1)
+        messages = []
+        async for entry in cursor:
+            if entry.get("full"):
+                messages.append(update_message(entry["version"]))
+            else:
+                messages.append(update_message(entry["version"], dict(entry["changed"]), entry["deleted"]))
+        return contiguous_changes(version, current_version, messages)
+
+    async def compact_change_log(self, context_key: str):
+        if self.change_log_length:
+            current_version = await self.get_version(context_key)
+            await self.db.changes.delete_many(
+                {"context_key": context_key, "version": {"$lte": current_version - self.change_log_length}}
+            )
+
+    async def _ensure_change_log(self):
+        if not self._change_log_ready:
+            try:
+                await self.db.create_collection("changes", capped=True, size=self.change_log_size)
+            except CollectionInvalid:
+                pass  # Already created
+            await self.db.changes.create_index([("context_key", 1), ("version", 1)])
+            self._change_log_ready = True
+
+    async def _log_change(self, context_key: str, version, changes=None):
+        # changes is (changed, deleted), or None for a full rewrite. Entries
+        # are written after the commit, so a writer failing in between
+        # leaves a gap and readers fall back to a full load.
+        if not self.change_log_length or version is None:
+            return
+        await self._ensure_change_log()
+        entry = {"context_key": context_key, "version": version}
+        if changes is None:
+            entry["full"] = True
+        else:
+            changed, deleted = changes
+            # Pairs instead of a sub-document, since keys may contain "." or "$"
+            entry["changed"] = [[key, value] for key, value in changed.items()]
+            entry["deleted"] = list(deleted)
+        await self.db.changes.insert_one(entry)
+
+    async def _write(self, context_key: str, update: dict, expected_version=None, fence=None):
+        query = {"context_key": context_key}
+        if expected_version is not None:
+            # Documents written before versioning have no version field
+            query["version"] = expected_version if expected_version else {"$in": [None, 0]}
+        if fence:
+            # The context remembers the highest fencing token that wrote it
+            # for each lock, and writes with an older token do not match
+            fields = {f"fences.{self._fence_field(lock_name)}": token for lock_name, token in fence.items()}
+            query["$and"] = [
+                {"$or": [{field: {"$lte": token}}, {field: {"$exists": False}}]}
+                for field, token in fields.items()
+            ]
+            update = {**update, "$max": fields}
+            await self._ensure_unique_index()
+        try:
+            document = await self.db.contexts.find_one_and_update(
+                query,
+                {**update, "$inc": {"version": 1}},
+                projection={"_id": False, "version": True},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The version or fence filter did not match an existing document,
+            # so the upsert tried to insert a second one for the same context key
+            if expected_version is not None:
+                return None
+            if fence:
+                raise LockLostError(f"Lost a lock of {context_key} before writing it")
+            raise
+        return document['version']
+
+    @staticmethod
+    def _fence_field(lock_name: str):
+        # Lock names contain context keys, which may contain "." or "$"
+        return lock_name.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+    async def _ensure_unique_index(self):
+        # Conditional upserts rely on the unique index to fail instead of
+        # inserting a duplicate document when the version does not match
+        if not self._unique_index_ready:
+            await self.db.contexts.create_index("context_key", unique=True)
+            self._unique_index_ready = True
+
+    async def _rewrite_keys(self, context_key: str, changed: dict, deleted, fence: dict = None):
+        # Writes keys that cannot be addressed by a dotted path by rewriting
+        # the stored context. The rewrite only commits against the version it
+        # read, so it never overwrites keys that another writer, such as one
+        # holding a different key lock, changed in the meantime.
+        await self._ensure_unique_index()
+        for _ in range(self.max_operation_retries):
+            context, version = await self.load_versioned(context_key)
+            context = {**context, **changed}
+            for key in deleted:
+                context.pop(key, None)
+            new_version = await self._write(context_key, {"$set": {"context": context}}, expected_version=version, fence=fence)
+            if new_version is not None:
+                return new_version
+            if fence and await self.get_version(context_key) == version:
+                # Nobody else wrote, so the fence rejected the write
+                raise LockLostError(f"Lost a lock of {context_key} before writing it")
+        raise Exception(f"Failed to save {context_key} due to repeated version conflicts")
+
+    def _keys_update(self, changed: dict, deleted, context: dict = None):
+        if any(not self._is_addressable(key) for key in [*changed, *deleted]):
+            # Keys containing "." or starting with "$" cannot be used in a
+            # dotted path, so rewrite the whole context instead.
+            if context is None:
+                return None
+            return {"$set": {"context": context}}
+        update = {}
+        if changed:
+            update["$set"] = {f"context.{key}": value for key, value in changed.items()}
+        if deleted:
+            update["$unset"] = {f"context.{key}": "" for key in deleted}
+        return update
+
+    async def save_keys(self, context_key: str, changed: dict, deleted: set, context: dict = None, fence: dict = None):
+        if not changed and not deleted:
+            return await self.get_version(context_key)
+        update = self._keys_update(changed, deleted, context)
+        if update is None:
+            version = await self._rewrite_keys(context_key, changed, deleted, fence)
+        else:
+            version = await self._write(context_key, update, fence=fence)
+        await self._log_change(context_key, version, (changed, deleted))
+        if self.enable_notifications:
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def save_many(self, changes: dict, fences: dict = None):
+        # bulk_write does not return documents, so every write also stores a
+        # write id. A version read back afterwards is only reported as ours
+        # if the document still carries our write id; otherwise another
+        # writer got in between and the version is reported as None.
+        if any((fences or {}).values()):
+            # A write rejected by its fence filter only shows as a duplicate
+            # key error of the bulk upsert, so fenced writes use save_keys
+            return await super().save_many(changes, fences)
+        write_id = uuid.uuid4().hex
+        requests = []
+        rewritten = {}
+        for context_key, (changed, deleted, context) in changes.items():
+            if not changed and not deleted:
+                continue
+            update = self._keys_update(changed, deleted, context)
+            if update is None:
+                rewritten[context_key] = await self._rewrite_keys(context_key, changed, deleted)
+                continue
+            update = {**update, "$inc": {"version": 1}}
+            update["$set"] = {**update.get("$set", {}), "write_id": write_id}
+            requests.append(UpdateOne({"context_key": context_key}, update, upsert=True))
+        if requests:
+            await self.db.contexts.bulk_write(requests, ordered=False)
+        versions = {context_key: None for context_key in changes}
+        cursor = self.db.contexts.find(
+            {"context_key": {"$in": list(changes)}},
+            projection={"_id": False, "context_key": True, "version": True, "write_id": True}
+        )
+        async for document in cursor:
+            changed, deleted, _ = changes[document["context_key"]]
+            if document.get("write_id") == write_id or not (changed or deleted):
+                versions[document["context_key"]] = document.get("version", 0)
+        versions.update(rewritten)
+        for context_key, (changed, deleted, _) in changes.items():
+            if changed or deleted:
+                await self._log_change(context_key, versions[context_key], (changed, deleted))
+        if self.enable_notifications:
+            for context_key, (changed, deleted, _) in changes.items():
+                if versions[context_key] is not None and (changed or deleted):
+                    await self.notification.publish_update(context_key, update_message(versions[context_key], changed, deleted))
+        return versions
+
+    async def compare_and_save(self, context_key: str, changed: dict, deleted: set, expected_version: int, context: dict = None):
+        update = self._keys_update(changed, deleted, context)
+        if update is None:
+            raise ValueError("compare_and_save needs the full context to write keys that cannot be addressed by a dotted path")
+        await self._ensure_unique_index()
+        version = await self._write(context_key, update, expected_version=expected_version)
+        await self._log_change(context_key, version, (changed, deleted))
+        if version is not None and self.enable_notifications:
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    @staticmethod
+    def _operation_stages(name: str, path: tuple, argument):
+        # Returns the expression for the operation's result, evaluated before
+        # the operation, and the stage that applies it
+        field = "context." + ".".join(path)
+        current = "$" + field
+        argument = {"$literal": argument}
+        if name == "set":
+            return {"$literal": None}, {"$set": {field: argument}}
+        if name == "increment":
+            value = {"$add": [{"$ifNull": [current, 0]}, argument]}
+            return value, {"$set": {field: value}}
+        if name == "append":
+            result = {"$add": [{"$size": {"$ifNull": [current, []]}}, 1]}
+            return result, {"$set": {field: {"$concatArrays": [{"$ifNull": [current, []]}, [argument]]}}}
+        if name == "merge":
+            value = {"$mergeObjects": [{"$ifNull": [current, {}]}, argument]}
+            return value, {"$set": {field: value}}
+        if name == "set_if_absent":
+            return {"$in": [{"$type": current}, ["missing", "null"]]}, {"$set": {field: {"$ifNull": [current, argument]}}}
+        return {"$ne": [{"$type": current}, "missing"]}, {"$unset": field}
+
+    async def apply_operations(self, context_key: str, operations):
+        # Runs the operations as one pipeline update. Before each operation
+        # its result is appended to the document's op_results field, which
+        # is read back with the updated values and then removed, so it does
+        # not stay in the stored document. Change stream subscribers skip
+        # the removal, see notifications.is_transient_update. Unlike common.operations, a
+        # path through a value that is not a document replaces that value
+        # (or, for a list, sets the field in each element), as MongoDB does.
+        if not operations or not all(self._is_addressable(key) for _, path, _ in operations for key in path):
+            return await super().apply_operations(context_key, operations)
+        pipeline = [{"$set": {"op_results": {"$literal": []}}}]
+        for name, path, argument in operations:
+            result, stage = self._operation_stages(name, path, argument)
+            pipeline.append({"$set": {"op_results": {"$concatArrays": ["$op_results", [result]]}}})
+            pipeline.append(stage)
+        mutates = True
+        if all(name in CONDITIONAL_OPERATIONS for name, _, _ in operations):
+            mutates = {"$anyElementTrue": ["$op_results"]}
+        pipeline.append({"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, {"$cond": [mutates, 1, 0]}]}}})
+        tops = {path[0] for _, path, _ in operations}
+        try:
+            document = await self.db.contexts.find_one_and_update(
+                {"context_key": context_key},
+                pipeline,
+                projection={"_id": False, "version": True, "op_results": True, **{f"context.{top}": True for top in tops}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except OperationFailure as error:
+            if error.code in OPERATION_TYPE_ERRORS:
+                raise TypeError(f"A value operated on in {context_key} has the wrong type: {error}") from error
+            raise
+        results = document["op_results"]
+        # A concurrent call may have set the field again since, but it reads
+        # its own results from its update's reply, so removing them is safe
+        await self.db.contexts.update_one(
+            {"context_key": context_key, "op_results": {"$exists": True}},
+            {"$unset": {"op_results": ""}}
+        )
+        changed_keys, deleted = set(), set()
+        for (name, path, _), result in zip(operations, results):
+            if name in CONDITIONAL_OPERATIONS and not result:
+                continue
+            if name == "delete" and len(path) == 1:
+                deleted.add(path[0])
+                changed_keys.discard(path[0])
+            else:
+                changed_keys.add(path[0])
+                deleted.discard(path[0])
+        version = document["version"]
+        if not changed_keys and not deleted:
+            return version, results, {}, deleted
+        context = document.get("context", {})
+        changed = {key: context.get(key) for key in changed_keys}
+        await self._log_change(context_key, version, (changed, deleted))
         if self.enable_notifications:
-            await self.notification.publish_update(context_key)
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version, results, changed, deleted
+
+    @staticmethod
+    def _is_addressable(key: str):
+        return bool(key) and "." not in key and not key.startswith("$")
 
-    async def publish_update(self, channel: str):
+    async def publish_update(self, channel: str, message: dict = None):
         if self.enable_notifications:
-            await self.notification.publish_update(channel)
+            await self.notification.publish_update(channel, message)
 
     async def subscribe_to_updates(self, channel: str, callback):
         if self.enable_notifications:
-            await self.notification.subscribe_to_updates(channel, callback)
+            return await self.notification.subscribe_to_updates(channel, callback)
 
     async def acquire_lock(self, key: str, lock_value: str, lock_timeout: int):
-        expire_at = datetime.utcnow() + timedelta(milliseconds=lock_timeout)
+        # Takes the lock if it is free or its lease has expired, judged by the
+        # server clock. The fencing token is at least the server time in ms,
+        # so it keeps increasing even after the TTL index removed the lock.
+        await self._ensure_lock_index()
+        try:
+            document = await self.db.locks.find_one_and_update(
+                {"_id": key, "$or": [{"lock_value": None}, {"$expr": {"$lte": ["$expire_at", "$$NOW"]}}]},
+                [{"$set": {
+                    "lock_value": lock_value,
+                    "expire_at": {"$add": ["$$NOW", lock_timeout]},
+                    "fence": {"$max": [{"$add": [{"$ifNull": ["$fence", 0]}, 1]}, {"$toLong": "$$NOW"}]}
+                }}],
+                projection={"_id": False, "fence": True},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The lock is held, so the upsert tried to insert a second document
+            return False
+        return document["fence"]
+
+    async def renew_lock(self, key: str, lock_value: str, lock_timeout: int):
         result = await self.db.locks.update_one(
-            {"_id": key, "lock_value": {"$exists": False}},
-            {"$set": {"lock_value": lock_value, "expire_at": expire_at}},
-            upsert=True
+            {"_id": key, "lock_value": lock_value},
+            [{"$set": {"expire_at": {"$add": ["$$NOW", lock_timeout]}}}]
         )
-        return result.modified_count == 1
+        return result.matched_count == 1
 
     async def release_lock(self, key: str, lock_value: str):
-        await self.db.locks.delete_one({"_id": key, "lock_value": lock_value})
\ No newline at end of file
+        # The document is kept until the TTL index removes it, so the next
+        # owner continues its fencing tokens
+        result = await self.db.locks.update_one(
+            {"_id": key, "lock_value": lock_value},
+            [{"$set": {"lock_value": None, "expire_at": "$$NOW"}}]
+        )
+        return result.matched_count == 1
+
+    async def _ensure_lock_index(self):
+        # Removes lock documents a while after their lease ended, including
+        # the ones left behind by crashed owners
+        if not self._lock_index_ready:
+            await self.db.locks.create_index("expire_at", expireAfterSeconds=LOCK_TTL_GRACE_SECONDS)
+            self._lock_index_ready = True
@@ -1,34 +1,377 @@
+import json
+import time
+from datetime import timezone
+import asyncio
 import motor
-import asyncio_redis
+import redis.asyncio
+import redis.exceptions
+from pymongo.errors import OperationFailure, PyMongoError
+
+from common.logger import configure_logging
+
+logger = configure_logging()
 
 # Create an alias for the TimeoutError class
-RedisTimeoutError = asyncio_redis.Error
+RedisTimeoutError = redis.exceptions.TimeoutError
+
+# Server errors raised when a change stream cannot resume from its token
+# (ChangeStreamHistoryLost, ChangeStreamFatalError)
+RESUME_TOKEN_LOST_CODES = (286, 280)
+
+def redis_client(redis_url: str, max_connections: int = None, **options):
+    # redis_url is a redis:// URL or a host name. The client connects on its
+    # first command. Replies are bytes, since codec payloads are binary.
+    # With max_connections, commands wait for a free connection of a pool of
+    # that size instead of opening more. options go to the connections.
+    url = redis_url if "://" in redis_url else f"redis://{redis_url}"
+    if max_connections:
+        pool = redis.asyncio.BlockingConnectionPool.from_url(url, max_connections=max_connections, timeout=None, **options)
+    else:
+        pool = redis.asyncio.ConnectionPool.from_url(url, **options)
+    return redis.asyncio.Redis.from_pool(pool)
+
+def update_message(version, changed=None, deleted=()):
+    # A message without "changed" only announces a new version, and
+    # subscribers have to reload the context to see it.
+    message = {"version": version}
+    if changed is not None:
+        message["changed"] = changed
+        message["deleted"] = list(deleted)
+    return message
+
+def contiguous_changes(version, current_version, messages):
+    # Returns the change log messages if they cover every version after
+    # version up to current_version, otherwise None
+    for offset, message in enumerate(messages, start=1):
+        if message["version"] != version + offset:
+            return None
+    if version + len(messages) != current_version:
+        return None
+    return messages
+
+# Document fields MongoDBBackend sets only for the duration of a write, see
+# MongoDBBackend.apply_operations
+TRANSIENT_FIELDS = ("op_results",)
+
+def is_transient_update(update_description: dict):
+    # True for a versionless update that only touches transient fields, such
+    # as the one removing op_results after an operations pipeline. Its
+    # context is unchanged, so subscribers do not need to hear of it.
+    if "version" in update_description.get("updatedFields", {}):
+        return False
+    paths = [*update_description.get("updatedFields", {}), *update_description.get("removedFields", [])]
+    return bool(paths) and all(path.split(".", 1)[0] in TRANSIENT_FIELDS for path in paths)
+
+def change_stream_message(update_description: dict):
+    # Turns the updateDescription of a change stream update event on a
+    # context document into an update message. Only whole top-level context
+    # keys can be applied as a delta; anything else needs a reload.
+    updated = update_description.get("updatedFields", {})
+    version = updated.get("version")
+    if version is None:
+        return None
+    changed = {}
+    deleted = []
+    for path, value in updated.items():
+        if path == "context" or (path.startswith("context.") and "." in path[len("context."):]):
+            return update_message(version)
+        if path.startswith("context."):
+            changed[path[len("context."):]] = value
+    for path in update_description.get("removedFields", []):
+        if path == "context" or (path.startswith("context.") and "." in path[len("context."):]):
+            return update_message(version)
+        if path.startswith("context."):
+            deleted.append(path[len("context."):])
+    if update_description.get("truncatedArrays"):
+        return update_message(version)
+    return update_message(version, changed, deleted)
+
+class Subscription:
+    # Handle returned by RedisNotification.subscribe_to_updates. Cancelling it
+    # removes the callback, and the channel is unsubscribed once no callbacks
+    # are left on it.
+    def __init__(self, notification, channel: str, callback):
+        self.notification = notification
+        self.channel = channel
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.notification._remove(self)
 
 class RedisNotification:
-    def __init__(self, redis_url):
-        self.redis = asyncio_redis.Connection.create(host=redis_url)
+    # All subscriptions share one pub/sub connection and one listener task,
+    # and messages are dispatched to callbacks by channel.
+    def __init__(self, redis_url, connection=None):
+        self.redis_url = redis_url
+        self.redis = connection or redis_client(redis_url)
+        self._subscriber = None
+        self._listener = None
+        self._handlers = {}
+        self._subscribing = asyncio.Lock()
 
-    async def publish_update(self, channel: str):
-        await self.redis.publish(channel, "update")
+    async def publish_update(self, channel: str, message: dict = None):
+        # sent lets subscribers measure the notification lag
+        await self.redis.publish(channel, json.dumps({**message, "sent": time.time()}) if message else "update")
 
     async def subscribe_to_updates(self, channel: str, callback):
-        subscriber = await self.redis.start_subscribe()
-        await subscriber.subscribe([channel])
+        # Returns once subscribed; messages are delivered from a background task
+        subscription = Subscription(self, channel, callback)
+        async with self._subscribing:
+            handlers = self._handlers.setdefault(channel, [])
+            handlers.append(subscription)
+            if self._subscriber is None:
+                await self._start_subscriber([channel])
+            elif len(handlers) == 1:
+                await self._subscriber.subscribe(channel)
+            if self._listener is None or self._listener.done():
+                self._listener = asyncio.create_task(self._listen())
+        return subscription
+
+    async def _start_subscriber(self, channels):
+        self._subscriber = self.redis.pubsub()
+        await self._subscriber.subscribe(*channels)
+        # The client reconnects a dropped pub/sub connection on its own and
+        # resubscribes, so a reconnect is only noticed through this callback
+        self._subscriber.connection.register_connect_callback(self._on_reconnect)
+
+    def _remove(self, subscription: Subscription):
+        handlers = self._handlers.get(subscription.channel, [])
+        if subscription in handlers:
+            handlers.remove(subscription)
+        if not handlers:
+            self._handlers.pop(subscription.channel, None)
+            asyncio.ensure_future(self._unsubscribe(subscription.channel))
+
+    async def _unsubscribe(self, channel: str):
+        async with self._subscribing:
+            if channel not in self._handlers and self._subscriber is not None:
+                await self._subscriber.unsubscribe(channel)
+
+    def channel_count(self):
+        return len(self._handlers)
+
+    async def _listen(self):
+        while self._subscriber is not None:
+            try:
+                reply = await self._subscriber.get_message(ignore_subscribe_messages=True, timeout=None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning(f"Lost the pub/sub connection: {error!r}, reconnecting")
+                await self._reconnect()
+                continue
+            if reply is None or reply["type"] != "message":
+                continue
+            channel = reply["channel"].decode()
+            message = None if reply["data"] == b"update" else json.loads(reply["data"])
+            for subscription in list(self._handlers.get(channel, ())):
+                try:
+                    await subscription.callback(message)
+                except Exception as error:
+                    logger.error(f"Update callback for {channel} failed: {error!r}")
+
+    async def _reconnect(self, initial_delay=0.1, max_delay=5.0):
+        delay = initial_delay
         while True:
-            reply = await subscriber.next_published()
-            if reply.value == "update":
-                await callback()
+            try:
+                async with self._subscribing:
+                    await self._close_subscriber()
+                    if self._handlers:
+                        await self._start_subscriber(list(self._handlers))
+                break
+            except Exception as error:
+                logger.warning(f"Reconnecting the pub/sub connection failed: {error!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+        await self._notify_all(None)
+
+    def _on_reconnect(self, connection):
+        # Called on the client's own reconnects only, the first connect
+        # happens before the callback is registered
+        asyncio.ensure_future(self._notify_all(None))
+
+    async def _notify_all(self, message):
+        # Messages published while disconnected are lost, so every subscriber
+        # is told to catch up (see Contextd.load_context)
+        for handlers in list(self._handlers.values()):
+            for subscription in list(handlers):
+                try:
+                    await subscription.callback(message)
+                except Exception as error:
+                    logger.error(f"Update callback for {subscription.channel} failed: {error!r}")
+
+    async def _close_subscriber(self):
+        subscriber, self._subscriber = self._subscriber, None
+        if subscriber is not None:
+            try:
+                if subscriber.connection is not None:
+                    subscriber.connection.deregister_connect_callback(self._on_reconnect)
+                await subscriber.aclose()
+            except Exception as error:
+                logger.warning(f"Closing the pub/sub connection failed: {error!r}")
+
+    async def close(self):
+        for handlers in list(self._handlers.values()):
+            for subscription in list(handlers):
+                subscription.cancelled = True
+        self._handlers.clear()
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        await self._close_subscriber()
 
 class MongoNotification:
-    def __init__(self, mongo_uri, db_name):
-        self.client = motor.motor_asyncio.AsyncIOMotorClient(mongo_uri)
+    # All subscriptions share one change stream on the contexts collection.
+    # The stream only matches the subscribed contexts; when the set of
+    # subscribed contexts changes it is restarted from the last resume
+    # token, so no change is missed. With resume_token_id the token is also
+    # stored in the database, and a restarted process continues from it.
+    def __init__(self, mongo_uri, db_name, client=None, resume_token_id=None, restart_delay=0.05, token_save_interval=1.0):
+        self.client = client or motor.motor_asyncio.AsyncIOMotorClient(mongo_uri)
         self.db = self.client[db_name]
+        self.resume_token_id = resume_token_id
+        self.restart_delay = restart_delay  # Lets a burst of subscriptions settle before restarting the stream
+        self.token_save_interval = token_save_interval
+        self._handlers = {}
+        self._document_ids = {}  # document _id -> context key, to match update events
+        self._resume_token = None
+        self._token_loaded = False
+        self._token_saved_at = 0.0
+        self._watcher = None
+        self._stale = asyncio.Event()  # Set when the stream filter needs to change
 
-    async def publish_update(self, channel: str):
-        # MongoDB change streams automatically handle publishing updates
+    async def publish_update(self, channel: str, message: dict = None):
+        # MongoDB change streams automatically handle publishing updates.
+        # Other messages are dropped, see StorageBackend.supports_publish.
         pass
 
     async def subscribe_to_updates(self, channel: str, callback):
-        async with self.db.contexts.watch([{'$match': {'operationType': 'update'}}]) as stream:
-            async for change in stream:
-                await callback()
\ No newline at end of file
+        subscription = Subscription(self, channel, callback)
+        handlers = self._handlers.setdefault(channel, [])
+        handlers.append(subscription)
+        if len(handlers) == 1:
+            # Update events only carry the document _id
+            document = await self.db.contexts.find_one({"context_key": channel}, projection={"_id": True})
+            if document:
+                self._document_ids[document["_id"]] = channel
+            self._stale.set()
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+        return subscription
+
+    def _remove(self, subscription: Subscription):
+        handlers = self._handlers.get(subscription.channel, [])
+        if subscription in handlers:
+            handlers.remove(subscription)
+        if not handlers:
+            self._handlers.pop(subscription.channel, None)
+            self._document_ids = {
+                document_id: context_key
+                for document_id, context_key in self._document_ids.items()
+                if context_key != subscription.channel
+            }
+            self._stale.set()
+
+    def channel_count(self):
+        return len(self._handlers)
+
+    def _pipeline(self):
+        return [{"$match": {"$or": [
+            {"operationType": {"$in": ["insert", "replace"]}, "fullDocument.context_key": {"$in": list(self._handlers)}},
+            {"operationType": "update", "documentKey._id": {"$in": list(self._document_ids)}}
+        ]}}]
+
+    async def _watch(self, initial_delay=0.1, max_delay=5.0):
+        # A failing stream is restarted after a delay that doubles with every
+        # failure in a row, up to max_delay, like RedisNotification._reconnect
+        if self.resume_token_id is not None and not self._token_loaded:
+            saved = await self.db.resume_tokens.find_one({"_id": self.resume_token_id})
+            self._resume_token = saved["token"] if saved else None
+            self._token_loaded = True
+        delay = self.restart_delay
+        backoff = initial_delay
+        while self._handlers:
+            await asyncio.sleep(delay)
+            delay = self.restart_delay
+            self._stale.clear()
+            try:
+                async with self.db.contexts.watch(self._pipeline(), resume_after=self._resume_token, max_await_time_ms=500) as stream:
+                    while not self._stale.is_set():
+                        change = await stream.try_next()
+                        backoff = initial_delay
+                        if stream.resume_token is not None:
+                            self._resume_token = stream.resume_token
+                        if change is not None:
+                            await self._dispatch(change)
+                        await self._save_resume_token()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as error:
+                if self._resume_token is None or error.code not in RESUME_TOKEN_LOST_CODES:
+                    logger.warning(f"Change stream failed: {error!r}, restarting in {backoff}s")
+                    delay, backoff = backoff, min(backoff * 2, max_delay)
+                    continue
+                # The oplog no longer holds the resume point, so changes were
+                # lost and every subscriber has to catch up on its own
+                logger.warning("Change stream resume token expired, restarting from now")
+                self._resume_token = None
+                await self._notify_all(None)
+            except PyMongoError as error:
+                logger.warning(f"Change stream failed: {error!r}, restarting in {backoff}s")
+                delay, backoff = backoff, min(backoff * 2, max_delay)
+
+    async def _dispatch(self, change: dict):
+        if change["operationType"] == "update":
+            if is_transient_update(change["updateDescription"]):
+                return
+            context_key = self._document_ids.get(change["documentKey"]["_id"])
+            message = change_stream_message(change["updateDescription"])
+        else:
+            document = change["fullDocument"]
+            context_key = document.get("context_key")
+            if change["documentKey"]["_id"] not in self._document_ids:
+                # A new document: its updates only match once its _id is in the filter
+                self._document_ids[change["documentKey"]["_id"]] = context_key
+                self._stale.set()
+            message = update_message(document["version"]) if "version" in document else None
+        if message is not None and change.get("wallTime") is not None:
+            # Lets subscribers measure the notification lag
+            message["sent"] = change["wallTime"].replace(tzinfo=timezone.utc).timestamp()
+        for subscription in list(self._handlers.get(context_key, ())):
+            try:
+                await subscription.callback(message)
+            except Exception as error:
+                logger.error(f"Update callback for {context_key} failed: {error!r}")
+
+    async def _notify_all(self, message):
+        for handlers in list(self._handlers.values()):
+            for subscription in list(handlers):
+                try:
+                    await subscription.callback(message)
+                except Exception as error:
+                    logger.error(f"Update callback for {subscription.channel} failed: {error!r}")
+
+    async def _save_resume_token(self, force=False):
+        if self.resume_token_id is None or self._resume_token is None:
+            return
+        now = time.monotonic()
+        if force or now - self._token_saved_at >= self.token_save_interval:
+            self._token_saved_at = now
+            await self.db.resume_tokens.update_one(
+                {"_id": self.resume_token_id},
+                {"$set": {"token": self._resume_token}},
+                upsert=True
+            )
+
+    async def close(self):
+        for handlers in list(self._handlers.values()):
+            for subscription in list(handlers):
+                subscription.cancelled = True
+        self._handlers.clear()
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        await self._save_resume_token(force=True)
@@ -1,33 +1,418 @@
+import asyncio
+import time
+from collections import OrderedDict
+
 from backends.base import StorageBackend
+from backends.notifications import update_message
+from common.logger import configure_logging
+
+logger = configure_logging()
+
+# Secondaries store the primary's version of their copy under this key, next
+# to the data, since their own version counters do not follow the primary's
+PRIMARY_VERSION_KEY = "__primary_version__"
+
+def with_primary_version(values: dict, version):
+    return {**values, PRIMARY_VERSION_KEY: version}
+
+class PendingWrite:
+    # Changes for one context key that have not reached the secondaries yet.
+    # Successive writes are merged, so only the latest state gets written.
+    def __init__(self):
+        self.context = None  # Full context if a full write is pending
+        self.changed = {}
+        self.deleted = set()
+        self.version = None  # Primary version of the latest merged write
+
+    def replace(self, context: dict, version):
+        self.context = dict(context)
+        self.changed = {}
+        self.deleted = set()
+        self.version = version
+
+    def merge(self, changed: dict, deleted, version):
+        self.version = version
+        if self.context is not None:
+            self.context.update(changed)
+            for key in deleted:
+                self.context.pop(key, None)
+            return
+        self.changed.update(changed)
+        self.deleted.difference_update(changed)
+        for key in deleted:
+            self.changed.pop(key, None)
+            self.deleted.add(key)
+
+    async def write_to(self, backend: StorageBackend, context_key: str):
+        if self.context is not None:
+            await backend.save_context(context_key, with_primary_version(self.context, self.version))
+        else:
+            await backend.save_keys(context_key, with_primary_version(self.changed, self.version), self.deleted)
+
+class TierStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.hydrations = 0
+        self.total_latency = 0.0
+        self.reads = 0
+
+    def record(self, outcome: str, latency: float):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        self.reads += 1
+        self.total_latency += latency
+
+    def as_dict(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "hydrations": self.hydrations,
+            "mean_latency": self.total_latency / self.reads if self.reads else 0.0,
+        }
 
 class OverlayStorageBackend(StorageBackend):
-    def __init__(self, primary_backend: StorageBackend, *secondary_backends: StorageBackend, enable_notifications=True):
+    def __init__(self, primary_backend: StorageBackend, *secondary_backends: StorageBackend, enable_notifications=True,
+                 write_behind=False, max_pending=1000, batch_size=16, write_retries=5, retry_delay=0.1,
+                 read_tiers=None, tier_timeout=None, hedge_after=None, hydrate=True, max_staleness=None):
         self.primary_backend = primary_backend
         self.secondary_backends = secondary_backends
         self.enable_notifications = enable_notifications
+        self.field_level = primary_backend.field_level
+        self.supports_publish = primary_backend.supports_publish
+        # With write-behind, writes return once the primary has committed and
+        # a background task copies them to the secondaries
+        self.write_behind = write_behind
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.write_retries = write_retries
+        self.retry_delay = retry_delay
+        self._pending = OrderedDict()  # context_key -> PendingWrite
+        self._pending_changed = asyncio.Event()
+        self._writer = None
+        self._in_flight = 0
+        self.write_behind_stats = {"queued": 0, "coalesced": 0, "written": 0, "retries": 0, "failed": 0}
+        # Backends to read from, fastest first. Without read tiers every read
+        # goes to the primary.
+        self.read_tiers = list(read_tiers) if read_tiers else None
+        self.tier_timeout = tier_timeout  # Seconds before a tier read counts as a miss
+        self.hedge_after = hedge_after  # Seconds before the next tier is queried as well
+        self.hydrate = hydrate  # Back-fill faster tiers that missed
+        # Seconds a primary version learnt from a write or a version check is
+        # trusted, so that reads within that time do not ask the primary
+        self.max_staleness = max_staleness
+        self._known_versions = {}  # context_key -> (primary version, time it was learnt)
+        self.tier_stats = [TierStats(f"{index}:{tier.__class__.__name__}") for index, tier in enumerate(self.read_tiers or ())]
+        self._hydrations = set()
 
     async def load_context(self, context_key: str):
-        return await self.primary_backend.load_context(context_key)
+        context, _ = await self.load_versioned(context_key)
+        return context
+
+    async def load_versioned(self, context_key: str):
+        if not self.read_tiers:
+            return await self.primary_backend.load_versioned(context_key)
+        # Tiers are read right away. A secondary's copy counts as a hit if
+        # the primary version stored with it is at least the primary's
+        # current version, which is asked for concurrently with the first
+        # tier read, or taken from a recent write or check within
+        # max_staleness. The primary's own answer is always accepted.
+        minimum = self._recent_version(context_key)
+        version_check = None
+        if minimum is None:
+            version_check = asyncio.create_task(self._check_version(context_key))
+        missed = []
+        running = {}
+        next_tier = 0
+
+        def start_next():
+            nonlocal next_tier
+            index = next_tier
+            next_tier += 1
+            running[asyncio.create_task(self._read_tier(index, context_key))] = index
+
+        start_next()
+        try:
+            while running:
+                hedge = self.hedge_after if next_tier < len(self.read_tiers) else None
+                done, _ = await asyncio.wait(running, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The slowest running tier is over its latency budget
+                    start_next()
+                    continue
+                for task in done:
+                    index = running.pop(task)
+                    result = task.result()
+                    if result is not None and self.read_tiers[index] is self.primary_backend:
+                        self._learn_version(context_key, result[1])
+                    elif result is not None:
+                        result = self._primary_copy(result)
+                        if result is not None and minimum is None:
+                            minimum = await version_check
+                        if result is None or result[1] < minimum:
+                            self.tier_stats[index].misses += 1
+                            result = None
+                    if result is not None:
+                        self.tier_stats[index].hits += 1
+                        self._hydrate(context_key, result, missed)
+                        return result
+                    missed.append(index)
+                if not running and next_tier < len(self.read_tiers):
+                    start_next()
+        finally:
+            for task in running:
+                task.cancel()
+            if version_check is not None and not version_check.done():
+                version_check.cancel()
+        # Every tier missed, fall back to the primary
+        result = await self.primary_backend.load_versioned(context_key)
+        self._learn_version(context_key, result[1])
+        self._hydrate(context_key, result, missed)
+        return result
+
+    def _primary_copy(self, result):
+        # Returns a secondary's (context, version) with the primary version
+        # stored alongside the data, or None if it has none
+        context, _ = result
+        if PRIMARY_VERSION_KEY not in context:
+            return None
+        context = dict(context)
+        return context, context.pop(PRIMARY_VERSION_KEY)
+
+    async def _check_version(self, context_key: str):
+        version = await self.primary_backend.get_version(context_key)
+        self._learn_version(context_key, version)
+        return version
+
+    def _recent_version(self, context_key: str):
+        if self.max_staleness is None:
+            return None
+        version, learnt_at = self._known_versions.get(context_key, (None, 0.0))
+        if time.monotonic() - learnt_at > self.max_staleness:
+            return None
+        return version
+
+    def _learn_version(self, context_key: str, version):
+        if self.max_staleness is None or version is None:
+            return
+        known, _ = self._known_versions.get(context_key, (None, 0.0))
+        if known is None or version >= known:
+            self._known_versions[context_key] = (version, time.monotonic())
+
+    async def load_many(self, context_keys):
+        if not self.read_tiers:
+            return await self.primary_backend.load_many(context_keys)
+        return await super().load_many(context_keys)
+
+    async def _read_tier(self, index: int, context_key: str):
+        # Returns the tier's (context, version), or None on a timeout or error
+        stats = self.tier_stats[index]
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(self.read_tiers[index].load_versioned(context_key), self.tier_timeout)
+        except asyncio.TimeoutError:
+            stats.record("timeouts", time.monotonic() - started)
+            return None
+        except Exception as error:
+            logger.warning(f"Reading {context_key} from tier {stats.name} failed: {error!r}")
+            stats.record("errors", time.monotonic() - started)
+            return None
+        stats.reads += 1
+        stats.total_latency += time.monotonic() - started
+        return result
+
+    def _hydrate(self, context_key: str, result, missed):
+        context, version = result
+        if not self.hydrate or version is None:
+            return
+        for index in missed:
+            tier = self.read_tiers[index]
+            if tier is self.primary_backend:
+                continue
+            self.tier_stats[index].hydrations += 1
+            task = asyncio.create_task(tier.store_snapshot(context_key, with_primary_version(context, version), version))
+            self._hydrations.add(task)
+            task.add_done_callback(self._hydrations.discard)
+
+    async def get_version(self, context_key: str):
+        return await self.primary_backend.get_version(context_key)
+
+    async def load_keys(self, context_key: str, keys):
+        # Single keys are read from the primary, which holds every version
+        return await self.primary_backend.load_keys(context_key, keys)
 
     async def save_context(self, context_key: str, context: dict):
-        await self.primary_backend.save_context(context_key, context)
-        for backend in self.secondary_backends:
-            await backend.save_context(context_key, context)
+        version = await self.primary_backend.save_context(context_key, context)
+        self._learn_version(context_key, version)
+        if self.write_behind:
+            await self._enqueue(context_key, lambda pending: pending.replace(context, version))
+        else:
+            await asyncio.gather(*(
+                backend.save_context(context_key, with_primary_version(context, version)) for backend in self.secondary_backends
+            ))
+        if self.enable_notifications:
+            await self.primary_backend.publish_update(context_key, update_message(version))
+        return version
+
+    async def save_keys(self, context_key: str, changed: dict, deleted: set, context: dict = None, fence: dict = None):
+        # Locks live on the primary, so only its write is fenced
+        version = await self.primary_backend.save_keys(context_key, changed, deleted, context, fence=fence)
+        await self._save_keys_to_secondaries(context_key, version, changed, deleted, context)
+        if self.enable_notifications:
+            await self.primary_backend.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def save_many(self, changes: dict, fences: dict = None):
+        # Locks live on the primary, so only its writes are fenced
+        versions = await self.primary_backend.save_many(changes, fences)
+        for context_key, version in versions.items():
+            self._learn_version(context_key, version)
+        if self.write_behind:
+            for context_key, (changed, deleted, _) in changes.items():
+                await self._enqueue(context_key, lambda pending, changed=changed, deleted=deleted, version=versions[context_key]: pending.merge(changed, deleted, version))
+        else:
+            secondary_changes = {
+                context_key: (
+                    with_primary_version(changed, versions[context_key]),
+                    deleted,
+                    with_primary_version(context, versions[context_key]) if context is not None else None
+                )
+                for context_key, (changed, deleted, context) in changes.items()
+            }
+            await asyncio.gather(*(backend.save_many(secondary_changes) for backend in self.secondary_backends))
         if self.enable_notifications:
-            await self.primary_backend.publish_update(context_key)
+            await asyncio.gather(*(
+                self.primary_backend.publish_update(context_key, update_message(versions[context_key], changed, deleted))
+                for context_key, (changed, deleted, _) in changes.items()
+            ))
+        return versions
 
-    async def publish_update(self, channel: str):
+    async def compare_and_save(self, context_key: str, changed: dict, deleted: set, expected_version: int, context: dict = None):
+        version = await self.primary_backend.compare_and_save(context_key, changed, deleted, expected_version, context)
+        if version is None:
+            return None
+        await self._save_keys_to_secondaries(context_key, version, changed, deleted, context)
         if self.enable_notifications:
-            await self.primary_backend.publish_update(channel)
+            await self.primary_backend.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def apply_operations(self, context_key: str, operations):
+        # The operations run on the primary, the secondaries get their outcome
+        version, results, changed, deleted = await self.primary_backend.apply_operations(context_key, operations)
+        if changed or deleted:
+            await self._save_keys_to_secondaries(context_key, version, changed, deleted)
+            if self.enable_notifications:
+                await self.primary_backend.publish_update(context_key, update_message(version, changed, deleted))
+        return version, results, changed, deleted
+
+    async def _save_keys_to_secondaries(self, context_key: str, version, changed: dict, deleted: set, context: dict = None):
+        self._learn_version(context_key, version)
+        if self.write_behind:
+            await self._enqueue(context_key, lambda pending: pending.merge(changed, deleted, version))
+        else:
+            if context is not None:
+                context = with_primary_version(context, version)
+            await asyncio.gather(*(
+                backend.save_keys(context_key, with_primary_version(changed, version), deleted, context)
+                for backend in self.secondary_backends
+            ))
+
+    async def _enqueue(self, context_key: str, apply):
+        if not self.secondary_backends:
+            return
+        pending = self._pending.get(context_key)
+        if pending is None:
+            # Apply backpressure instead of growing the queue without bound
+            while len(self._pending) >= self.max_pending:
+                self._pending_changed.clear()
+                await self._pending_changed.wait()
+            pending = self._pending.setdefault(context_key, PendingWrite())
+            self.write_behind_stats["queued"] += 1
+        else:
+            self.write_behind_stats["coalesced"] += 1
+        apply(pending)
+        self._pending_changed.set()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        # A batch holds distinct context keys and the next batch only starts
+        # once it is written, so writes for one key never overtake each other
+        while self._pending:
+            batch = [self._pending.popitem(last=False) for _ in range(min(self.batch_size, len(self._pending)))]
+            self._in_flight += len(batch)
+            self._pending_changed.set()
+            try:
+                await asyncio.gather(*(
+                    self._write_with_retries(backend, context_key, pending)
+                    for context_key, pending in batch
+                    for backend in self.secondary_backends
+                ))
+            finally:
+                self._in_flight -= len(batch)
+                self._pending_changed.set()
+
+    async def _write_with_retries(self, backend: StorageBackend, context_key: str, pending: PendingWrite):
+        for attempt in range(self.write_retries + 1):
+            try:
+                await pending.write_to(backend, context_key)
+                self.write_behind_stats["written"] += 1
+                return
+            except Exception as error:
+                if attempt == self.write_retries:
+                    self.write_behind_stats["failed"] += 1
+                    logger.error(f"Giving up writing {context_key} to {type(backend).__name__}: {error!r}")
+                    return
+                self.write_behind_stats["retries"] += 1
+                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+
+    async def flush(self):
+        # Waits until every queued write has been copied to the secondaries
+        while self._pending or self._in_flight:
+            self._pending_changed.clear()
+            await self._pending_changed.wait()
+        if self._hydrations:
+            await asyncio.gather(*self._hydrations, return_exceptions=True)
+
+    def read_stats(self):
+        return {stats.name: stats.as_dict() for stats in self.tier_stats}
+
+    async def close(self):
+        await self.flush()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    async def publish_update(self, channel: str, message: dict = None):
+        if self.enable_notifications:
+            await self.primary_backend.publish_update(channel, message)
 
     async def subscribe_to_updates(self, channel: str, callback):
         if self.enable_notifications:
-            await self.primary_backend.subscribe_to_updates(channel, callback)
+            return await self.primary_backend.subscribe_to_updates(channel, callback)
 
     async def acquire_lock(self, key: str, lock_value: str, lock_timeout: int):
         return await self.primary_backend.acquire_lock(key, lock_value, lock_timeout)
 
+    async def acquire_locks(self, keys, lock_value: str, lock_timeout: int):
+        return await self.primary_backend.acquire_locks(keys, lock_value, lock_timeout)
+
+    async def release_locks(self, keys, lock_value: str):
+        await self.primary_backend.release_locks(keys, lock_value)
+
+    async def renew_lock(self, key: str, lock_value: str, lock_timeout: int):
+        return await self.primary_backend.renew_lock(key, lock_value, lock_timeout)
+
+    async def acquire_lock_fair(self, key: str, lock_value: str, lock_timeout: int):
+        return await self.primary_backend.acquire_lock_fair(key, lock_value, lock_timeout)
+
+    async def leave_lock_queue(self, key: str, lock_value: str):
+        await self.primary_backend.leave_lock_queue(key, lock_value)
+
     async def release_lock(self, key: str, lock_value: str):
         await self.primary_backend.release_lock(key, lock_value)
-        for backend in self.secondary_backends:
-            await backend.release_lock(key, lock_value)
\ No newline at end of file
+        await asyncio.gather(*(backend.release_lock(key, lock_value) for backend in self.secondary_backends))
\ No newline at end of file
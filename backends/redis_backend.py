@@ -1,41 +1,752 @@
-import asyncio_redis
 import json
+import asyncio
 
-from backends.base import StorageBackend
-from backends.notifications import RedisNotification
+from backends.base import LockLostError, StorageBackend
+from backends.notifications import RedisNotification, contiguous_changes, redis_client, update_message
+from common.codec import default_codec
+
+# Shared by the versioned write scripts: records a committed version in the
+# context's change log, a stream whose entry IDs are the versions. A log that
+# does not end before the version no longer matches the versions and is
+# dropped. limit is "" when the change log is disabled.
+CHANGE_LOG_LUA = """
+local function log_change(log_key, limit, entry, version)
+    if limit ~= "" then
+        local last = redis.call("xrevrange", log_key, "+", "-", "COUNT", 1)[1]
+        if last and tonumber(string.match(last[1], "^%d+")) >= version then
+            redis.call("del", log_key)
+        end
+        redis.call("xadd", log_key, "MAXLEN", "~", limit, version .. "-0", "change", entry)
+    end
+    return version
+end
+"""
+
+# The single-context write scripts take the change log limit and entry off
+# the front of ARGV, and the change log key is KEYS[3].
+CHANGE_LOG_ARGS_LUA = CHANGE_LOG_LUA + """
+local log_limit = table.remove(ARGV, 1)
+local log_entry = table.remove(ARGV, 1)
+"""
+
+# Shared by the write scripts used for locked writes: rejects the write with
+# a STALE_FENCE error if another owner has taken one of the writer's locks.
+# Takes the number of fences and the fencing tokens off the front of ARGV;
+# the matching lock fence counters follow the other keys in KEYS.
+FENCE_ARGS_LUA = """
+local fence_count = tonumber(table.remove(ARGV, 1))
+local fence_tokens = {}
+for i = 1, fence_count do
+    fence_tokens[i] = table.remove(ARGV, 1)
+end
+for i = 1, fence_count do
+    if redis.call("get", KEYS[#KEYS - fence_count + i]) ~= fence_tokens[i] then
+        return redis.error_reply("STALE_FENCE")
+    end
+end
+"""
+
+# Writes a set of hash fields atomically and bumps the context version.
+# KEYS: context key, version key, change log key, then fence counters.
+# ARGV: change log limit and entry, fences, then expected version ("" to write unconditionally), replace flag, number
+# of changed fields, then field/value pairs, then the names of the fields to
+# delete. Returns nil if the stored version does not match the expected one.
+SAVE_FIELDS_SCRIPT = CHANGE_LOG_ARGS_LUA + FENCE_ARGS_LUA + """
+if ARGV[1] ~= "" and tonumber(redis.call("get", KEYS[2]) or "0") ~= tonumber(ARGV[1]) then
+    return false
+end
+if ARGV[2] == "1" then
+    redis.call("del", KEYS[1])
+end
+local changed = tonumber(ARGV[3])
+local last_changed = 3 + changed * 2
+for i = 4, last_changed, 2 do
+    redis.call("hset", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+for i = last_changed + 1, #ARGV do
+    redis.call("hdel", KEYS[1], ARGV[i])
+end
+return log_change(KEYS[3], log_limit, log_entry, redis.call("incr", KEYS[2]))
+"""
+
+# ARGV: change log limit and entry, fences, expected version ("" to write
+# unconditionally), serialized context.
+SAVE_BLOB_SCRIPT = CHANGE_LOG_ARGS_LUA + FENCE_ARGS_LUA + """
+if ARGV[1] ~= "" and tonumber(redis.call("get", KEYS[2]) or "0") ~= tonumber(ARGV[1]) then
+    return false
+end
+redis.call("set", KEYS[1], ARGV[2])
+return log_change(KEYS[3], log_limit, log_entry, redis.call("incr", KEYS[2]))
+"""
+
+# Replaces the context and sets its version to an explicit value. The change
+# log no longer leads up to that version, so it is dropped.
+# KEYS: context key, version key, change log key. ARGV: version, field-level flag, then either
+# the serialized context or field/value pairs.
+STORE_SNAPSHOT_SCRIPT = """
+redis.call("del", KEYS[1])
+if ARGV[2] == "1" then
+    for i = 3, #ARGV, 2 do
+        redis.call("hset", KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+else
+    redis.call("set", KEYS[1], ARGV[3])
+end
+redis.call("set", KEYS[2], ARGV[1])
+redis.call("del", KEYS[3])
+return tonumber(ARGV[1])
+"""
+
+# Reads the context and its version in one round trip.
+LOAD_SCRIPT = """
+local context
+if ARGV[1] == "1" then
+    context = redis.call("hgetall", KEYS[1])
+else
+    context = redis.call("get", KEYS[1])
+end
+return {context, redis.call("get", KEYS[2])}
+"""
+
+# Reads some fields of a field-level context and its version in one round
+# trip. KEYS: context key, version key. ARGV: field names. Returns the values,
+# false for missing fields, and the version. The fields are read in chunks
+# since Lua limits the number of arguments unpack can pass.
+LOAD_KEYS_SCRIPT = """
+local values = {}
+for i = 1, #ARGV, 1000 do
+    local chunk = redis.call("hmget", KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+    for j = 1, #chunk do
+        values[#values + 1] = chunk[j]
+    end
+end
+return {values, redis.call("get", KEYS[2])}
+"""
+
+# Reads several contexts and their versions in one round trip.
+# KEYS: context key and version key for each context. ARGV: field-level flag.
+# Returns the context and version of each context in turn.
+LOAD_MANY_SCRIPT = """
+local results = {}
+for i = 1, #KEYS, 2 do
+    if ARGV[1] == "1" then
+        results[i] = redis.call("hgetall", KEYS[i])
+    else
+        results[i] = redis.call("get", KEYS[i])
+    end
+    results[i + 1] = redis.call("get", KEYS[i + 1])
+end
+return results
+"""
+
+# Writes changes to several contexts atomically and bumps each version.
+# KEYS: context key, version key and change log key for each context, then
+# fence counters. ARGV: fences, field-level flag, change log limit, then per context the change log
+# entry followed by either the serialized context, or the number of changed
+# fields, field/value pairs, the number of deleted fields and their names.
+# Returns the new version of each context.
+SAVE_MANY_SCRIPT = CHANGE_LOG_LUA + FENCE_ARGS_LUA + """
+local versions = {}
+local arg = 3
+for i = 1, #KEYS - fence_count, 3 do
+    local entry = ARGV[arg]
+    arg = arg + 1
+    if ARGV[1] == "1" then
+        local changed = tonumber(ARGV[arg])
+        for j = arg + 1, arg + changed * 2, 2 do
+            redis.call("hset", KEYS[i], ARGV[j], ARGV[j + 1])
+        end
+        arg = arg + changed * 2 + 1
+        local deleted = tonumber(ARGV[arg])
+        for j = arg + 1, arg + deleted do
+            redis.call("hdel", KEYS[i], ARGV[j])
+        end
+        arg = arg + deleted + 1
+    else
+        redis.call("set", KEYS[i], ARGV[arg])
+        arg = arg + 1
+    end
+    versions[#versions + 1] = log_change(KEYS[i + 2], ARGV[2], entry, redis.call("incr", KEYS[i + 1]))
+end
+return versions
+"""
+
+# Returns the current version and the change log entries after a version.
+# KEYS: version key, change log key. ARGV: version.
+CHANGES_SINCE_SCRIPT = """
+local entries = redis.call("xrange", KEYS[2], (tonumber(ARGV[1]) + 1) .. "-0", "+")
+return {redis.call("get", KEYS[1]), entries}
+"""
+
+# Takes all of the given locks or none of them, and returns their next
+# fencing tokens (0 if any is held).
+# KEYS: lock keys, then their fence counters. ARGV: lock value, lock timeout in ms.
+ACQUIRE_MANY_SCRIPT = """
+local count = #KEYS / 2
+for i = 1, count do
+    if redis.call("exists", KEYS[i]) == 1 then
+        return 0
+    end
+end
+local tokens = {}
+for i = 1, count do
+    redis.call("set", KEYS[i], ARGV[1], "PX", ARGV[2])
+    tokens[i] = redis.call("incr", KEYS[count + i])
+end
+return tokens
+"""
+
+# Releases the given locks that are still held with the lock value.
+RELEASE_MANY_SCRIPT = """
+local released = 0
+for i = 1, #KEYS do
+    if redis.call("get", KEYS[i]) == ARGV[1] then
+        released = released + redis.call("del", KEYS[i])
+    end
+end
+return released
+"""
+
+# Takes a lock and returns its next fencing token, or 0 if it is held.
+# KEYS: lock key, fence counter. ARGV: lock value, lock timeout in ms.
+ACQUIRE_SCRIPT = """
+if redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return redis.call("incr", KEYS[2])
+end
+return 0
+"""
+
+# Extends the lease of a lock still held with the lock value.
+# KEYS: lock key. ARGV: lock value, lock timeout in ms.
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Grants a lock only to the owner at the head of a FIFO waiter queue, and
+# returns its next fencing token (0 if not granted).
+# KEYS: lock key, queue (sorted set of owners by ticket), ticket counter,
+# last-seen hash, fence counter. ARGV: lock value, lock timeout in ms, stale
+# waiter timeout in ms. Waiters that stopped polling are dropped from the
+# head of the queue.
+ACQUIRE_FAIR_SCRIPT = """
+local time = redis.call("time")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+if not redis.call("zscore", KEYS[2], ARGV[1]) then
+    redis.call("zadd", KEYS[2], redis.call("incr", KEYS[3]), ARGV[1])
+end
+redis.call("hset", KEYS[4], ARGV[1], now)
+local head = redis.call("zrange", KEYS[2], 0, 0)[1]
+while head and head ~= ARGV[1] and now - tonumber(redis.call("hget", KEYS[4], head) or "0") > tonumber(ARGV[3]) do
+    redis.call("zrem", KEYS[2], head)
+    redis.call("hdel", KEYS[4], head)
+    head = redis.call("zrange", KEYS[2], 0, 0)[1]
+end
+if head ~= ARGV[1] then
+    return 0
+end
+if redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    redis.call("zrem", KEYS[2], ARGV[1])
+    redis.call("hdel", KEYS[4], ARGV[1])
+    return redis.call("incr", KEYS[5])
+end
+return 0
+"""
+
+# Runs atomic operations (see common.operations) on the JSON-encoded fields of
+# a field-level context. KEYS: context key, version key, change log key.
+# ARGV: change log limit, then name, JSON path and JSON argument ("" for
+# delete) of each operation. Every operation is applied to the decoded values
+# before anything is written, so a type error leaves the context unchanged.
+# Returns the version, the JSON results, the JSON object of changed top-level
+# values and the JSON list of deleted keys. Returns FALLBACK when a value
+# cannot be decoded and re-encoded by cjson without changing it: values with
+# a codec header, empty lists and dicts (cjson cannot tell them apart),
+# numbers with more than 14 significant digits or an exponent, and floats
+# with integral values (cjson writes them as integers).
+ATOMIC_SCRIPT = CHANGE_LOG_LUA + """
+local function unsafe(raw)
+    if string.byte(raw, 1) >= 128 or string.find(raw, "[]", 1, true) or string.find(raw, "{}", 1, true) then
+        return true
+    end
+    for number in string.gmatch(raw, "%d+%.?%d*[eE]?") do
+        local digits = string.gsub(string.gsub(number, "%.", ""), "^0+", "")
+        if string.find(number, "[eE]$") or #digits > 14 or string.find(number, "%.0*$") then
+            return true
+        end
+    end
+    return false
+end
+local function absent(value)
+    return value == nil or value == cjson.null
+end
+local function is_list(value)
+    return type(value) == "table" and value[1] ~= nil
+end
+local function is_mapping(value)
+    return type(value) == "table" and value[1] == nil
+end
+local function is_float(value)
+    return value ~= math.floor(value)
+end
+
+local values = {}  -- Decoded top-level values, the root of every path
+local loaded = {}
+local state = {}  -- Top-level key -> "changed" or "deleted"
+local results = {}
+for i = 2, #ARGV, 3 do
+    local name, path, argument = ARGV[i], cjson.decode(ARGV[i + 1]), nil
+    if ARGV[i + 2] ~= "" then
+        if unsafe(ARGV[i + 2]) then
+            return "FALLBACK"
+        end
+        argument = cjson.decode(ARGV[i + 2])
+    end
+    local top = path[1]
+    if not loaded[top] then
+        local raw = redis.call("hget", KEYS[1], top)
+        if raw then
+            if unsafe(raw) then
+                return "FALLBACK"
+            end
+            values[top] = cjson.decode(raw)
+        end
+        loaded[top] = true
+    end
+    local parent, leaf, missing = values, path[#path], false
+    for depth = 1, #path - 1 do
+        local child = parent[path[depth]]
+        if absent(child) then
+            if name == "delete" then
+                missing = true
+                break
+            end
+            child = {}
+            parent[path[depth]] = child
+        elseif not is_mapping(child) then
+            return redis.error_reply("NOT_A_MAPPING")
+        end
+        parent = child
+    end
+    local result, mutated = cjson.null, true
+    local current = parent[leaf]
+    if missing then
+        result, mutated = false, false
+    elseif name == "set" then
+        parent[leaf] = argument
+    elseif name == "increment" then
+        if absent(current) then
+            current = 0
+        elseif type(current) ~= "number" then
+            return redis.error_reply("NOT_A_NUMBER")
+        end
+        result = current + argument
+        if tonumber(string.format("%.14g", result)) ~= result or (not is_float(result) and (is_float(current) or is_float(argument))) then
+            return "FALLBACK"
+        end
+        parent[leaf] = result
+    elseif name == "append" then
+        if absent(current) then
+            current = {}
+            parent[leaf] = current
+        elseif not is_list(current) then
+            return redis.error_reply("NOT_A_LIST")
+        end
+        current[#current + 1] = argument
+        result = #current
+    elseif name == "merge" then
+        if absent(current) then
+            current = {}
+            parent[leaf] = current
+        elseif not is_mapping(current) then
+            return redis.error_reply("NOT_A_MAPPING")
+        end
+        for key, value in pairs(argument) do
+            current[key] = value
+        end
+        result = current
+    elseif name == "set_if_absent" then
+        result = absent(current)
+        mutated = result
+        if result then
+            parent[leaf] = argument
+        end
+    elseif name == "delete" then
+        result = current ~= nil
+        mutated = result
+        parent[leaf] = nil
+    end
+    if mutated then
+        state[top] = (name == "delete" and #path == 1) and "deleted" or "changed"
+    end
+    -- Encoded right away, later operations may still modify the value
+    results[#results + 1] = cjson.encode(result)
+end
+
+local changed, deleted = {}, {}
+for top, change in pairs(state) do
+    if change == "deleted" then
+        redis.call("hdel", KEYS[1], top)
+        deleted[#deleted + 1] = cjson.encode(top)
+    else
+        local encoded = cjson.encode(values[top])
+        redis.call("hset", KEYS[1], top, encoded)
+        changed[#changed + 1] = cjson.encode(top) .. ":" .. encoded
+    end
+end
+local results_json = "[" .. table.concat(results, ",") .. "]"
+if #changed == 0 and #deleted == 0 then
+    return {tonumber(redis.call("get", KEYS[2]) or "0"), results_json, "{}", "[]"}
+end
+local changed_json = "{" .. table.concat(changed, ",") .. "}"
+local deleted_json = "[" .. table.concat(deleted, ",") .. "]"
+local entry = '{"changed": ' .. changed_json .. ', "deleted": ' .. deleted_json .. '}'
+local version = log_change(KEYS[3], ARGV[1], entry, redis.call("incr", KEYS[2]))
+return {version, results_json, changed_json, deleted_json}
+"""
+
+# Releases a lock still held with the lock value.
+# KEYS: lock key. ARGV: lock value.
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+SCRIPTS = (
+    SAVE_FIELDS_SCRIPT, SAVE_BLOB_SCRIPT, STORE_SNAPSHOT_SCRIPT, LOAD_SCRIPT, LOAD_KEYS_SCRIPT, LOAD_MANY_SCRIPT,
+    SAVE_MANY_SCRIPT, CHANGES_SINCE_SCRIPT, ACQUIRE_MANY_SCRIPT, RELEASE_MANY_SCRIPT, ACQUIRE_SCRIPT, RENEW_SCRIPT,
+    ACQUIRE_FAIR_SCRIPT, ATOMIC_SCRIPT, RELEASE_SCRIPT
+)
+
+# Errors ATOMIC_SCRIPT reports for values of the wrong type
+ATOMIC_ERRORS = {
+    "NOT_A_NUMBER": "is not a number",
+    "NOT_A_LIST": "is not a list",
+    "NOT_A_MAPPING": "is not a mapping",
+}
 
 class RedisBackend(StorageBackend):
-    def __init__(self, redis_url, enable_notifications=True):
-        self.redis = asyncio_redis.Connection.create(host=redis_url)
+    def __init__(self, redis_url, enable_notifications=True, field_level=False, codec=None, pool_size=None, change_log_length=None, client=None, client_options=None):
+        # With pool_size, commands run on a pool of that many connections
+        # and wait for a free one when all are busy. Notifications publish
+        # through the same pool and use one extra pub/sub connection for all
+        # subscriptions. client replaces the client built from redis_url and
+        # client_options (passed to its connections). Connections are opened
+        # on first use; create, or connect, checks the server is reachable.
+        self.redis = client or redis_client(redis_url, pool_size + 1 if pool_size else None, **(client_options or {}))
         self.enable_notifications = enable_notifications
-        self.notification = RedisNotification(redis_url)
+        self.field_level = field_level
+        self.codec = codec or default_codec
+        self.change_log_length = change_log_length  # Entries kept per context, None disables the change log
+        self.notification = RedisNotification(redis_url, connection=self.redis)
+        # Scripts are sent once and then run by their SHA1
+        self._scripts = {script: self.redis.register_script(script) for script in SCRIPTS}
+
+    @classmethod
+    async def create(cls, redis_url, **options):
+        backend = cls(redis_url, **options)
+        await backend.connect()
+        return backend
+
+    async def connect(self):
+        await self.redis.ping()
+
+    async def close(self):
+        await self.notification.close()
+        await self.redis.aclose()
+
+    async def _eval(self, script: str, keys: list, args: list):
+        return await self._scripts[script](keys=keys, args=args)
+
+    @staticmethod
+    def _version_key(context_key: str):
+        return f"{context_key}:version"
+
+    @staticmethod
+    def _change_log_key(context_key: str):
+        return f"{context_key}:changes"
+
+    def _keys(self, context_key: str):
+        return [context_key, self._version_key(context_key), self._change_log_key(context_key)]
+
+    def _change_log_entry(self, changes=None):
+        # changes is (changed, deleted), or None for a full rewrite, which
+        # readers of the log have to reload
+        if changes is None:
+            return ""
+        changed, deleted = changes
+        return json.dumps({"changed": changed, "deleted": list(deleted)})
+
+    def _change_log_args(self, changes=None):
+        if not self.change_log_length:
+            return ["", ""]
+        return [str(self.change_log_length), self._change_log_entry(changes)]
 
     async def load_context(self, context_key: str):
-        context_data = await self.redis.get(context_key)
-        return json.loads(context_data) if context_data else {}
+        context, _ = await self.load_versioned(context_key)
+        return context
+
+    async def load_versioned(self, context_key: str):
+        context_data, version = await self._eval(
+            LOAD_SCRIPT,
+            keys=[context_key, self._version_key(context_key)],
+            args=["1" if self.field_level else "0"]
+        )
+        version = int(version) if version else 0
+        if self.field_level:
+            fields = context_data or []
+            return {fields[i].decode(): self.codec.decode(fields[i + 1]) for i in range(0, len(fields), 2)}, version
+        return self.codec.decode(context_data) if context_data else {}, version
+
+    async def load_keys(self, context_key: str, keys):
+        if not self.field_level:
+            return await super().load_keys(context_key, keys)
+        keys = list(keys)
+        values, version = await self._eval(
+            LOAD_KEYS_SCRIPT,
+            keys=[context_key, self._version_key(context_key)],
+            args=keys
+        )
+        loaded = {key: self.codec.decode(value) for key, value in zip(keys, values or []) if value is not None}
+        return loaded, int(version) if version else 0
+
+    async def load_many(self, context_keys):
+        context_keys = list(context_keys)
+        if not context_keys:
+            return {}
+        keys = []
+        for context_key in context_keys:
+            keys.extend([context_key, self._version_key(context_key)])
+        results = await self._eval(LOAD_MANY_SCRIPT, keys=keys, args=["1" if self.field_level else "0"])
+        loaded = {}
+        for index, context_key in enumerate(context_keys):
+            context_data, version = results[2 * index], results[2 * index + 1]
+            if self.field_level:
+                fields = context_data or []
+                context = {fields[i].decode(): self.codec.decode(fields[i + 1]) for i in range(0, len(fields), 2)}
+            else:
+                context = self.codec.decode(context_data) if context_data else {}
+            loaded[context_key] = (context, int(version) if version else 0)
+        return loaded
+
+    async def changes_since(self, context_key: str, version: int):
+        if not self.change_log_length:
+            return None
+        current, entries = await self._eval(
+            CHANGES_SINCE_SCRIPT,
+            keys=[self._version_key(context_key), self._change_log_key(context_key)],
+            args=[str(version)]
+        )
+        current = int(current) if current else 0
+        messages = []
+        for entry_id, fields in entries:
+            entry_version = int(entry_id.split(b"-")[0])
+            entry = dict(zip(fields[::2], fields[1::2])).get(b"change")
+            if entry:
+                change = json.loads(entry)
+                messages.append(update_message(entry_version, change["changed"], change["deleted"]))
+            else:
+                messages.append(update_message(entry_version))
+        return contiguous_changes(version, current, messages)
+
+    async def compact_change_log(self, context_key: str):
+        # Trims the change log to exactly change_log_length entries; writes
+        # only trim it approximately
+        if self.change_log_length:
+            await self.redis.xtrim(self._change_log_key(context_key), maxlen=self.change_log_length, approximate=False)
+
+    async def get_version(self, context_key: str):
+        version = await self.redis.get(self._version_key(context_key))
+        return int(version) if version else 0
 
     async def save_context(self, context_key: str, context: dict):
-        await self.redis.set(context_key, json.dumps(context))
+        if self.field_level:
+            version = await self._save_fields(context_key, context, (), replace=True)
+        else:
+            version = await self._save_blob(context_key, context)
         if self.enable_notifications:
-            await self.notification.publish_update(context_key)
+            await self.notification.publish_update(context_key, update_message(version))
+        return version
 
-    async def publish_update(self, channel: str):
+    async def save_keys(self, context_key: str, changed: dict, deleted: set, context: dict = None, fence: dict = None):
+        if not changed and not deleted:
+            return await self.get_version(context_key)
+        if self.field_level:
+            version = await self._save_fields(context_key, changed, deleted, log=(changed, deleted), fence=fence)
+        else:
+            if context is None:
+                context = await self.load_context(context_key)
+                context.update(changed)
+                for key in deleted:
+                    context.pop(key, None)
+            version = await self._save_blob(context_key, context, log=(changed, deleted), fence=fence)
         if self.enable_notifications:
-            await self.notification.publish_update(channel)
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def save_many(self, changes: dict, fences: dict = None):
+        if not changes:
+            return {}
+        if not self.field_level and any(context is None for _, _, context in changes.values()):
+            # Blob writes need the full contexts to merge into
+            return await super().save_many(changes, fences)
+        fence = {lock_name: token for context_fence in (fences or {}).values() for lock_name, token in (context_fence or {}).items()}
+        keys = []
+        args = [str(len(fence)), *(str(token) for token in fence.values()), "1" if self.field_level else "0", str(self.change_log_length or "")]
+        for context_key, (changed, deleted, context) in changes.items():
+            keys.extend(self._keys(context_key))
+            args.append(self._change_log_entry((changed, deleted)))
+            if self.field_level:
+                args.append(str(len(changed)))
+                for field, value in changed.items():
+                    args.extend([field, self.codec.encode(value)])
+                args.append(str(len(deleted)))
+                args.extend(deleted)
+            else:
+                args.append(self.codec.encode(context))
+        keys.extend(self._fence_key(lock_name) for lock_name in fence)
+        try:
+            versions = dict(zip(changes, await self._eval(SAVE_MANY_SCRIPT, keys=keys, args=args)))
+        except Exception as error:
+            if "STALE_FENCE" in str(error):
+                raise LockLostError(f"Lost a lock of {', '.join(changes)} before writing them") from error
+            raise
+        if self.enable_notifications:
+            await asyncio.gather(*(
+                self.notification.publish_update(context_key, update_message(versions[context_key], changed, deleted))
+                for context_key, (changed, deleted, _) in changes.items()
+            ))
+        return versions
+
+    async def store_snapshot(self, context_key: str, context: dict, version: int):
+        args = [str(version), "1" if self.field_level else "0"]
+        if self.field_level:
+            for field, value in context.items():
+                args.extend([field, self.codec.encode(value)])
+        else:
+            args.append(self.codec.encode(context))
+        return await self._eval(
+            STORE_SNAPSHOT_SCRIPT,
+            keys=self._keys(context_key),
+            args=args
+        )
+
+    async def compare_and_save(self, context_key: str, changed: dict, deleted: set, expected_version: int, context: dict = None):
+        if self.field_level:
+            version = await self._save_fields(context_key, changed, deleted, expected_version=expected_version, log=(changed, deleted))
+        else:
+            if context is None:
+                raise ValueError("compare_and_save needs the full context for a blob layout")
+            version = await self._save_blob(context_key, context, expected_version=expected_version, log=(changed, deleted))
+        if version is not None and self.enable_notifications:
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def apply_operations(self, context_key: str, operations):
+        # Field-level contexts stored as uncompressed JSON run the operations
+        # in ATOMIC_SCRIPT. Other layouts and values the script cannot round
+        # trip use the compare-and-save fallback.
+        if not operations or not self.field_level or self.codec.encoder not in ("json", "orjson") or self.codec.compression:
+            return await super().apply_operations(context_key, operations)
+        args = [str(self.change_log_length or "")]
+        for name, path, argument in operations:
+            args.extend([name, json.dumps(list(path)), "" if name == "delete" else json.dumps(argument)])
+        try:
+            reply = await self._eval(ATOMIC_SCRIPT, keys=self._keys(context_key), args=args)
+        except Exception as error:
+            for code, problem in ATOMIC_ERRORS.items():
+                if code in str(error):
+                    raise TypeError(f"A value operated on in {context_key} {problem}") from error
+            raise
+        if reply == b"FALLBACK":
+            return await super().apply_operations(context_key, operations)
+        version, results, changed, deleted = reply
+        version, results, changed, deleted = int(version), json.loads(results), json.loads(changed), set(json.loads(deleted))
+        if (changed or deleted) and self.enable_notifications:
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version, results, changed, deleted
+
+    async def _save_blob(self, context_key: str, context: dict, expected_version=None, log=None, fence=None):
+        return await self._eval_write(
+            SAVE_BLOB_SCRIPT,
+            context_key,
+            ["" if expected_version is None else str(expected_version), self.codec.encode(context)],
+            log,
+            fence
+        )
+
+    async def _save_fields(self, context_key: str, changed: dict, deleted, replace=False, expected_version=None, log=None, fence=None):
+        args = [
+            "" if expected_version is None else str(expected_version),
+            "1" if replace else "0",
+            str(len(changed))
+        ]
+        for field, value in changed.items():
+            args.extend([field, self.codec.encode(value)])
+        args.extend(deleted)
+        return await self._eval_write(SAVE_FIELDS_SCRIPT, context_key, args, log, fence)
+
+    async def _eval_write(self, script: str, context_key: str, args: list, log=None, fence=None):
+        fence = fence or {}
+        try:
+            return await self._eval(
+                script,
+                keys=[*self._keys(context_key), *(self._fence_key(lock_name) for lock_name in fence)],
+                args=[*self._change_log_args(log), str(len(fence)), *(str(token) for token in fence.values()), *args]
+            )
+        except Exception as error:
+            if "STALE_FENCE" in str(error):
+                raise LockLostError(f"Lost a lock of {context_key} before writing it") from error
+            raise
+
+    async def publish_update(self, channel: str, message: dict = None):
+        if self.enable_notifications:
+            await self.notification.publish_update(channel, message)
 
     async def subscribe_to_updates(self, channel: str, callback):
         if self.enable_notifications:
-            await self.notification.subscribe_to_updates(channel, callback)
+            return await self.notification.subscribe_to_updates(channel, callback)
+
+    @staticmethod
+    def _fence_key(key: str):
+        return f"{key}:fence"
 
     async def acquire_lock(self, key: str, lock_value: str, lock_timeout: int):
-        return await self.redis.set(key, lock_value, nx=True, px=lock_timeout)
+        token = await self._eval(ACQUIRE_SCRIPT, keys=[key, self._fence_key(key)], args=[lock_value, str(lock_timeout)])
+        return token or False
+
+    async def renew_lock(self, key: str, lock_value: str, lock_timeout: int):
+        return await self._eval(RENEW_SCRIPT, keys=[key], args=[lock_value, str(lock_timeout)]) == 1
+
+    async def acquire_locks(self, keys, lock_value: str, lock_timeout: int):
+        keys = list(keys)
+        tokens = await self._eval(
+            ACQUIRE_MANY_SCRIPT,
+            keys=[*keys, *(self._fence_key(key) for key in keys)],
+            args=[lock_value, str(lock_timeout)]
+        )
+        if tokens == 0:
+            return False
+        return dict(zip(keys, tokens))
+
+    async def release_locks(self, keys, lock_value: str):
+        return await self._eval(RELEASE_MANY_SCRIPT, keys=list(keys), args=[lock_value])
+
+    async def acquire_lock_fair(self, key: str, lock_value: str, lock_timeout: int, stale_waiter_timeout: int = 2000):
+        acquired = await self._eval(
+            ACQUIRE_FAIR_SCRIPT,
+            keys=[key, f"{key}:queue", f"{key}:tickets", f"{key}:waiters", self._fence_key(key)],
+            args=[lock_value, str(lock_timeout), str(stale_waiter_timeout)]
+        )
+        return acquired or False
+
+    async def leave_lock_queue(self, key: str, lock_value: str):
+        await self.redis.zrem(f"{key}:queue", lock_value)
+        await self.redis.hdel(f"{key}:waiters", lock_value)
 
     async def release_lock(self, key: str, lock_value: str):
-        script = """
-        if redis.call("get", KEYS[1]) == ARGV[1] then
-            return redis.call("del", KEYS[1])
-        else
-            return 0
-        end
-        """
-        return await self.redis.eval(script, keys=[key], args=[lock_value])
\ No newline at end of file
+        return await self._eval(RELEASE_SCRIPT, keys=[key], args=[lock_value])
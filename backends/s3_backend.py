@@ -1,20 +1,54 @@
-import boto3
 import json
-from datetime import datetime, timedelta
+import time
+import zlib
+import boto3
+import hashlib
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
 
-from backends.base import StorageBackend
-from backends.notifications import RedisNotification, MongoNotification
+from backends.base import LockLostError, StorageBackend
+from backends.notifications import RedisNotification, MongoNotification, contiguous_changes, update_message
+from common.codec import default_codec
+from common.lazy import KeyCache
 
 class S3Backend(StorageBackend):
-    def __init__(self, bucket_name, aws_access_key_id, aws_secret_access_key, region_name, notification_type='redis', redis_url=None, mongo_uri=None, db_name=None, enable_notifications=True):
+    def __init__(self, bucket_name, aws_access_key_id, aws_secret_access_key, region_name, notification_type='redis', redis_url=None, mongo_uri=None, db_name=None, enable_notifications=True, field_level=False, max_concurrency=16, executor=None, codec=None, change_log_length=None, chunks=None, chunk_cache_bytes=64 * 1024 * 1024, range_size=8 * 1024 * 1024, chunk_grace_period=3600, endpoint_url=None):
+        # boto3 is synchronous, so every request runs on a bounded thread pool
+        # instead of the event loop. The HTTP connection pool is sized to
+        # match, so concurrent requests reuse connections instead of queueing.
         self.s3 = boto3.client(
             's3',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            region_name=region_name
+            region_name=region_name,
+            endpoint_url=endpoint_url,  # For S3-compatible stores such as MinIO
+            config=Config(max_pool_connections=max_concurrency)
         )
+        self.max_concurrency = max_concurrency
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="s3-backend")
+        self._requests = asyncio.Semaphore(max_concurrency)
         self.bucket_name = bucket_name
         self.enable_notifications = enable_notifications
+        # With chunks, keys are grouped by hash into that many chunk objects,
+        # stored under the hash of their content. A manifest lists the chunks
+        # of the current version, and swapping it commits a write, which only
+        # uploads the chunks that changed. Field-level contexts store every
+        # value as its own object the same way, listed by their version marker.
+        self.chunks = chunks
+        self.field_level = field_level or bool(chunks)
+        self.codec = codec or default_codec
+        self.range_size = range_size  # Chunks larger than this are read with concurrent ranged GETs
+        self.chunk_grace_period = chunk_grace_period  # Seconds an unreferenced chunk or value is kept for readers of older manifests
+        self._chunk_cache = KeyCache(max_bytes=chunk_cache_bytes, sizeof=len)  # digest -> encoded chunk or value; they never change
+        self._etags = {}  # context_key -> (version, ETag) of the last seen version object
+        self._garbage_seen = {}  # context_key -> {unreferenced object key: time a collection first saw it}
+        # Committed changes are also written as one object per version, and
+        # compaction keeps change_log_length of them. None disables the log.
+        self.change_log_length = change_log_length
         
         if notification_type == 'mongo' and mongo_uri and db_name:
             self.notification = MongoNotification(mongo_uri, db_name)
@@ -22,48 +56,570 @@ class S3Backend(StorageBackend):
             self.notification = RedisNotification(redis_url)
         else:
             self.notification = None
+        self.supports_publish = isinstance(self.notification, RedisNotification)
 
     async def load_context(self, context_key: str):
+        context, _ = await self.load_versioned(context_key)
+        return context
+
+    async def load_versioned(self, context_key: str):
+        if self.chunks:
+            return await self._load_chunked(context_key)
+        if self.field_level:
+            return await self._load_fields(context_key)
+        response = await self._get_object(context_key)
+        if response is None:
+            return {}, 0
+        body, metadata, etag = response
+        version = int(metadata.get('version', 0))
+        self._etags[context_key] = (version, etag)
+        return self.codec.decode(body), version
+
+    async def load_keys(self, context_key: str, keys):
+        if self.chunks:
+            return await self._load_chunked(context_key, keys)
+        if self.field_level:
+            return await self._load_fields(context_key, keys)
+        return await super().load_keys(context_key, keys)
+
+    async def get_version(self, context_key: str):
         try:
-            response = self.s3.get_object(Bucket=self.bucket_name, Key=context_key)
-            return json.loads(response['Body'].read().decode('utf-8'))
-        except self.s3.exceptions.NoSuchKey:
-            return {}
+            response = await self._call('head_object', Bucket=self.bucket_name, Key=self._version_object_key(context_key))
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                self._etags.pop(context_key, None)
+                return 0
+            raise
+        version = int(response['Metadata'].get('version', 0))
+        self._etags[context_key] = (version, response['ETag'])
+        return version
 
     async def save_context(self, context_key: str, context: dict):
-        self.s3.put_object(
+        version = await self.get_version(context_key) + 1
+        await self._write_snapshot(context_key, context, version)
+        await self._log_change(context_key, version)
+        if self.enable_notifications and self.notification:
+            await self.notification.publish_update(context_key, update_message(version))
+        return version
+
+    async def store_snapshot(self, context_key: str, context: dict, version: int):
+        await self._write_snapshot(context_key, context, version)
+        if self.change_log_length:
+            # The log no longer leads up to the stored version
+            await self._delete_objects(await self._list_objects(self._change_log_prefix(context_key)))
+        return version
+
+    async def changes_since(self, context_key: str, version: int):
+        if not self.change_log_length:
+            return None
+        current_version = await self.get_version(context_key)
+        if current_version == version:
+            return []
+        object_keys = await self._list_objects(
+            self._change_log_prefix(context_key),
+            start_after=self._change_log_object_key(context_key, version)
+        )
+        object_keys = object_keys[:current_version - version]
+        responses = await asyncio.gather(*(self._get_object(object_key) for object_key in object_keys))
+        messages = [json.loads(response[0]) for response in responses if response is not None]
+        return contiguous_changes(version, current_version, messages)
+
+    async def compact_change_log(self, context_key: str):
+        if self.change_log_length:
+            object_keys = await self._list_objects(self._change_log_prefix(context_key))
+            await self._delete_objects(object_keys[:-self.change_log_length])
+        if self.field_level:
+            await self.collect_garbage(context_key)
+
+    def _change_log_prefix(self, context_key: str):
+        return f"{context_key}/changes/"
+
+    def _change_log_object_key(self, context_key: str, version: int):
+        # Zero padded so that listing returns the entries in version order
+        return f"{self._change_log_prefix(context_key)}{version:020d}"
+
+    async def _log_change(self, context_key: str, version: int, changes=None):
+        # changes is (changed, deleted), or None for a full rewrite. Entries
+        # are written after the commit, so a writer failing in between
+        # leaves a gap and readers fall back to a full load.
+        if not self.change_log_length:
+            return
+        message = update_message(version) if changes is None else update_message(version, *changes)
+        await self._call(
+            'put_object',
             Bucket=self.bucket_name,
-            Key=context_key,
-            Body=json.dumps(context).encode('utf-8')
+            Key=self._change_log_object_key(context_key, version),
+            Body=json.dumps(message).encode('utf-8')
         )
+
+    async def _write_snapshot(self, context_key: str, context: dict, version: int):
+        if self.field_level:
+            await self._save_manifest(context_key, context, (), replace=True, version=version)
+        else:
+            await self._save_blob(context_key, context, version)
+
+    async def save_keys(self, context_key: str, changed: dict, deleted: set, context: dict = None, fence: dict = None):
+        if fence:
+            await self._check_fence(fence)
+        if not self.field_level and context is None:
+            context = await self.load_context(context_key)
+            context.update(changed)
+            for key in deleted:
+                context.pop(key, None)
+        if self.field_level and (changed or deleted):
+            version = await self._save_manifest(context_key, changed, deleted)
+            await self._log_change(context_key, version, (changed, deleted))
+            if self.enable_notifications and self.notification:
+                await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+            return version
+        version = await self.get_version(context_key)
+        if not changed and not deleted:
+            return version
+        version += 1
+        await self._save_blob(context_key, context, version)
+        await self._log_change(context_key, version, (changed, deleted))
+        if self.enable_notifications and self.notification:
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def compare_and_save(self, context_key: str, changed: dict, deleted: set, expected_version: int, context: dict = None):
+        if not self.field_level and context is None:
+            raise ValueError("compare_and_save needs the full context for a blob layout")
+        if self.field_level:
+            version = await self._save_manifest(context_key, changed, deleted, expected_version=expected_version)
+            if version is None:
+                return None
+            await self._log_change(context_key, version, (changed, deleted))
+            if self.enable_notifications and self.notification:
+                await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+            return version
+        known_version, etag = self._etags.get(context_key, (None, None))
+        if known_version != expected_version:
+            if await self.get_version(context_key) != expected_version:
+                return None
+            _, etag = self._etags.get(context_key, (None, None))
+        # The conditional PUT of the context object is the commit point
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        version = expected_version + 1
+        try:
+            await self._save_blob(context_key, context, version, condition)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                self._etags.pop(context_key, None)
+                return None
+            raise
+        await self._log_change(context_key, version, (changed, deleted))
         if self.enable_notifications and self.notification:
-            await self.notification.publish_update(context_key)
+            await self.notification.publish_update(context_key, update_message(version, changed, deleted))
+        return version
+
+    async def _call(self, method: str, **kwargs):
+        async with self._requests:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(getattr(self.s3, method), **kwargs))
+
+    async def _get_object(self, object_key: str):
+        # Reading the body is blocking too, so it happens on the pool thread.
+        # Returns None if the object does not exist.
+        def get():
+            try:
+                response = self.s3.get_object(Bucket=self.bucket_name, Key=object_key)
+            except self.s3.exceptions.NoSuchKey:
+                return None
+            return response['Body'].read(), response['Metadata'], response['ETag']
+
+        async with self._requests:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, get)
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+        if self.notification is not None:
+            await self.notification.close()
+
+    async def _save_blob(self, context_key: str, context: dict, version: int, condition=None):
+        response = await self._call(
+            'put_object',
+            Bucket=self.bucket_name,
+            Key=context_key,
+            Body=self.codec.encode(context),
+            Metadata={'version': str(version)},
+            **(condition or {})
+        )
+        self._etags[context_key] = (version, response['ETag'])
+
+    def _version_object_key(self, context_key: str):
+        # Blob contexts carry their version in the object metadata; field-level
+        # contexts on a marker object that lists their values, and chunked
+        # contexts on their manifest.
+        if self.chunks:
+            return f"{context_key}/manifest"
+        return f"{context_key}/version" if self.field_level else context_key
+
+    def _field_prefix(self, context_key: str):
+        return f"{context_key}/fields/"
+
+    async def _list_objects(self, prefix: str, start_after=None):
+        def list_objects():
+            paginator = self.s3.get_paginator('list_objects_v2')
+            pages = paginator.paginate(
+                Bucket=self.bucket_name,
+                Prefix=prefix,
+                **({'StartAfter': start_after} if start_after else {})
+            )
+            return [item['Key'] for page in pages for item in page.get('Contents', [])]
+
+        async with self._requests:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, list_objects)
+
+    async def _delete_objects(self, object_keys):
+        objects = [{'Key': object_key} for object_key in object_keys]
+        # DeleteObjects accepts at most 1000 keys per request
+        await asyncio.gather(*(
+            self._call(
+                'delete_objects',
+                Bucket=self.bucket_name,
+                Delete={'Objects': objects[start:start + 1000], 'Quiet': True}
+            )
+            for start in range(0, len(objects), 1000)
+        ))
+
+    def _chunk_prefix(self, context_key: str):
+        return f"{context_key}/chunks/"
+
+    def _object_prefix(self, context_key: str):
+        # Where the chunks or field values listed by the manifest are stored
+        return self._chunk_prefix(context_key) if self.chunks else self._field_prefix(context_key)
+
+    @staticmethod
+    def _chunk_index(key: str, chunk_count: int):
+        return zlib.crc32(key.encode('utf-8')) % chunk_count
+
+    async def _read_manifest(self, context_key: str):
+        # Returns the manifest and its ETag, or an empty manifest and None.
+        # A chunked manifest lists one entry per chunk index: None for an
+        # empty chunk, otherwise the digest and size of the chunk object. A
+        # field-level one maps every key to the digest and size of its value.
+        response = await self._get_object(self._version_object_key(context_key))
+        if response is None:
+            self._etags.pop(context_key, None)
+            if self.chunks:
+                return {"version": 0, "chunks": [None] * self.chunks}, None
+            return {"version": 0, "fields": {}}, None
+        body, _, etag = response
+        manifest = json.loads(body)
+        self._etags[context_key] = (manifest["version"], etag)
+        return manifest, etag
+
+    async def _load_chunked(self, context_key: str, keys=None):
+        # Reads the chunks of one manifest, all of them or those holding
+        # keys, so the result is consistent with the manifest's version. A
+        # chunk collected while the read was in flight means the manifest was
+        # replaced, so the read starts over with the new one.
+        for _ in range(self.max_operation_retries):
+            manifest, _ = await self._read_manifest(context_key)
+            entries = manifest["chunks"]
+            if keys is None:
+                indexes = range(len(entries))
+            else:
+                indexes = sorted({self._chunk_index(key, len(entries)) for key in keys})
+            try:
+                chunks = await self._get_chunks(context_key, [entries[index] for index in indexes])
+            except KeyError:
+                continue
+            context = {}
+            for chunk in chunks:
+                context.update(chunk)
+            if keys is not None:
+                context = {key: context[key] for key in keys if key in context}
+            return context, manifest["version"]
+        raise Exception(f"Failed to read a consistent version of {context_key}")
+
+    async def _load_fields(self, context_key: str, keys=None):
+        # Like _load_chunked, with one object per key
+        for _ in range(self.max_operation_retries):
+            manifest, _ = await self._read_manifest(context_key)
+            entries = manifest["fields"]
+            names = list(entries) if keys is None else [key for key in keys if key in entries]
+            try:
+                values = await self._get_chunks(context_key, [entries[name] for name in names])
+            except KeyError:
+                continue
+            return dict(zip(names, values)), manifest["version"]
+        raise Exception(f"Failed to read a consistent version of {context_key}")
+
+    async def _get_chunks(self, context_key: str, entries):
+        # Returns the decoded chunks or values of the given manifest entries;
+        # raises KeyError if an object no longer exists
+        bodies = await asyncio.gather(*(
+            self._get_chunk(context_key, entry) for entry in entries if entry is not None
+        ))
+        return [self.codec.decode(body) for body in bodies]
+
+    async def _get_chunk(self, context_key: str, entry: dict):
+        digest, size = entry["digest"], entry["size"]
+        body = self._chunk_cache.get(digest)
+        if body is not None:
+            return body
+        object_key = self._object_prefix(context_key) + digest
+        if size > self.range_size:
+            parts = await asyncio.gather(*(
+                self._get_range(object_key, start, min(start + self.range_size, size) - 1)
+                for start in range(0, size, self.range_size)
+            ))
+            body = None if None in parts else b''.join(parts)
+        else:
+            response = await self._get_object(object_key)
+            body = response[0] if response is not None else None
+        if body is None:
+            raise KeyError(digest)
+        self._chunk_cache[digest] = body
+        return body
+
+    async def _get_range(self, object_key: str, start: int, end: int):
+        def get():
+            try:
+                response = self.s3.get_object(Bucket=self.bucket_name, Key=object_key, Range=f"bytes={start}-{end}")
+            except self.s3.exceptions.NoSuchKey:
+                return None
+            return response['Body'].read()
+
+        async with self._requests:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, get)
+
+    async def _save_chunked(self, context_key: str, changed: dict, deleted, expected_version=None, replace=False, version=None):
+        # Rewrites the chunks holding changed or deleted keys, or all chunks
+        # with replace, and commits them by swapping the manifest with a
+        # conditional PUT. Without expected_version a concurrent swap makes
+        # the write start over from the new manifest; with it the write
+        # returns None instead. version overrides the new version.
+        for _ in range(self.max_operation_retries):
+            manifest, etag = await self._read_manifest(context_key)
+            if expected_version is not None and manifest["version"] != expected_version:
+                return None
+            if replace:
+                # Chunks that come out the same as before are not uploaded again
+                entries = list(manifest["chunks"]) if len(manifest["chunks"]) == self.chunks else [None] * self.chunks
+                contents = {index: {} for index in range(self.chunks)}
+            else:
+                entries = list(manifest["chunks"])
+                indexes = sorted({self._chunk_index(key, len(entries)) for key in [*changed, *deleted]})
+                try:
+                    chunks = await self._get_chunks(context_key, [entries[index] for index in indexes])
+                except KeyError:
+                    continue
+                loaded = iter(chunks)
+                contents = {index: next(loaded) if entries[index] is not None else {} for index in indexes}
+            for key, value in changed.items():
+                contents[self._chunk_index(key, len(entries))][key] = value
+            for key in deleted:
+                contents[self._chunk_index(key, len(entries))].pop(key, None)
+            uploads = {}
+            for index, content in contents.items():
+                if not content:
+                    entries[index] = None
+                    continue
+                body = self.codec.encode(content)
+                digest = hashlib.sha256(body).hexdigest()
+                if entries[index] is None or entries[index]["digest"] != digest:
+                    uploads[digest] = body
+                entries[index] = {"digest": digest, "size": len(body)}
+            new_version = await self._commit_manifest(context_key, {"chunks": entries}, uploads, manifest, etag, version)
+            if new_version is not None:
+                return new_version
+            if expected_version is not None:
+                return None
+        raise Exception(f"Failed to write {context_key} due to repeated concurrent writes")
+
+    async def _save_fields(self, context_key: str, changed: dict, deleted, expected_version=None, replace=False, version=None):
+        # Uploads the changed values as new objects, then commits them by
+        # swapping the version marker that lists the values of every key.
+        # Writers that lose the swap have only added objects no marker
+        # refers to, so a conflicting write never shows up partially.
+        # Arguments as for _save_chunked.
+        bodies = {key: self.codec.encode(value) for key, value in changed.items()}
+        for _ in range(self.max_operation_retries):
+            manifest, etag = await self._read_manifest(context_key)
+            if expected_version is not None and manifest["version"] != expected_version:
+                return None
+            entries = {} if replace else dict(manifest["fields"])
+            uploads = {}
+            for key, body in bodies.items():
+                digest = hashlib.sha256(body).hexdigest()
+                if key not in entries or entries[key]["digest"] != digest:
+                    uploads[digest] = body
+                entries[key] = {"digest": digest, "size": len(body)}
+            for key in deleted:
+                entries.pop(key, None)
+            new_version = await self._commit_manifest(context_key, {"fields": entries}, uploads, manifest, etag, version)
+            if new_version is not None:
+                return new_version
+            if expected_version is not None:
+                return None
+        raise Exception(f"Failed to write {context_key} due to repeated concurrent writes")
+
+    async def _save_manifest(self, context_key: str, changed: dict, deleted, **options):
+        if self.chunks:
+            return await self._save_chunked(context_key, changed, deleted, **options)
+        return await self._save_fields(context_key, changed, deleted, **options)
+
+    async def _commit_manifest(self, context_key: str, content: dict, uploads: dict, manifest: dict, etag, version=None):
+        # Uploads the new objects (digest -> body), then swaps the manifest
+        # read with etag for one with content, unless another writer swapped
+        # it first. Returns the new version, or None on a conflict.
+        await asyncio.gather(*(
+            self._call('put_object', Bucket=self.bucket_name, Key=self._object_prefix(context_key) + digest, Body=body)
+            for digest, body in uploads.items()
+        ))
+        for digest, body in uploads.items():
+            self._chunk_cache[digest] = body
+        new_version = manifest["version"] + 1 if version is None else version
+        condition = {} if version is not None else {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = await self._call(
+                'put_object',
+                Bucket=self.bucket_name,
+                Key=self._version_object_key(context_key),
+                Body=json.dumps({"version": new_version, **content}).encode('utf-8'),
+                Metadata={'version': str(new_version)},
+                **condition
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            self._etags.pop(context_key, None)
+            return None
+        self._etags[context_key] = (new_version, response['ETag'])
+        return new_version
+
+    async def collect_garbage(self, context_key: str):
+        # Deletes the chunk or value objects the manifest does not reference,
+        # once they are older than chunk_grace_period, so that readers still
+        # working from an older manifest can finish. Objects of writes that
+        # lost the manifest swap are collected the same way. An object is
+        # only deleted once two passes of this backend, more than
+        # chunk_grace_period apart, found it unreferenced, so the first pass
+        # after a start only records candidates. Returns the number of
+        # deleted objects.
+        if not self.field_level:
+            return 0
+        prefix = self._object_prefix(context_key)
+        # An object is only a candidate if neither the manifest read before
+        # the listing nor the one read after it references it
+        before, _ = await self._read_manifest(context_key)
+        objects = await self._list_object_times(prefix)
+        after, _ = await self._read_manifest(context_key)
+        referenced = self._referenced_objects(prefix, before) | self._referenced_objects(prefix, after)
+        now = time.time()
+        cutoff = now - self.chunk_grace_period
+        unreferenced = {object_key for object_key, modified in objects if object_key not in referenced and modified < cutoff}
+        seen = self._garbage_seen.get(context_key, {})
+        self._garbage_seen[context_key] = {object_key: seen.get(object_key, now) for object_key in unreferenced}
+        candidates = [object_key for object_key in unreferenced if object_key in seen and seen[object_key] <= cutoff]
+        # A writer whose new manifest refers to a candidate uploads it again
+        # first, which makes it recent again
+        modified = await asyncio.gather(*(self._last_modified(object_key) for object_key in candidates))
+        candidates = [object_key for object_key, last in zip(candidates, modified) if last is not None and last < cutoff]
+        # A writer may have uploaded and referenced a candidate since the
+        # manifest was last read
+        latest, _ = await self._read_manifest(context_key)
+        garbage = [object_key for object_key in candidates if object_key not in self._referenced_objects(prefix, latest)]
+        await self._delete_objects(garbage)
+        for object_key in garbage:
+            self._garbage_seen[context_key].pop(object_key, None)
+        return len(garbage)
+
+    def _referenced_objects(self, prefix: str, manifest: dict):
+        entries = manifest["chunks"] if self.chunks else manifest["fields"].values()
+        return {prefix + entry["digest"] for entry in entries if entry is not None}
+
+    async def _last_modified(self, object_key: str):
+        # Returns the last modified timestamp of an object, None if it does not exist
+        try:
+            response = await self._call('head_object', Bucket=self.bucket_name, Key=object_key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response['LastModified'].timestamp()
 
-    async def publish_update(self, channel: str):
+    async def _list_object_times(self, prefix: str):
+        # Returns (object key, last modified timestamp) for every object
+        def list_objects():
+            paginator = self.s3.get_paginator('list_objects_v2')
+            pages = paginator.paginate(Bucket=self.bucket_name, Prefix=prefix)
+            return [(item['Key'], item['LastModified'].timestamp()) for page in pages for item in page.get('Contents', [])]
+
+        async with self._requests:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, list_objects)
+
+    async def publish_update(self, channel: str, message: dict = None):
         if self.enable_notifications and self.notification:
-            await self.notification.publish_update(channel)
+            await self.notification.publish_update(channel, message)
 
     async def subscribe_to_updates(self, channel: str, callback):
         if self.enable_notifications and self.notification:
-            await self.notification.subscribe_to_updates(channel, callback)
+            return await self.notification.subscribe_to_updates(channel, callback)
 
     async def acquire_lock(self, key: str, lock_value: str, lock_timeout: int):
+        # The lock object is only written conditionally: IfNoneMatch when it
+        # does not exist, IfMatch on the ETag that was read when its lease has
+        # ended. Of several owners racing for it only one write succeeds. The
+        # object is kept on release so fencing tokens keep increasing.
+        response = await self._get_object(key)
+        if response is None:
+            condition, fence = {'IfNoneMatch': '*'}, 1
+        else:
+            body, metadata, etag = response
+            if body and self._lease_expiry(metadata) > time.time():
+                return False
+            condition, fence = {'IfMatch': etag}, int(metadata.get('fence', 0)) + 1
+        if not await self._put_lock(key, lock_value, lock_timeout, fence, condition):
+            return False
+        return fence
+
+    async def renew_lock(self, key: str, lock_value: str, lock_timeout: int):
+        response = await self._get_object(key)
+        if response is None or response[0].decode('utf-8') != lock_value:
+            return False
+        _, metadata, etag = response
+        return await self._put_lock(key, lock_value, lock_timeout, int(metadata.get('fence', 0)), {'IfMatch': etag})
+
+    async def release_lock(self, key: str, lock_value: str):
+        response = await self._get_object(key)
+        if response is None or response[0].decode('utf-8') != lock_value:
+            return False
+        _, metadata, etag = response
+        return await self._put_lock(key, '', 0, int(metadata.get('fence', 0)), {'IfMatch': etag})
+
+    async def _put_lock(self, key: str, lock_value: str, lock_timeout: int, fence: int, condition: dict):
         try:
-            self.s3.put_object(
+            await self._call(
+                'put_object',
                 Bucket=self.bucket_name,
                 Key=key,
-                Body=lock_value,
-                Metadata={'expire_at': (datetime.utcnow() + timedelta(milliseconds=lock_timeout)).isoformat()},
-                ConditionExpression='attribute_not_exists(lock_value)'
+                Body=lock_value.encode('utf-8'),
+                Metadata={'expire_at': str(time.time() + lock_timeout / 1000), 'fence': str(fence)},
+                **condition
             )
-            return True
-        except self.s3.exceptions.ConditionalCheckFailedException:
-            return False
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
 
-    async def release_lock(self, key: str, lock_value: str):
+    @staticmethod
+    def _lease_expiry(metadata: dict):
+        expire_at = metadata.get('expire_at', '0')
         try:
-            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
-            if response['Body'].read().decode('utf-8') == lock_value:
-                self.s3.delete_object(Bucket=self.bucket_name, Key=key)
-        except self.s3.exceptions.NoSuchKey:
-            pass
\ No newline at end of file
+            return float(expire_at)
+        except ValueError:
+            # Locks written by older versions store an ISO timestamp
+            return datetime.fromisoformat(expire_at).replace(tzinfo=timezone.utc).timestamp()
+
+    async def _check_fence(self, fence: dict):
+        # S3 cannot make the check part of the write, so a lock taken over
+        # between this check and the write goes unnoticed
+        responses = await asyncio.gather(*(self._get_object(lock_name) for lock_name in fence))
+        for lock_name, response in zip(fence, responses):
+            if response is None or int(response[1].get('fence', 0)) != fence[lock_name] or not response[0]:
+                raise LockLostError(f"Lost lock {lock_name} before writing")
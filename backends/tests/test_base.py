@@ -1,24 +1,50 @@
 import unittest
+import boto3
 from testcontainers.mongodb import MongoDbContainer
 from testcontainers.redis import RedisContainer
 from testcontainers.minio import MinioContainer
 
-class TestBase(unittest.TestCase):
+TEST_BUCKET = "test-bucket"
+
+def redis_url(container):
+    return f"redis://{container.get_container_host_ip()}:{container.get_exposed_port(6379)}"
+
+def minio_container():
+    return MinioContainer("minio/minio:latest").with_env("MINIO_ACCESS_KEY", "minioadmin").with_env("MINIO_SECRET_KEY", "minioadmin")
+
+def s3_options(container):
+    # S3Backend arguments for the MinIO container, whose test bucket is
+    # created on first use
+    config = container.get_config()
+    options = {
+        "bucket_name": TEST_BUCKET,
+        "aws_access_key_id": config["access_key"],
+        "aws_secret_access_key": config["secret_key"],
+        "region_name": "us-east-1",
+        "endpoint_url": f"http://{config['endpoint']}",
+    }
+    s3 = boto3.client("s3", **{key: value for key, value in options.items() if key != "bucket_name"})
+    if TEST_BUCKET not in [bucket["Name"] for bucket in s3.list_buckets().get("Buckets", [])]:
+        s3.create_bucket(Bucket=TEST_BUCKET)
+    return options
+
+# Backend clients are bound to the event loop they were created on, and every
+# test runs on a loop of its own, so tests create their backends in
+# asyncSetUp rather than in setUpClass
+class TestBase(unittest.IsolatedAsyncioTestCase):
     @classmethod
     def setUpClass(cls):
         cls.mongodb_container = MongoDbContainer("mongo:latest")
         cls.mongodb_container.start()
-        
+
         cls.redis_container = RedisContainer("redis:latest")
         cls.redis_container.start()
-        
-        cls.minio_container = (
-            MinioContainer("minio/minio:latest").with_env("MINIO_ACCESS_KEY", "minioadmin").with_env("MINIO_SECRET_KEY", "minioadmin")
-        )
+
+        cls.minio_container = minio_container()
         cls.minio_container.start()
 
     @classmethod
     def tearDownClass(cls):
         cls.mongodb_container.stop()
         cls.redis_container.stop()
-        cls.minio_container.stop()
\ No newline at end of file
+        cls.minio_container.stop()
@@ -0,0 +1,335 @@
+import unittest
+import asyncio
+from backends.base import LockLostError, StorageBackend
+from backends.memory_backend import InjectedFailure, MemoryBackend, MemoryBus, MemoryStore
+from common.operations import operation
+from common.watch import ABSENT
+from context import Contextd
+
+class TestMemoryBackend(unittest.TestCase):
+    def test_save_and_load(self):
+        async def run_test():
+            backend = MemoryBackend()
+            self.assertEqual(await backend.load_versioned("ctx"), ({}, 0))
+            self.assertEqual(await backend.save_keys("ctx", {"a": [1], "b": 2}, set()), 1)
+            self.assertEqual(await backend.save_keys("ctx", {"c": 3}, {"b"}), 2)
+            context, version = await backend.load_versioned("ctx")
+            self.assertEqual((context, version), ({"a": [1], "c": 3}, 2))
+            context["a"].append(2)
+            self.assertEqual(await backend.load_context("ctx"), {"a": [1], "c": 3})
+            self.assertIsNone(await backend.compare_and_save("ctx", {"a": 0}, set(), 1))
+            self.assertEqual(await backend.compare_and_save("ctx", {"a": 0}, set(), 2), 3)
+
+        asyncio.run(run_test())
+
+    def test_change_log(self):
+        async def run_test():
+            backend = MemoryBackend(change_log_length=2)
+            for value in range(3):
+                await backend.save_keys("ctx", {"a": value}, set())
+            changes = await backend.changes_since("ctx", 1)
+            self.assertEqual([message["version"] for message in changes], [2, 3])
+            self.assertEqual(changes[-1]["changed"], {"a": 2})
+            self.assertIsNone(await backend.changes_since("ctx", 0))
+
+        asyncio.run(run_test())
+
+    def test_load_keys(self):
+        async def run_test():
+            backend = MemoryBackend()
+            await backend.save_keys("ctx", {"a": 1, "b": [2], "c": 3}, set())
+            self.assertEqual(await backend.load_keys("ctx", ["a", "b", "missing"]), ({"a": 1, "b": [2]}, 1))
+            self.assertEqual(await backend.load_keys("other", ["a"]), ({}, 0))
+
+        asyncio.run(run_test())
+
+    def test_lock_lease_expires_and_fences_stale_writes(self):
+        async def run_test():
+            backend = MemoryBackend()
+            first = await backend.acquire_lock("lock", "a", 20)
+            self.assertFalse(await backend.acquire_lock("lock", "b", 20))
+            self.assertTrue(await backend.renew_lock("lock", "a", 20))
+            await asyncio.sleep(0.03)
+            second = await backend.acquire_lock("lock", "b", 1000)
+            self.assertGreater(second, first)
+            with self.assertRaises(LockLostError):
+                await backend.save_keys("ctx", {"a": 1}, set(), fence={"lock": first})
+            self.assertEqual(await backend.save_keys("ctx", {"a": 1}, set(), fence={"lock": second}), 1)
+            self.assertFalse(await backend.release_lock("lock", "a"))
+            self.assertTrue(await backend.release_lock("lock", "b"))
+
+        asyncio.run(run_test())
+
+    def test_bulk_locks_fence_bulk_writes(self):
+        async def run_test():
+            backend = MemoryBackend()
+            tokens = await backend.acquire_locks(["lock-1", "lock-2"], "a", 20)
+            self.assertEqual(set(tokens), {"lock-1", "lock-2"})
+            await asyncio.sleep(0.03)
+            await backend.acquire_lock("lock-2", "b", 1000)
+            with self.assertRaises(LockLostError):
+                await backend.save_many(
+                    {"ctx-1": ({"a": 1}, set(), None), "ctx-2": ({"b": 2}, set(), None)},
+                    {"ctx-1": {"lock-1": tokens["lock-1"]}, "ctx-2": {"lock-2": tokens["lock-2"]}}
+                )
+            self.assertEqual(await backend.load_many(["ctx-1", "ctx-2"]), {"ctx-1": ({}, 0), "ctx-2": ({}, 0)})
+
+        asyncio.run(run_test())
+
+    def test_fair_lock_serves_waiters_in_order(self):
+        async def run_test():
+            backend = MemoryBackend()
+            await backend.acquire_lock("lock", "holder", 1000)
+            self.assertFalse(await backend.acquire_lock_fair("lock", "first", 1000))
+            self.assertFalse(await backend.acquire_lock_fair("lock", "second", 1000))
+            await backend.release_lock("lock", "holder")
+            self.assertFalse(await backend.acquire_lock_fair("lock", "second", 1000))
+            self.assertTrue(await backend.acquire_lock_fair("lock", "first", 1000))
+
+        asyncio.run(run_test())
+
+    def test_injected_latency_and_failures(self):
+        async def run_test():
+            backend = MemoryBackend(latency=0.01, failure_rate=1.0)
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            with self.assertRaises(InjectedFailure):
+                await backend.save_keys("ctx", {"a": 1}, set())
+            self.assertGreaterEqual(loop.time() - started, 0.01)
+            self.assertEqual(backend.failures["save_keys"], 1)
+            backend.failure_rate = 0.0
+            self.assertEqual(await backend.get_version("ctx"), 0)
+
+        asyncio.run(run_test())
+
+    def test_atomic_operations(self):
+        async def run_test():
+            backend = MemoryBackend(change_log_length=10)
+            await backend.save_keys("ctx", {"count": 1, "other": 0}, set())
+            version, results, changed, deleted = await backend.apply_operations("ctx", [
+                operation("increment", "count", 2),
+                operation("set", "user.email", "a@example.com"),
+                operation("delete", "other"),
+            ])
+            self.assertEqual((version, results), (2, [3, None, True]))
+            self.assertEqual((changed, deleted), ({"count": 3, "user": {"email": "a@example.com"}}, {"other"}))
+            self.assertEqual((await backend.changes_since("ctx", 1))[0]["changed"], changed)
+            self.assertEqual(await backend.apply_operations("ctx", [operation("set_if_absent", "count", 0)]), (2, [False], {}, set()))
+            with self.assertRaises(TypeError):
+                await backend.apply_operations("ctx", [operation("increment", "count", 1), operation("append", "count", 1)])
+            self.assertEqual(await backend.load_versioned("ctx"), ({"count": 3, "user": {"email": "a@example.com"}}, 2))
+
+        asyncio.run(run_test())
+
+    def test_compare_and_save_fallback_for_operations(self):
+        class CasBackend(MemoryBackend):
+            apply_operations = StorageBackend.apply_operations
+
+        async def run_test():
+            backend = CasBackend(latency=0.001, jitter=0.002, seed=1)
+            outcomes = await asyncio.gather(*(
+                backend.apply_operations("ctx", [operation("increment", "count", 1)]) for _ in range(10)
+            ))
+            self.assertEqual(sorted(results[0] for _, results, _, _ in outcomes), list(range(1, 11)))
+            self.assertEqual(await backend.load_context("ctx"), {"count": 10})
+            self.assertGreater(backend.calls["compare_and_save"], 10)
+
+        asyncio.run(run_test())
+
+    def test_locked_fallback_for_operations(self):
+        class LockingBackend(MemoryBackend):
+            apply_operations = StorageBackend.apply_operations
+            compare_and_save = StorageBackend.compare_and_save
+
+        async def run_test():
+            backend = LockingBackend(latency=0.001, jitter=0.002, seed=1)
+            outcomes = await asyncio.gather(*(
+                backend.apply_operations("ctx", [operation("increment", "count", 1)]) for _ in range(10)
+            ))
+            self.assertEqual(sorted(results[0] for _, results, _, _ in outcomes), list(range(1, 11)))
+            self.assertEqual(await backend.load_context("ctx"), {"count": 10})
+            self.assertEqual(backend.calls.get("compare_and_save", 0), 0)
+            self.assertTrue(await backend.acquire_lock("ctx_lock", "other", 1000))
+
+        asyncio.run(run_test())
+
+class TestMemoryCluster(unittest.TestCase):
+    def test_instances_share_state_and_updates(self):
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus(latency=0.005)
+            first = Contextd("ctx", MemoryBackend(store, bus), lock_mode="key")
+            second = Contextd("ctx", MemoryBackend(store, bus), lock_mode="key")
+            await first.initialize()
+            await second.initialize()
+            await asyncio.gather(first.update_context("a", 1), second.update_context("b", 2))
+            await bus.join()
+            await first.wait_for_reload()
+            await second.wait_for_reload()
+            self.assertEqual(first.get_context(), {"a": 1, "b": 2})
+            self.assertEqual(second.get_context(), {"a": 1, "b": 2})
+            self.assertEqual(first.version, second.version)
+            await first.close()
+            await second.close()
+            self.assertEqual(bus.channel_count(), 0)
+
+        asyncio.run(run_test())
+
+    def test_dropped_messages_are_caught_up(self):
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus(drop_rate=1.0)
+            writer = MemoryBackend(store, bus, change_log_length=10)
+            reader = Contextd("ctx", MemoryBackend(store, bus, change_log_length=10))
+            await reader.initialize()
+            await writer.save_keys("ctx", {"a": 1}, set())
+            await bus.join()
+            self.assertEqual(bus.stats["dropped"], 1)
+            self.assertEqual(reader.get_context(), {})
+            await reader.load_context()
+            self.assertEqual(reader.get_context(), {"a": 1})
+            await reader.close()
+
+        asyncio.run(run_test())
+
+    def test_failed_save_then_full_reload(self):
+        class FailingBackend(MemoryBackend):
+            fail_saves = 0
+
+            async def save_keys(self, *args, **kwargs):
+                if self.fail_saves:
+                    self.fail_saves -= 1
+                    raise InjectedFailure("save_keys")
+                return await super().save_keys(*args, **kwargs)
+
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus()
+            backend = FailingBackend(store, bus)
+            first = Contextd("ctx", backend)
+            second = Contextd("ctx", MemoryBackend(store, bus))
+            await first.initialize()
+            await second.initialize()
+            await first.update_context("x", 1)
+            backend.fail_saves = 1
+            with self.assertRaises(InjectedFailure):
+                await first.update_context("y", 10)
+            self.assertEqual(first.get_context(), {"x": 1})
+            await bus.join()
+            # A full rewrite makes the other instance reload everything
+            second.context = {"x": 2}
+            await second.save_context()
+            await bus.join()
+            await first.wait_for_reload()
+            await first.update_context("q", 5)
+            self.assertEqual(first.get_context(), {"x": 2, "q": 5})
+            self.assertEqual(await backend.load_context("ctx"), {"x": 2, "q": 5})
+            await first.close()
+            await second.close()
+
+        asyncio.run(run_test())
+
+    def test_atomic_operations_reach_other_instances(self):
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus(latency=0.002)
+            first = Contextd("ctx", MemoryBackend(store, bus))
+            second = Contextd("ctx", MemoryBackend(store, bus))
+            await first.initialize()
+            await second.initialize()
+            await asyncio.gather(*(instance.increment("hits") for instance in (first, second) for _ in range(5)))
+            self.assertTrue(await first.set_if_absent("owner", "first"))
+            self.assertFalse(await second.set_if_absent("owner", "second"))
+            self.assertEqual(await second.append("events", {"type": "start"}), 1)
+            await second.set_path("user.profile.email", "a@example.com")
+            self.assertTrue(await first.delete("events"))
+            await bus.join()
+            expected = {"hits": 10, "owner": "first", "user": {"profile": {"email": "a@example.com"}}}
+            self.assertEqual(first.get_context(), expected)
+            self.assertEqual(second.get_context(), expected)
+            self.assertEqual(first.version, second.version)
+            self.assertEqual(store.locks, {})
+            await first.close()
+            await second.close()
+
+        asyncio.run(run_test())
+
+    def test_watchers_see_local_and_remote_changes(self):
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus(latency=0.002)
+            first = Contextd("ctx", MemoryBackend(store, bus, change_log_length=10))
+            second = Contextd("ctx", MemoryBackend(store, bus, change_log_length=10))
+            await first.initialize()
+            await second.initialize()
+            local, remote = [], []
+            first.watch("user*", local.append)
+            second.watch("user*", remote.append)
+            await first.transactional_update({"user": {"name": "a"}, "other": 1})
+            await first.update_context("user", {"name": "b"})
+            await first.increment("user_count")
+            await bus.join()
+            await second.wait_for_reload()
+            expected = [("user", ABSENT, {"name": "a"}), ("user", {"name": "a"}, {"name": "b"}), ("user_count", ABSENT, 1)]
+            self.assertEqual([(change.key, change.old, change.new) for change in local], expected)
+            self.assertEqual([(change.key, change.old, change.new) for change in remote], expected)
+            self.assertTrue(all(change.local for change in local))
+            self.assertFalse(any(change.local for change in remote))
+            await first.close()
+            await second.close()
+
+        asyncio.run(run_test())
+
+    def test_lazy_instance_fetches_and_caches_its_working_set(self):
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus(latency=0.002)
+            writer = Contextd("ctx", MemoryBackend(store, bus))
+            await writer.initialize()
+            await writer.transactional_update({f"key{index}": index for index in range(100)})
+            backend = MemoryBackend(store, bus)
+            reader = Contextd("ctx", backend, lazy=True, cache_keys=10)
+            await reader.initialize()
+            self.assertEqual((len(reader.context), reader.version), (0, 1))
+            with self.assertRaises(ValueError):
+                reader.get_context()
+            view = await reader.get_lazy_context()
+            self.assertEqual(await asyncio.gather(view.get("key1"), view.get("key1"), view.get("missing", "none")), [1, 1, "none"])
+            self.assertEqual(backend.calls["load_keys"], 2)
+            await view.prefetch([f"key{index}" for index in range(20, 30)])
+            self.assertEqual(backend.calls["load_keys"], 3)
+            self.assertEqual(len(reader.context), 10)
+            self.assertNotIn("key1", view)
+            self.assertEqual(await reader.get_many(["key25", "key29"]), {"key25": 25, "key29": 29})
+            self.assertEqual(backend.calls["load_keys"], 3)
+            await writer.transactional_update({"key25": "new", "key50": "new"}, deletions=["key29"])
+            await bus.join()
+            self.assertEqual((reader.context.get("key25"), "key29" in reader.context, "key50" in reader.context), ("new", False, False))
+            await reader.update_context("key60", 60)
+            self.assertEqual((await view.get("key60"), await view.get("key50")), (60, "new"))
+            await bus.join()
+            self.assertEqual(reader.version, writer.version)
+            stats = view.stats()
+            self.assertEqual((stats["keys"], stats["fetches"]), (10, 4))
+            with self.assertRaises(ValueError):
+                await reader.save_context()
+            await writer.close()
+            await reader.close()
+
+        asyncio.run(run_test())
+
+    def test_lazy_instance_drops_its_cache_after_missed_versions(self):
+        async def run_test():
+            store, bus = MemoryStore(), MemoryBus(latency=0.002, drop_rate=1.0)
+            writer = Contextd("ctx", MemoryBackend(store, bus), enable_notifications=False)
+            await writer.initialize()
+            await writer.transactional_update({"a": 1, "b": 2})
+            reader = Contextd("ctx", MemoryBackend(store, bus), lazy=True)
+            await reader.initialize()
+            self.assertEqual(await reader.get_many(["a", "b"]), {"a": 1, "b": 2})
+            fetch = asyncio.ensure_future(reader.get("c"))
+            await asyncio.sleep(0)
+            await writer.transactional_update({"a": 10, "c": 3})
+            await reader.load_context()
+            self.assertEqual((len(reader.context), reader.version), (0, 2))
+            self.assertEqual(await fetch, None)
+            self.assertEqual(await reader.get("a"), 10)
+            self.assertEqual(reader.cache_stats()["invalidations"], 1)
+            await writer.close()
+            await reader.close()
+
+        asyncio.run(run_test())
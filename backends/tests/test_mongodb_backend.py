@@ -1,16 +1,20 @@
 import unittest
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+from pymongo.errors import PyMongoError
 from backends.mongodb_backend import MongoDBBackend
+from backends.notifications import MongoNotification, change_stream_message
 from backends.tests.test_base import TestBase
+from common.operations import operation
 
 
 class TestMongoDBBackend(TestBase):
-    @classmethod
-    def setUpClass(cls):
-        super().setUpClass()
-        cls.backend = MongoDBBackend(
-            mongo_uri=cls.mongodb_container.get_connection_url(),
+    async def asyncSetUp(self):
+        self.backend = MongoDBBackend(
+            mongo_uri=self.mongodb_container.get_connection_url(),
             db_name="test_db"
         )
+        self.addCleanup(self.backend.client.close)
 
     async def test_save_and_load_context(self):
         context_key = "test_key"
@@ -19,5 +23,148 @@ class TestMongoDBBackend(TestBase):
         loaded_context = await self.backend.load_context(context_key)
         self.assertEqual(context_data, loaded_context)
 
+    async def test_save_keys(self):
+        context_key = "test_fields"
+        await self.backend.save_context(context_key, {"a": 1, "b": 2})
+        await self.backend.save_keys(context_key, {"c": 3, "d.e": 4}, {"a"}, {"b": 2, "c": 3, "d.e": 4})
+        loaded_context = await self.backend.load_context(context_key)
+        self.assertEqual({"b": 2, "c": 3, "d.e": 4}, loaded_context)
+
+    async def test_unaddressable_keys_keep_concurrent_writes(self):
+        # Without the full context the rewrite must not drop keys other
+        # writers, such as ones holding other key locks, saved meanwhile
+        context_key = "test_unaddressable"
+        await self.backend.save_context(context_key, {"a": 1})
+        await asyncio.gather(*(
+            self.backend.save_keys(context_key, {f"key.{index}" if index % 2 else f"key{index}": index}, set())
+            for index in range(10)
+        ))
+        loaded_context = await self.backend.load_context(context_key)
+        self.assertEqual({"a": 1, **{f"key.{index}" if index % 2 else f"key{index}": index for index in range(10)}}, loaded_context)
+
+    async def test_load_keys(self):
+        context_key = "test_load_keys"
+        version = await self.backend.save_context(context_key, {"a": 1, "b": {"nested": True}, "c.d": 3})
+        self.assertEqual(({"a": 1}, version), await self.backend.load_keys(context_key, ["a", "missing"]))
+        # Keys that cannot be projected fall back to a full read
+        self.assertEqual(({"c.d": 3}, version), await self.backend.load_keys(context_key, ["c.d"]))
+
+    async def test_compare_and_save_rejects_stale_version(self):
+        context_key = "test_cas"
+        version = await self.backend.save_context(context_key, {"key": "value"})
+        new_version = await self.backend.compare_and_save(context_key, {"key": "v2"}, set(), version)
+        self.assertEqual(new_version, version + 1)
+        conflict = await self.backend.compare_and_save(context_key, {"key": "v3"}, set(), version)
+        self.assertIsNone(conflict)
+        self.assertEqual({"key": "v2"}, await self.backend.load_context(context_key))
+
+    async def test_atomic_operations(self):
+        context_key = "test_atomic"
+        version = await self.backend.save_context(context_key, {"count": 1, "owner": "a"})
+        new_version, results, changed, deleted = await self.backend.apply_operations(context_key, [
+            operation("increment", "count", 2),
+            operation("merge", "user", {"name": "a"}),
+            operation("set_if_absent", "owner", "b"),
+            operation("delete", "owner"),
+        ])
+        self.assertEqual((new_version, results), (version + 1, [3, {"name": "a"}, False, True]))
+        self.assertEqual((changed, deleted), ({"count": 3, "user": {"name": "a"}}, {"owner"}))
+        self.assertNotIn("op_results", await self.backend.db.contexts.find_one({"context_key": context_key}))
+        unchanged = await self.backend.apply_operations(context_key, [operation("delete", "missing")])
+        self.assertEqual(unchanged, (new_version, [False], {}, set()))
+        with self.assertRaises(TypeError):
+            await self.backend.apply_operations(context_key, [operation("append", "count", 1)])
+
+class TestMongoNotification(unittest.TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.db = self.client["test_db"]
+        self.db.contexts.find_one = AsyncMock(return_value={"_id": "doc-1"})
+        self.notification = MongoNotification(None, "test_db", client=self.client)
+        self.notification._watch = AsyncMock()
+
+    def test_update_description_becomes_delta(self):
+        message = change_stream_message({
+            "updatedFields": {"context.a": 1, "version": 7, "write_id": "x"},
+            "removedFields": ["context.b"]
+        })
+        self.assertEqual(message, {"version": 7, "changed": {"a": 1}, "deleted": ["b"]})
+
+    def test_nested_or_full_updates_need_reload(self):
+        self.assertEqual(change_stream_message({"updatedFields": {"context.a.b": 1, "version": 3}}), {"version": 3})
+        self.assertEqual(change_stream_message({"updatedFields": {"context": {}, "version": 3}}), {"version": 3})
+        self.assertIsNone(change_stream_message({"updatedFields": {"context.a": 1}}))
+
+    def test_stream_is_filtered_to_subscribed_contexts(self):
+        async def run_test():
+            await self.notification.subscribe_to_updates("tenant-1", AsyncMock())
+            match = self.notification._pipeline()[0]["$match"]["$or"]
+            self.assertEqual(match[0]["fullDocument.context_key"], {"$in": ["tenant-1"]})
+            self.assertEqual(match[1]["documentKey._id"], {"$in": ["doc-1"]})
+
+        asyncio.run(run_test())
+
+    def test_changes_are_dispatched_by_document(self):
+        async def run_test():
+            first, second = AsyncMock(), AsyncMock()
+            await self.notification.subscribe_to_updates("tenant-1", first)
+            self.db.contexts.find_one.return_value = None
+            await self.notification.subscribe_to_updates("tenant-2", second)
+            self.notification._stale.clear()
+            await self.notification._dispatch({
+                "operationType": "update",
+                "documentKey": {"_id": "doc-1"},
+                "updateDescription": {"updatedFields": {"context.a": 1, "version": 2}, "removedFields": []}
+            })
+            first.assert_awaited_once_with({"version": 2, "changed": {"a": 1}, "deleted": []})
+            await self.notification._dispatch({
+                "operationType": "insert",
+                "documentKey": {"_id": "doc-2"},
+                "fullDocument": {"_id": "doc-2", "context_key": "tenant-2", "context": {}, "version": 1}
+            })
+            second.assert_awaited_once_with({"version": 1})
+            self.assertTrue(self.notification._stale.is_set())
+            self.assertEqual(self.notification._document_ids["doc-2"], "tenant-2")
+
+        asyncio.run(run_test())
+
+    def test_failing_stream_restarts_with_backoff(self):
+        async def run_test():
+            notification = MongoNotification(None, "test_db", client=self.client)
+            notification._handlers["tenant-1"] = [Mock()]
+            stream = MagicMock()
+            stream.try_next = AsyncMock(side_effect=[None, PyMongoError("stream lost")])
+            stream.resume_token = None
+            watch = MagicMock()
+            watch.__aenter__.return_value = stream
+            self.db.contexts.watch = Mock(side_effect=[PyMongoError("down")] * 8 + [watch] + [PyMongoError("down")] * 2)
+            delays = []
+
+            async def sleep(delay):
+                delays.append(delay)
+                if len(delays) == 11:
+                    notification._handlers.clear()
+
+            with patch("backends.notifications.asyncio.sleep", sleep):
+                await notification._watch()
+            # A change read from the stream resets the backoff
+            self.assertEqual(delays, [0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 5.0, 5.0, 0.1, 0.2])
+
+        asyncio.run(run_test())
+
+    def test_removing_operation_results_is_not_dispatched(self):
+        async def run_test():
+            callback = AsyncMock()
+            await self.notification.subscribe_to_updates("tenant-1", callback)
+            await self.notification._dispatch({
+                "operationType": "update",
+                "documentKey": {"_id": "doc-1"},
+                "updateDescription": {"updatedFields": {}, "removedFields": ["op_results"]}
+            })
+            callback.assert_not_awaited()
+            self.assertIsNone(change_stream_message({"updatedFields": {"context.a": 1}, "removedFields": ["op_results"]}))
+
+        asyncio.run(run_test())
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,22 +1,37 @@
 import unittest
 import asyncio
+import fakeredis
+from fakeredis._clients._async import FakeAsyncRedisConnection
+from redis.asyncio import BlockingConnectionPool
+from redis.exceptions import ConnectionError as RedisConnectionError
 from testcontainers.redis import RedisContainer
+from backends.base import LockLostError
 from backends.redis_backend import RedisBackend
+from backends.tests.test_base import redis_url
+from common.codec import Codec
+from common.operations import operation
 
-class TestRedisBackend(unittest.TestCase):
+class TestRedisBackend(unittest.IsolatedAsyncioTestCase):
     @classmethod
     def setUpClass(cls):
         cls.redis_container = RedisContainer()
         cls.redis_container.start()
-        cls.backend = RedisBackend(
-            redis_url=cls.redis_container.get_client(),
-            enable_notifications=False  # Disable notifications for testing
-        )
 
     @classmethod
     def tearDownClass(cls):
         cls.redis_container.stop()
 
+    async def asyncSetUp(self):
+        # Clients are bound to the event loop they were created on, and every
+        # test runs on a loop of its own
+        self.backend = await self.create_backend()
+
+    async def create_backend(self, **options):
+        options = {"enable_notifications": False, **options}  # Disable notifications for testing
+        backend = await RedisBackend.create(redis_url(self.redis_container), **options)
+        self.addAsyncCleanup(backend.close)
+        return backend
+
     async def test_save_and_load_context(self):
         context_key = "test_key"
         context_data = {"key": "value"}
@@ -24,6 +39,101 @@ class TestRedisBackend(unittest.TestCase):
         loaded_context = await self.backend.load_context(context_key)
         self.assertEqual(context_data, loaded_context)
 
+    async def test_versions_increase_on_save(self):
+        context_key = "test_versioned"
+        first_version = await self.backend.save_context(context_key, {"key": "value"})
+        second_version = await self.backend.save_keys(context_key, {"key": "value2"}, set())
+        self.assertEqual(second_version, first_version + 1)
+        self.assertEqual(second_version, await self.backend.get_version(context_key))
+        context, version = await self.backend.load_versioned(context_key)
+        self.assertEqual(({"key": "value2"}, second_version), (context, version))
+
+    async def test_compare_and_save_rejects_stale_version(self):
+        context_key = "test_cas"
+        version = await self.backend.save_context(context_key, {"key": "value"})
+        new_version = await self.backend.compare_and_save(context_key, {"key": "v2"}, set(), version, {"key": "v2"})
+        self.assertEqual(new_version, version + 1)
+        conflict = await self.backend.compare_and_save(context_key, {"key": "v3"}, set(), version, {"key": "v3"})
+        self.assertIsNone(conflict)
+        self.assertEqual({"key": "v2"}, await self.backend.load_context(context_key))
+
+    async def test_field_level_save_keys(self):
+        backend = await self.create_backend(field_level=True)
+        context_key = "test_fields"
+        await backend.save_context(context_key, {"a": 1, "b": {"nested": True}})
+        await backend.save_keys(context_key, {"c": [1, 2]}, {"a"})
+        loaded_context = await backend.load_context(context_key)
+        self.assertEqual({"b": {"nested": True}, "c": [1, 2]}, loaded_context)
+
+    async def test_field_level_load_keys(self):
+        backend = await self.create_backend(field_level=True)
+        context_key = "test_load_keys"
+        version = await backend.save_context(context_key, {"a": 1, "b": {"nested": True}, "c": 3})
+        values, loaded_version = await backend.load_keys(context_key, ["a", "b", "missing"])
+        self.assertEqual(({"a": 1, "b": {"nested": True}}, version), (values, loaded_version))
+
+    async def test_field_level_atomic_operations(self):
+        backend = await self.create_backend(field_level=True)
+        context_key = "test_atomic"
+        version = await backend.save_context(context_key, {"count": 1, "user": {"name": "a"}, "price": 1.5})
+        new_version, results, changed, deleted = await backend.apply_operations(context_key, [
+            operation("increment", "count", 2),
+            operation("set", "user.email", "a@example.com"),
+            operation("append", "log", "x"),
+            operation("delete", "price"),
+        ])
+        self.assertEqual((new_version, results), (version + 1, [3, None, 1, True]))
+        self.assertEqual(changed, {"count": 3, "user": {"name": "a", "email": "a@example.com"}, "log": ["x"]})
+        self.assertEqual(deleted, {"price"})
+        with self.assertRaises(TypeError):
+            await backend.apply_operations(context_key, [operation("increment", "log", 1)])
+        # Empty lists cannot be decoded unambiguously by cjson, so this takes the compare-and-save path
+        await backend.save_keys(context_key, {"items": []}, set())
+        _, results, _, _ = await backend.apply_operations(context_key, [operation("append", "items", 1)])
+        self.assertEqual(results, [1])
+        self.assertEqual([1], (await backend.load_context(context_key))["items"])
+
+    async def test_load_and_save_many(self):
+        versions = await self.backend.save_many({
+            "test_bulk_1": ({"a": 1}, set(), {"a": 1}),
+            "test_bulk_2": ({"b": 2}, set(), {"b": 2})
+        })
+        loaded = await self.backend.load_many(["test_bulk_1", "test_bulk_2", "test_bulk_missing"])
+        self.assertEqual(({"a": 1}, versions["test_bulk_1"]), loaded["test_bulk_1"])
+        self.assertEqual(({"b": 2}, versions["test_bulk_2"]), loaded["test_bulk_2"])
+        self.assertEqual(({}, 0), loaded["test_bulk_missing"])
+
+    async def test_acquire_locks_takes_all_or_none(self):
+        await self.backend.acquire_lock("test_bulk_lock_2", "other", 10000)
+        self.assertFalse(await self.backend.acquire_locks(["test_bulk_lock_1", "test_bulk_lock_2"], "value", 10000))
+        self.assertTrue(await self.backend.acquire_lock("test_bulk_lock_1", "other", 10000))
+
+    async def test_bulk_locks_fence_bulk_writes(self):
+        backend = await self.create_backend(field_level=True)
+        tokens = await backend.acquire_locks(["test_bulk_fence_1", "test_bulk_fence_2"], "owner", 10000)
+        fences = {"test_bulk_fenced": {"test_bulk_fence_1": tokens["test_bulk_fence_1"]}}
+        await backend.save_many({"test_bulk_fenced": ({"a": 1}, set(), None)}, fences)
+        await backend.release_locks(["test_bulk_fence_1", "test_bulk_fence_2"], "owner")
+        self.assertGreater(await backend.acquire_lock("test_bulk_fence_1", "other", 10000), tokens["test_bulk_fence_1"])
+        with self.assertRaises(LockLostError):
+            await backend.save_many({"test_bulk_fenced": ({"a": 2}, set(), None)}, fences)
+        self.assertEqual({"a": 1}, await backend.load_context("test_bulk_fenced"))
+
+    async def test_changes_since_replays_change_log(self):
+        backend = await self.create_backend(field_level=True, change_log_length=2)
+        context_key = "test_change_log"
+        version = await backend.save_context(context_key, {"a": 1})
+        await backend.save_keys(context_key, {"b": 2}, {"a"})
+        await backend.save_keys(context_key, {"c": 3}, set())
+        self.assertEqual([
+            {"version": version + 1, "changed": {"b": 2}, "deleted": ["a"]},
+            {"version": version + 2, "changed": {"c": 3}, "deleted": []}
+        ], await backend.changes_since(context_key, version))
+        await backend.compact_change_log(context_key)
+        await backend.save_keys(context_key, {"d": 4}, set())
+        await backend.compact_change_log(context_key)
+        self.assertIsNone(await backend.changes_since(context_key, version))
+
     async def test_acquire_and_release_lock(self):
         lock_key = "test_lock"
         lock_value = "test_value"
@@ -41,12 +151,114 @@ class TestRedisBackend(unittest.TestCase):
         channel = "test_channel"
         update_received = asyncio.Event()
 
-        async def callback():
+        async def callback(message):
             update_received.set()
 
-        await self.backend.subscribe_to_updates(channel, callback)
-        await self.backend.publish_update(channel)
+        backend = await self.create_backend(enable_notifications=True)
+        await backend.subscribe_to_updates(channel, callback)
+        await backend.publish_update(channel)
         await asyncio.wait_for(update_received.wait(), timeout=5.0)
 
+class CountingConnection(FakeAsyncRedisConnection):
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        CountingConnection.created += 1
+
+class TestRedisBackendScripts(unittest.IsolatedAsyncioTestCase):
+    # Runs the Lua scripts and the reply parsing against an in-process Redis
+    async def asyncSetUp(self):
+        self.client = fakeredis.FakeAsyncRedis()
+        self.backend = RedisBackend("localhost", field_level=True, change_log_length=10, client=self.client)
+        await self.backend.connect()
+
+    async def asyncTearDown(self):
+        await self.backend.close()
+
+    async def test_pool_bounds_connections(self):
+        server = fakeredis.FakeServer()
+        CountingConnection.created = 0
+        backend = await RedisBackend.create(
+            "localhost",
+            enable_notifications=False,
+            field_level=True,
+            pool_size=2,
+            client_options={"connection_class": CountingConnection, "server": server}
+        )
+        pool = backend.redis.connection_pool
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        versions = await asyncio.gather(*(backend.save_keys("test_pool", {f"key{index}": index}, set()) for index in range(20)))
+        self.assertEqual(list(range(1, 21)), sorted(versions))
+        self.assertLessEqual(CountingConnection.created, 3)
+        self.assertEqual(20, len(await backend.load_context("test_pool")))
+        await backend.close()
+
+    async def test_create_fails_fast_on_unreachable_server(self):
+        with self.assertRaises(RedisConnectionError):
+            await RedisBackend.create("redis://127.0.0.1:1", enable_notifications=False)
+
+    async def test_binary_codec_round_trips(self):
+        codec = Codec("msgpack", compression="zlib", compress_threshold=0)
+        for field_level in (False, True):
+            with self.subTest(field_level=field_level):
+                backend = RedisBackend("localhost", field_level=field_level, codec=codec, client=self.client)
+                context_key = f"test_binary_{field_level}"
+                context = {"text": "caf\u00e9", "data": list(range(50)), "none": None}
+                version = await backend.save_context(context_key, context)
+                self.assertEqual((context, version), await backend.load_versioned(context_key))
+                self.assertEqual({context_key: (context, version)}, await backend.load_many([context_key]))
+
+    async def test_field_level_keys_and_change_log(self):
+        context_key = "test_fields"
+        version = await self.backend.save_context(context_key, {"a": 1, "b": None})
+        await self.backend.save_keys(context_key, {"c": [1, 2]}, {"a"})
+        self.assertEqual(({"b": None, "c": [1, 2]}, version + 1), await self.backend.load_versioned(context_key))
+        self.assertEqual(({"b": None}, version + 1), await self.backend.load_keys(context_key, ["a", "b"]))
+        self.assertEqual(
+            [{"version": version + 1, "changed": {"c": [1, 2]}, "deleted": ["a"]}],
+            await self.backend.changes_since(context_key, version)
+        )
+        await self.backend.compact_change_log(context_key)
+        self.assertIsNone(await self.backend.compare_and_save(context_key, {"d": 4}, set(), version))
+        self.assertEqual(version + 2, await self.backend.compare_and_save(context_key, {"d": 4}, set(), version + 1))
+
+    async def test_atomic_operations(self):
+        context_key = "test_atomic"
+        version = await self.backend.save_context(context_key, {"count": 1, "items": []})
+        self.assertEqual(
+            (version + 1, [3], {"count": 3}, set()),
+            await self.backend.apply_operations(context_key, [operation("increment", "count", 2)])
+        )
+        # Empty lists take the compare-and-save fallback
+        _, results, _, _ = await self.backend.apply_operations(context_key, [operation("append", "items", 1)])
+        self.assertEqual([1], results)
+        with self.assertRaises(TypeError):
+            await self.backend.apply_operations(context_key, [operation("increment", "items", 1)])
+
+    async def test_locks_and_fences(self):
+        token = await self.backend.acquire_lock("test_lock", "owner", 10000)
+        self.assertTrue(token)
+        self.assertFalse(await self.backend.acquire_lock("test_lock", "other", 10000))
+        self.assertTrue(await self.backend.renew_lock("test_lock", "owner", 10000))
+        await self.backend.save_keys("test_fenced", {"a": 1}, set(), fence={"test_lock": token})
+        self.assertEqual(1, await self.backend.release_lock("test_lock", "owner"))
+        self.assertTrue(await self.backend.acquire_lock_fair("test_lock", "other", 10000))
+        with self.assertRaises(LockLostError):
+            await self.backend.save_keys("test_fenced", {"a": 2}, set(), fence={"test_lock": token})
+        self.assertTrue(await self.backend.acquire_locks(["test_lock_1", "test_lock_2"], "owner", 10000))
+        self.assertEqual(2, await self.backend.release_locks(["test_lock_1", "test_lock_2"], "owner"))
+
+    async def test_publish_and_subscribe_updates(self):
+        received = asyncio.Queue()
+
+        async def callback(message):
+            await received.put(message)
+
+        await self.backend.subscribe_to_updates("test_channel", callback)
+        version = await self.backend.save_keys("test_channel", {"a": 1}, set())
+        message = await asyncio.wait_for(received.get(), timeout=5.0)
+        self.assertEqual((version, {"a": 1}), (message["version"], message["changed"]))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,26 +1,31 @@
 import unittest
 import asyncio
-from testcontainers.minio import MinioContainer
+from testcontainers.redis import RedisContainer
 from backends.s3_backend import S3Backend
+from backends.tests.test_base import minio_container, redis_url, s3_options
 
-class TestS3Backend(unittest.TestCase):
+class TestS3Backend(unittest.IsolatedAsyncioTestCase):
     @classmethod
     def setUpClass(cls):
-        cls.minio_container = (
-            MinioContainer("minio/minio:latest").with_env("MINIO_ACCESS_KEY", "minioadmin").with_env("MINIO_SECRET_KEY", "minioadmin")
-        )
+        cls.minio_container = minio_container()
         cls.minio_container.start()
-        cls.minio_container_config = cls.minio_container.get_config()
-        cls.backend = S3Backend(
-            bucket_name="test_bucket",
-            aws_access_key_id=cls.minio_container_config["access_key"],
-            aws_secret_access_key=cls.minio_container_config["secret_key"],
-            region_name="us-east-1"
-        )
+        # Notifications go through Redis
+        cls.redis_container = RedisContainer()
+        cls.redis_container.start()
+        cls.s3_options = s3_options(cls.minio_container)
 
     @classmethod
     def tearDownClass(cls):
         cls.minio_container.stop()
+        cls.redis_container.stop()
+
+    async def asyncSetUp(self):
+        self.backend = self.create_backend(redis_url=redis_url(self.redis_container))
+
+    def create_backend(self, **options):
+        backend = S3Backend(**self.s3_options, **options)
+        self.addAsyncCleanup(backend.close)
+        return backend
 
     async def test_save_and_load_context(self):
         context_key = "test_key"
@@ -29,6 +34,87 @@ class TestS3Backend(unittest.TestCase):
         loaded_context = await self.backend.load_context(context_key)
         self.assertEqual(context_data, loaded_context)
 
+    async def test_field_level_save_keys(self):
+        backend = self.create_backend(field_level=True)
+        context_key = "test_fields"
+        await backend.save_context(context_key, {"a": 1, "b/c": 2})
+        await backend.save_keys(context_key, {"d": 3, "e": None}, {"a"})
+        loaded_context = await backend.load_context(context_key)
+        self.assertEqual({"b/c": 2, "d": 3, "e": None}, loaded_context)
+        values, _ = await backend.load_keys(context_key, ["a", "e"])
+        self.assertEqual({"e": None}, values)
+
+    async def test_field_level_conflicting_write_leaves_no_trace(self):
+        def field_backend():
+            return self.create_backend(field_level=True)
+
+        writer, loser = field_backend(), field_backend()
+        context_key = "test_fields_cas"
+        version = await writer.save_context(context_key, {"a": 1, "b": 2})
+        self.assertEqual(version + 1, await writer.compare_and_save(context_key, {"a": 10}, set(), version))
+        self.assertIsNone(await loser.compare_and_save(context_key, {"b": 20, "c": 3}, {"a"}, version))
+        self.assertEqual(({"a": 10, "b": 2}, version + 1), await field_backend().load_versioned(context_key))
+
+    async def test_chunked_layout_rewrites_only_changed_chunks(self):
+        def chunked_backend(**options):
+            return self.create_backend(chunks=8, chunk_grace_period=0, **options)
+
+        backend = chunked_backend()
+        context_key = "test_chunked"
+        context = {f"key{index}": index for index in range(100)}
+        version = await backend.save_context(context_key, context)
+        manifest, _ = await backend._read_manifest(context_key)
+        version = await backend.save_keys(context_key, {"key1": "changed"}, {"key2"})
+        new_manifest, _ = await backend._read_manifest(context_key)
+        rewritten = [old != new for old, new in zip(manifest["chunks"], new_manifest["chunks"])]
+        self.assertLessEqual(sum(rewritten), 2)
+        context["key1"] = "changed"
+        del context["key2"]
+        reader = chunked_backend(range_size=16)
+        self.assertEqual((context, version), await reader.load_versioned(context_key))
+        self.assertEqual(({"key1": "changed"}, version), await reader.load_keys(context_key, ["key1", "key2"]))
+        self.assertIsNone(await reader.compare_and_save(context_key, {"key3": 0}, set(), version - 1))
+        # The first pass only records the unreferenced chunks
+        self.assertEqual(0, await backend.collect_garbage(context_key))
+        self.assertEqual(sum(rewritten), await backend.collect_garbage(context_key))
+        self.assertEqual((context, version), await reader.load_versioned(context_key))
+
+    async def test_garbage_collection_keeps_values_referenced_again(self):
+        backend = self.create_backend(field_level=True, chunk_grace_period=0)
+        writer = self.create_backend(field_level=True)
+        context_key = "test_fields_gc"
+        await backend.save_context(context_key, {"a": 1})
+        await backend.save_keys(context_key, {"a": 2}, set())
+        self.assertEqual(0, await backend.collect_garbage(context_key))
+        last_modified = backend._last_modified
+
+        async def reference_again(object_key):
+            # Another writer sets the old value again while the candidate is checked
+            modified = await last_modified(object_key)
+            await writer.save_keys(context_key, {"a": 1}, set())
+            return modified
+
+        backend._last_modified = reference_again
+        self.assertEqual(0, await backend.collect_garbage(context_key))
+        self.assertEqual({"a": 1}, await self.create_backend(field_level=True).load_context(context_key))
+
+    async def test_requests_do_not_block_event_loop(self):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(ticker())
+        try:
+            await self.backend.save_context("test_nonblocking", {"key": "value"})
+            await self.backend.load_context("test_nonblocking")
+        finally:
+            task.cancel()
+        self.assertGreater(ticks, 2)
+
     async def test_publish_update(self):
         channel = "test_channel"
         await self.backend.publish_update(channel)
@@ -38,7 +124,7 @@ class TestS3Backend(unittest.TestCase):
         channel = "test_channel"
         update_received = asyncio.Event()
 
-        async def callback():
+        async def callback(message):
             update_received.set()
 
         await self.backend.subscribe_to_updates(channel, callback)
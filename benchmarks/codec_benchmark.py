@@ -0,0 +1,85 @@
+"""Compares encode/decode time and payload size of the available codecs.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_benchmark --keys 100 1000 10000 --json results.json
+"""
+import argparse
+import json
+import random
+import string
+import timeit
+
+from common.codec import Codec, msgpack, orjson, zstandard
+
+def build_context(keys: int, seed: int = 0):
+    # Mix of the value shapes contexts usually hold: small records, lists,
+    # strings and numbers
+    rng = random.Random(seed)
+
+    def word():
+        return ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 12)))
+
+    context = {}
+    for i in range(keys):
+        kind = i % 4
+        if kind == 0:
+            value = {"name": word(), "email": f"{word()}@example.com", "active": rng.random() > 0.5}
+        elif kind == 1:
+            value = [rng.randint(0, 10000) for _ in range(rng.randint(1, 20))]
+        elif kind == 2:
+            value = ' '.join(word() for _ in range(rng.randint(1, 30)))
+        else:
+            value = rng.random() * 1000
+        context[f"key_{i}"] = value
+    return context
+
+def available_codecs():
+    codecs = [Codec("json"), Codec("json", "zlib")]
+    if orjson is not None:
+        codecs += [Codec("orjson"), Codec("orjson", "zlib")]
+    if msgpack is not None:
+        codecs += [Codec("msgpack"), Codec("msgpack", "zlib")]
+    if zstandard is not None:
+        codecs += [Codec("json", "zstd")]
+        if orjson is not None:
+            codecs.append(Codec("orjson", "zstd"))
+        if msgpack is not None:
+            codecs.append(Codec("msgpack", "zstd"))
+    return codecs
+
+def measure(codec: Codec, context: dict, repeat: int):
+    encoded = codec.encode(context)
+    assert codec.decode(encoded) == context
+    encode_time = min(timeit.repeat(lambda: codec.encode(context), number=1, repeat=repeat))
+    decode_time = min(timeit.repeat(lambda: codec.decode(encoded), number=1, repeat=repeat))
+    return {
+        "codec": codec.name,
+        "keys": len(context),
+        "bytes": len(encoded),
+        "encode_ms": encode_time * 1000,
+        "decode_ms": decode_time * 1000,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, nargs="+", default=[100, 1000, 10000], help="Context sizes in keys")
+    parser.add_argument("--repeat", type=int, default=20, help="Repetitions per measurement, the fastest is reported")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for keys in args.keys:
+        context = build_context(keys)
+        for codec in available_codecs():
+            results.append(measure(codec, context, args.repeat))
+
+    print(f"{'codec':<16}{'keys':>8}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    for result in results:
+        print(f"{result['codec']:<16}{result['keys']:>8}{result['bytes']:>12}{result['encode_ms']:>12.3f}{result['decode_ms']:>12.3f}")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
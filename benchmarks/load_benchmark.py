@@ -0,0 +1,244 @@
+"""Measures Contextd update throughput and latency under concurrent writers.
+
+Every run starts `--instances` Contextd instances on one context, each with
+`--writers` concurrent writers calling update_context, and reports update
+throughput, p50/p99 update latency, lock wait, notification propagation delay
+and payload bytes. Runs cover every combination of backend, context size and
+number of hot keys (fewer hot keys means more contention). Run from the
+repository root:
+
+    python -m benchmarks.load_benchmark --backends memory redis --keys 100 10000 --hot-keys 1 64 --json results.json
+
+and compare with an earlier run, e.g. from the previous commit:
+
+    python -m benchmarks.load_benchmark --backends memory redis --keys 100 10000 --hot-keys 1 64 --compare results.json
+
+The memory backend needs no servers; `--latency` and `--jitter` make it
+behave like a networked one. S3 runs use the standard AWS environment
+variables, so MinIO can be targeted with AWS_ENDPOINT_URL.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from benchmarks.codec_benchmark import build_context
+from backends.instrumented_backend import InstrumentedBackend
+from common.lock_wait import ExponentialBackoff
+from common.metrics import Metrics, Observer
+from context import Contextd
+
+class Recorder(Observer):
+    # Collects what Contextd and InstrumentedBackend report through their
+    # metrics hooks (see common.metrics) for all instances of one run. Times
+    # are in seconds. Payload sizes are those of the encoded values, not the
+    # bytes on the wire including protocol overhead.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.update_latency = []
+        self.lock_wait = []
+        self.propagation = []
+        self.bytes = Counter()
+        self.calls = Counter()
+        self.errors = Counter()
+
+    def timing(self, name: str, seconds: float, labels: dict):
+        if name == "contextd_backend_seconds":
+            self.calls[labels["operation"]] += 1
+        elif name == "contextd_lock_wait_seconds" and labels["acquired"] == "true":
+            self.lock_wait.append(seconds)
+        elif name == "contextd_notification_lag_seconds":
+            self.propagation.append(seconds)
+
+    def value(self, name: str, value: float, labels: dict):
+        if name == "contextd_payload_bytes":
+            self.bytes["written" if labels["direction"] == "encode" else "read"] += value
+
+def percentiles(samples):
+    # Milliseconds; None when nothing was measured
+    if not samples:
+        return {"p50": None, "p99": None, "mean": None}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {"p50": at(0.5), "p99": at(0.99), "mean": round(sum(ordered) / len(ordered) * 1000, 3)}
+
+def backend_factory(name: str, args):
+    # Returns a function creating one backend per instance. Server backends
+    # are imported here so that memory runs work without their drivers.
+    if name == "memory":
+        from backends.memory_backend import MemoryBackend, MemoryBus, MemoryStore
+        store, bus = MemoryStore(), MemoryBus(latency=args.latency, jitter=args.jitter)
+        return lambda: MemoryBackend(store, bus, latency=args.latency, jitter=args.jitter)
+    if name == "redis":
+        from backends.redis_backend import RedisBackend
+        return lambda: RedisBackend(args.redis_url, field_level=args.field_level)
+    if name == "mongo":
+        from backends.mongodb_backend import MongoDBBackend
+        return lambda: MongoDBBackend(args.mongo_uri, args.mongo_db)
+    if name == "s3":
+        from backends.s3_backend import S3Backend
+        return lambda: S3Backend(
+            args.s3_bucket, None, None, args.s3_region,
+            redis_url=args.redis_url, field_level=args.field_level
+        )
+    raise ValueError(f"Unknown backend: {name}")
+
+async def run(backend: str, keys: int, hot_keys: int, args):
+    recorder = Recorder()
+    metrics = Metrics(recorder)
+    factory = backend_factory(backend, args)
+    backends = [InstrumentedBackend(factory(), metrics) for _ in range(args.instances)]
+    context_key = f"benchmark:{uuid.uuid4().hex}"
+    await backends[0].save_context(context_key, build_context(keys, args.seed))
+    instances = [
+        Contextd(
+            context_key,
+            backend,
+            lock_mode=args.lock_mode,
+            write_mode=args.write_mode,
+            lock_wait=ExponentialBackoff(base_delay=0.001, max_delay=0.05, deadline=30.0),
+            lock_wakeups=args.lock_wakeups,
+            max_write_retries=1000,
+            group_commit=args.group_commit,
+            commit_window=args.commit_window,
+            metrics=metrics
+        )
+        for backend in backends
+    ]
+    await asyncio.gather(*(contextd.initialize() for contextd in instances))
+    recorder.reset()
+
+    async def write(contextd: Contextd, rng: random.Random):
+        for _ in range(args.updates):
+            started = time.perf_counter()
+            try:
+                await contextd.update_context(f"key_{rng.randrange(min(hot_keys, keys))}", rng.random())
+            except Exception as error:
+                recorder.errors[type(error).__name__] += 1
+                continue
+            recorder.update_latency.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        write(contextd, random.Random(f"{args.seed}-{instance}-{writer}"))
+        for instance, contextd in enumerate(instances)
+        for writer in range(args.writers)
+    ))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(args.settle)  # Let the last notifications arrive
+
+    for contextd in instances:
+        await contextd.close()
+    for instrumented in backends:
+        close = getattr(instrumented.backend, "close", None)
+        if close is not None:
+            await close()
+
+    return {
+        "backend": backend,
+        "instances": args.instances,
+        "writers": args.writers,
+        "keys": keys,
+        "hot_keys": hot_keys,
+        "lock_mode": args.lock_mode,
+        "write_mode": args.write_mode,
+        "group_commit": args.group_commit,
+        "updates": len(recorder.update_latency),
+        "errors": dict(recorder.errors),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(recorder.update_latency) / elapsed, 1),
+        "update_ms": percentiles(recorder.update_latency),
+        "lock_wait_ms": percentiles(recorder.lock_wait),
+        "propagation_ms": percentiles(recorder.propagation),
+        "bytes": dict(recorder.bytes),
+        "calls": dict(recorder.calls),
+    }
+
+def run_key(result):
+    return tuple(result[field] for field in ("backend", "instances", "writers", "keys", "hot_keys", "lock_mode", "write_mode"))
+
+def compare(results, baseline):
+    # Prints the change of throughput and p99 latency for every run that is
+    # also in the baseline
+    previous = {run_key(result): result for result in baseline["results"]}
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for result in results:
+        before = previous.get(run_key(result))
+        if before is None:
+            continue
+        throughput = (result["throughput"] / before["throughput"] - 1) * 100 if before["throughput"] else 0.0
+        p99, p99_before = result["update_ms"]["p99"], before["update_ms"]["p99"]
+        latency = (p99 / p99_before - 1) * 100 if p99 and p99_before else 0.0
+        print(f"{result['backend']:<8}{result['keys']:>8}{result['hot_keys']:>6}   throughput {throughput:+7.1f}%   p99 {latency:+7.1f}%")
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["memory"], choices=["memory", "redis", "mongo", "s3"])
+    parser.add_argument("--instances", type=int, default=4, help="Contextd instances sharing the context")
+    parser.add_argument("--writers", type=int, default=4, help="Concurrent writers per instance")
+    parser.add_argument("--updates", type=int, default=100, help="Updates per writer")
+    parser.add_argument("--keys", type=int, nargs="+", default=[100, 10000], help="Context sizes in keys")
+    parser.add_argument("--hot-keys", type=int, nargs="+", default=[1, 64], help="Number of keys the writers update")
+    parser.add_argument("--lock-mode", default="context", choices=["context", "key", "striped"])
+    parser.add_argument("--write-mode", default="lock", choices=["lock", "optimistic"])
+    parser.add_argument("--group-commit", action="store_true", help="Merge concurrent updates of an instance into one commit")
+    parser.add_argument("--commit-window", type=float, default=0.0, help="Group commit: seconds to collect updates before committing")
+    parser.add_argument("--lock-wakeups", action="store_true", help="Wake lock waiters on release (memory and Redis)")
+    parser.add_argument("--field-level", action="store_true", help="Field-level layout for Redis and S3")
+    parser.add_argument("--latency", type=float, default=0.0, help="Memory backend: seconds added to every call and message")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Memory backend: up to this many extra seconds")
+    parser.add_argument("--settle", type=float, default=0.2, help="Seconds to wait for notifications after the writers finish")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis-url", default="localhost")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--mongo-db", default="contextd_benchmark")
+    parser.add_argument("--s3-bucket", default="contextd-benchmark")
+    parser.add_argument("--s3-region", default="us-east-1")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    parser.add_argument("--compare", dest="baseline_path", help="Results file of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend in args.backends:
+        for keys in args.keys:
+            for hot_keys in args.hot_keys:
+                results.append(asyncio.run(run(backend, keys, hot_keys, args)))
+
+    print(f"{'backend':<8}{'keys':>8}{'hot':>6}{'updates/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'lock p99':>10}{'notify p99':>12}{'errors':>8}")
+    for result in results:
+        print(
+            f"{result['backend']:<8}{result['keys']:>8}{result['hot_keys']:>6}{result['throughput']:>12.1f}"
+            f"{result['update_ms']['p50'] or 0:>10.3f}{result['update_ms']['p99'] or 0:>10.3f}"
+            f"{result['lock_wait_ms']['p99'] or 0:>10.3f}{result['propagation_ms']['p99'] or 0:>12.3f}"
+            f"{sum(result['errors'].values()):>8}"
+        )
+    if args.baseline_path:
+        with open(args.baseline_path) as f:
+            compare(results, json.load(f))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({
+                "commit": current_commit(),
+                "created": datetime.now(timezone.utc).isoformat(),
+                "config": {key: value for key, value in vars(args).items() if key not in ("json_path", "baseline_path")},
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
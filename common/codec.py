@@ -0,0 +1,118 @@
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoded values start with a header byte in the 0x80-0xBF range:
+#   0b10CCFFFF, where CC is the compression and FFFF the payload format.
+# UTF-8 JSON text can never start with such a byte, so data written without
+# a header (plain JSON, as stored before codecs existed) is still recognised.
+HEADER_MARK = 0x80
+
+FORMAT_JSON = 1
+FORMAT_MSGPACK = 2
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+FORMATS = {"json": FORMAT_JSON, "orjson": FORMAT_JSON, "msgpack": FORMAT_MSGPACK}
+COMPRESSIONS = {None: COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+class Codec:
+    """Serializes context values to bytes.
+
+    `encoder` is one of "json", "orjson" or "msgpack"; "json" and "orjson"
+    produce the same format and can read each other's output. Payloads of at
+    least `compress_threshold` bytes are compressed with `compression` ("zlib"
+    or "zstd"). Plain uncompressed JSON is written without a header so that
+    instances which predate codecs can still read it. Every codec decodes
+    every format whose library is installed, whatever it encodes with.
+    """
+
+    def __init__(self, encoder: str = "json", compression: str = None, compress_threshold: int = 1024, compression_level: int = None):
+        if encoder not in FORMATS:
+            raise ValueError(f"Unknown encoder: {encoder}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        if encoder == "orjson" and orjson is None:
+            raise ValueError("The orjson encoder requires the orjson package")
+        if encoder == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack encoder requires the msgpack package")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.encoder = encoder
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compression_level = compression_level
+
+    @property
+    def name(self):
+        return f"{self.encoder}+{self.compression}" if self.compression else self.encoder
+
+    def encode(self, value) -> bytes:
+        if self.encoder == "orjson":
+            payload = orjson.dumps(value)
+        elif self.encoder == "msgpack":
+            payload = msgpack.packb(value, use_bin_type=True)
+        else:
+            payload = json.dumps(value).encode('utf-8')
+        compression = COMPRESSION_NONE
+        if self.compression and len(payload) >= self.compress_threshold:
+            compression = COMPRESSIONS[self.compression]
+            payload = _compress(compression, payload, self.compression_level)
+        payload_format = FORMATS[self.encoder]
+        if payload_format == FORMAT_JSON and compression == COMPRESSION_NONE:
+            return payload
+        return bytes([HEADER_MARK | (compression << 4) | payload_format]) + payload
+
+    def decode(self, data):
+        if isinstance(data, str):
+            return json.loads(data)
+        if not data or data[0] & 0xC0 != HEADER_MARK:
+            return self._loads_json(data)
+        compression, payload_format = (data[0] >> 4) & 0x03, data[0] & 0x0F
+        payload = _decompress(compression, data[1:])
+        if payload_format == FORMAT_JSON:
+            return self._loads_json(payload)
+        if payload_format == FORMAT_MSGPACK:
+            if msgpack is None:
+                raise RuntimeError("Cannot decode msgpack data without the msgpack package")
+            return msgpack.unpackb(payload, raw=False)
+        raise ValueError(f"Unknown payload format: {payload_format}")
+
+    def _loads_json(self, data):
+        # orjson reads big integers as floats and rejects NaN and Infinity,
+        # which json writes, so it only reads for the orjson encoder
+        return orjson.loads(data) if self.encoder == "orjson" else json.loads(data)
+
+def _compress(compression, payload, level):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(payload, -1 if level is None else level)
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(payload)
+
+def _decompress(compression, payload):
+    if compression == COMPRESSION_NONE:
+        return payload
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(payload)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Cannot decode zstd data without the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown compression: {compression}")
+
+default_codec = Codec()
@@ -0,0 +1,90 @@
+import asyncio
+from collections import Counter
+from common.logger import configure_logging
+
+logger = configure_logging()
+
+class GroupCommit:
+    """Merges concurrent writes into batches committed by one action.
+
+    `submit()` queues a change (key/value pairs to set and keys to delete)
+    and returns once the batch containing it has been committed. Changes
+    that arrive within `window` seconds of the first one, or while a commit
+    is in flight, are merged in arrival order, so a later change to a key
+    wins. A batch holds at most `max_batch_size` changes. If the commit
+    fails, every change of the batch fails with the same exception.
+    """
+
+    def __init__(self, commit, window: float = 0.0, max_batch_size: int = 64):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.commit = commit  # async commit(operations: dict, deletions: set)
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.requests = 0
+        self.batches = 0
+        self.failures = 0
+        self.batch_sizes = Counter()  # Number of changes per batch -> batches
+        self.last_batch_size = 0
+        self._pending = []  # (operations, deletions, future) in arrival order
+        self._task = None
+
+    async def submit(self, operations: dict, deletions=()):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((operations, deletions, future))
+        self.requests += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        # The change stays in its batch even if the caller stops waiting
+        return await asyncio.shield(future)
+
+    async def _run(self):
+        while self._pending:
+            if self.window:
+                await asyncio.sleep(self.window)
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            operations, deletions = {}, set()
+            for changed, deleted, _ in batch:
+                for key, value in changed.items():
+                    operations[key] = value
+                    deletions.discard(key)
+                for key in deleted:
+                    operations.pop(key, None)
+                    deletions.add(key)
+            try:
+                await self.commit(operations, deletions)
+            except asyncio.CancelledError:
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as error:
+                self.failures += 1
+                logger.debug("Group commit of %s changes failed: %r", len(batch), error)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            else:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+            self.last_batch_size = len(batch)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending = []
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "failures": self.failures,
+            "mean_batch_size": sum(size * count for size, count in self.batch_sizes.items()) / self.batches if self.batches else 0.0,
+            "max_batch_size": max(self.batch_sizes, default=0),
+            "last_batch_size": self.last_batch_size,
+            "batch_sizes": dict(self.batch_sizes),
+        }
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+class KeyCache(MutableMapping):
+    """A mapping that keeps its most recently used keys.
+
+    Once it holds more than `max_keys` keys, or its values take more than
+    `max_bytes` as measured by `sizeof`, the least recently used keys are
+    evicted. Keys in `pinned`, such as unsaved local changes, are never
+    evicted, so the cache can exceed its bounds while they are pinned.
+    Reading a key with `[]` or setting it marks it as used; `get` and `in`
+    do not.
+    """
+
+    def __init__(self, max_keys: int = None, max_bytes: int = None, sizeof=None, pinned=()):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("max_bytes needs a sizeof function")
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if max_bytes is not None else None
+        self.pinned = pinned
+        self.bytes = 0
+        self.evictions = 0
+        self._values = OrderedDict()  # Least recently used first
+        self._sizes = {}
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        self._values.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __setitem__(self, key, value):
+        if self.sizeof is not None:
+            size = self.sizeof(value)
+            self.bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+        self._values[key] = value
+        self._values.move_to_end(key)
+        self._evict()
+
+    def __delitem__(self, key):
+        del self._values[key]
+        self.bytes -= self._sizes.pop(key, 0)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def _evict(self):
+        excess_keys = len(self._values) - self.max_keys if self.max_keys is not None else 0
+        excess_bytes = self.bytes - self.max_bytes if self.max_bytes is not None else 0
+        if excess_keys <= 0 and excess_bytes <= 0:
+            return
+        victims = []
+        for key in self._values:
+            if excess_keys <= 0 and excess_bytes <= 0:
+                break
+            if key in self.pinned:
+                continue
+            victims.append(key)
+            excess_keys -= 1
+            excess_bytes -= self._sizes.get(key, 0)
+        for key in victims:
+            del self[key]
+        self.evictions += len(victims)
+
+    def stats(self):
+        return {"keys": len(self._values), "bytes": self.bytes, "evictions": self.evictions}
+
+class LazyContext:
+    """The context of a lazy Contextd, read key by key.
+
+    Returned by Contextd.get_lazy_context. Reads are coroutines: a key that
+    is not cached is fetched from the backend on first access and cached
+    until it is evicted or invalidated. `prefetch` fetches a list of
+    keys in one round trip. `in` and `len` only cover the cached keys.
+    """
+
+    def __init__(self, contextd):
+        self.contextd = contextd
+
+    @property
+    def version(self):
+        return self.contextd.version
+
+    async def get(self, key, default=None):
+        return await self.contextd.get(key, default)
+
+    async def get_many(self, keys) -> dict:
+        return await self.contextd.get_many(keys)
+
+    async def prefetch(self, keys):
+        await self.contextd.prefetch(keys)
+
+    def __contains__(self, key):
+        return key in self.contextd.context
+
+    def __len__(self):
+        return len(self.contextd.context)
+
+    def stats(self):
+        return self.contextd.cache_stats()
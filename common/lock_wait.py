@@ -0,0 +1,41 @@
+import random
+import time
+
+class FixedDelay:
+    """Retries at a fixed interval, up to max_retries attempts."""
+
+    def __init__(self, retry_delay: float = 0.1, max_retries: int = 50):
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+
+    def delays(self):
+        for _ in range(self.max_retries - 1):
+            yield self.retry_delay
+
+class ExponentialBackoff:
+    """Doubles the delay after every failed attempt, with jitter.
+
+    With jitter, each delay is drawn from the upper half of the backoff window
+    so that contending instances spread out without ever busy-looping.
+
+    Gives up once `deadline` seconds have passed since the first attempt.
+    """
+
+    def __init__(self, base_delay: float = 0.005, max_delay: float = 0.5, deadline: float = 5.0, jitter: bool = True):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def delays(self):
+        give_up_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                return
+            delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+            if self.jitter:
+                delay = random.uniform(delay / 2, delay)
+            yield min(delay, remaining)
+            attempt += 1
@@ -1,6 +1,11 @@
+import os
 import logging
 
 def configure_logging():
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Handlers and the root level are left to the application. The level of
+    # contextd's own logger can be set with CONTEXTD_LOG_LEVEL, e.g. "DEBUG".
     logger = logging.getLogger(__name__)
-    return logger
\ No newline at end of file
+    level = os.environ.get("CONTEXTD_LOG_LEVEL")
+    if level:
+        logger.setLevel(level.upper())
+    return logger
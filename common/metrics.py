@@ -0,0 +1,195 @@
+import time
+from bisect import bisect_left
+
+# Histogram buckets for durations in seconds and for sizes in bytes
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+class Observer:
+    """Receives measurements from Metrics. Subclasses override what they need.
+
+    `timing` gets durations in seconds, `value` other distributions such as
+    payload sizes, and `count` increments of counters. `labels` is a dict of
+    strings and must not be modified.
+    """
+
+    def timing(self, name: str, seconds: float, labels: dict):
+        pass
+
+    def value(self, name: str, value: float, labels: dict):
+        pass
+
+    def count(self, name: str, value: float, labels: dict):
+        pass
+
+class Metrics:
+    """Passes measurements to the attached observers.
+
+    Instrumented code calls `start()` before an operation and `elapsed()`
+    after it. Without observers `start()` returns None and nothing is timed,
+    so instrumentation costs one attribute check per call.
+    """
+
+    def __init__(self, *observers: Observer):
+        self.observers = list(observers)
+
+    def add_observer(self, observer: Observer):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer: Observer):
+        self.observers.remove(observer)
+
+    def start(self):
+        return time.perf_counter() if self.observers else None
+
+    def elapsed(self, name: str, started, **labels):
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        for observer in self.observers:
+            observer.timing(name, seconds, labels)
+
+    def timing(self, name: str, seconds: float, **labels):
+        for observer in self.observers:
+            observer.timing(name, seconds, labels)
+
+    def value(self, name: str, value: float, **labels):
+        for observer in self.observers:
+            observer.value(name, value, labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        for observer in self.observers:
+            observer.count(name, value, labels)
+
+class MeteredCodec:
+    """Wraps a codec and reports the size of every encoded and decoded payload."""
+
+    def __init__(self, codec, metrics: Metrics, **labels):
+        self.codec = codec
+        self.metrics = metrics
+        self.labels = labels
+
+    def __getattr__(self, name):
+        return getattr(self.codec, name)
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        if self.metrics.observers:
+            self.metrics.value("contextd_payload_bytes", len(data), direction="encode", **self.labels)
+        return data
+
+    def decode(self, data):
+        if self.metrics.observers:
+            self.metrics.value("contextd_payload_bytes", len(data), direction="decode", **self.labels)
+        return self.codec.decode(data)
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class PrometheusObserver(Observer):
+    """Aggregates measurements in memory and renders them in the Prometheus
+    text exposition format, e.g. for a /metrics endpoint:
+
+        observer = PrometheusObserver()
+        metrics = Metrics(observer)
+        ...
+        body = observer.render()
+
+    Timings become histograms in seconds, values histograms over
+    `size_buckets`, and counts counters.
+    """
+
+    def __init__(self, time_buckets=TIME_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.time_buckets = tuple(time_buckets)
+        self.size_buckets = tuple(size_buckets)
+        self._histograms = {}  # name -> {label items: _Histogram}
+        self._counters = {}  # name -> {label items: total}
+
+    def _histogram(self, name, labels, buckets):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = _Histogram(buckets)
+        return histogram
+
+    def timing(self, name: str, seconds: float, labels: dict):
+        self._histogram(name, labels, self.time_buckets).observe(seconds)
+
+    def value(self, name: str, value: float, labels: dict):
+        self._histogram(name, labels, self.size_buckets).observe(value)
+
+    def count(self, name: str, value: float, labels: dict):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    @staticmethod
+    def _labels(items):
+        if not items:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for key, total in series.items():
+                lines.append(f"{name}{self._labels(key)} {total}")
+        for name, series in sorted(self._histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels((*key, ('le', str(bound))))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+class OpenTelemetryObserver(Observer):
+    """Records measurements with an OpenTelemetry meter and, optionally, tracer:
+
+        from opentelemetry import metrics, trace
+        observer = OpenTelemetryObserver(metrics.get_meter("contextd"), trace.get_tracer("contextd"))
+
+    Timings and values are recorded on histograms and counts on counters
+    (without the `_total` suffix, which exporters add). With a tracer every
+    timing is also reported as a span covering the measured operation.
+    """
+
+    def __init__(self, meter, tracer=None):
+        self.meter = meter
+        self.tracer = tracer
+        self._instruments = {}
+
+    def _instrument(self, name, create, unit):
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            instrument = self._instruments[name] = create(name, unit=unit)
+        return instrument
+
+    def timing(self, name: str, seconds: float, labels: dict):
+        self._instrument(name, self.meter.create_histogram, "s").record(seconds, attributes=labels)
+        if self.tracer is not None:
+            end = time.time_ns()
+            span = self.tracer.start_span(name, start_time=end - int(seconds * 1e9), attributes=labels)
+            span.end(end_time=end)
+
+    def value(self, name: str, value: float, labels: dict):
+        unit = "By" if name.endswith("_bytes") else "1"
+        self._instrument(name, self.meter.create_histogram, unit).record(value, attributes=labels)
+
+    def count(self, name: str, value: float, labels: dict):
+        name = name[:-len("_total")] if name.endswith("_total") else name
+        self._instrument(name, self.meter.create_counter, "1").add(value, attributes=labels)
@@ -0,0 +1,109 @@
+import copy
+
+# Atomic operations run by the storage backend without a client lock. Each
+# operation is a (name, path, argument) tuple; the path is a tuple of keys
+# into nested mappings, starting with a top-level context key.
+OPERATIONS = ("set", "increment", "append", "merge", "set_if_absent", "delete")
+
+_MISSING = object()
+
+def parse_path(path) -> tuple:
+    """Turns "user.profile.email" into ("user", "profile", "email").
+
+    Keys that contain "." can be given as a tuple or list instead.
+    """
+    if isinstance(path, str):
+        path = tuple(path.split("."))
+    else:
+        path = tuple(path)
+    if not path or not all(isinstance(key, str) and key for key in path):
+        raise ValueError(f"Invalid path: {path!r}")
+    return path
+
+def operation(name: str, path, argument=None) -> tuple:
+    """Validates an operation and returns it as a (name, path, argument) tuple."""
+    if name not in OPERATIONS:
+        raise ValueError(f"Unknown operation: {name}")
+    if name == "increment" and (isinstance(argument, bool) or not isinstance(argument, (int, float))):
+        raise TypeError(f"increment needs a number, not {type(argument).__name__}")
+    if name == "merge" and not isinstance(argument, dict):
+        raise TypeError(f"merge needs a dict, not {type(argument).__name__}")
+    return name, parse_path(path), argument
+
+def apply_operations(context: dict, operations) -> tuple:
+    """Applies operations to context in place, in order.
+
+    Returns the result of every operation, the set of top-level keys whose
+    values changed and the set of top-level keys that were deleted. A missing
+    value or None counts as absent for increment (which starts from 0),
+    append, merge and set_if_absent. Missing mappings on the way to the last
+    key are created. Raises TypeError if a value has the wrong type; context
+    may then be partly modified and should be discarded.
+
+    Results: the new number for increment, the new length for append, the
+    merged mapping for merge, whether the value was set for set_if_absent,
+    whether the key existed for delete, and None for set.
+    """
+    results = []
+    changed = set()
+    deleted = set()
+    for name, path, argument in operations:
+        result, mutated = _apply(context, name, path, argument)
+        results.append(result)
+        if not mutated:
+            continue
+        if name == "delete" and len(path) == 1:
+            deleted.add(path[0])
+            changed.discard(path[0])
+        else:
+            changed.add(path[0])
+            deleted.discard(path[0])
+    return results, changed, deleted
+
+def _apply(context: dict, name: str, path: tuple, argument):
+    # Returns the operation's result and whether it changed the context
+    target = context
+    for depth, key in enumerate(path[:-1], start=1):
+        child = target.get(key)
+        if child is None:
+            if name == "delete":
+                return False, False
+            child = target[key] = {}
+        elif not isinstance(child, dict):
+            raise TypeError(f"{'.'.join(path[:depth])} is not a mapping")
+        target = child
+    leaf = path[-1]
+    current = target.get(leaf)
+    if name == "set":
+        target[leaf] = argument
+        return None, True
+    if name == "increment":
+        if current is None:
+            current = 0
+        elif isinstance(current, bool) or not isinstance(current, (int, float)):
+            raise TypeError(f"{'.'.join(path)} is not a number")
+        target[leaf] = current + argument
+        return target[leaf], True
+    if name == "append":
+        if current is None:
+            current = target[leaf] = []
+        elif not isinstance(current, list):
+            raise TypeError(f"{'.'.join(path)} is not a list")
+        current.append(argument)
+        return len(current), True
+    if name == "merge":
+        if current is None:
+            current = target[leaf] = {}
+        elif not isinstance(current, dict):
+            raise TypeError(f"{'.'.join(path)} is not a mapping")
+        current.update(argument)
+        return copy.deepcopy(current), True
+    if name == "set_if_absent":
+        if current is not None:
+            return False, False
+        target[leaf] = argument
+        return True, True
+    if name == "delete":
+        existed = target.pop(leaf, _MISSING) is not _MISSING
+        return existed, existed
+    raise ValueError(f"Unknown operation: {name}")
@@ -0,0 +1,363 @@
+from collections.abc import ItemsView, Mapping, ValuesView
+
+# A hash array mapped trie: every level consumes 5 bits of the key's hash and
+# holds at most 32 entries. Nodes are never modified after they are built, so
+# a change copies only the nodes on the path to the changed key and shares
+# everything else with the map it was derived from.
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_BITS = 64
+
+_CHILD = object()  # Marks an entry holding a sub-node instead of a key
+_MISSING = object()
+
+def _hash(key):
+    return hash(key) & ((1 << _HASH_BITS) - 1)
+
+class _Node:
+    # bitmap has a bit set for every occupied slot; array holds a key and a
+    # value per occupied slot, in slot order, with (_CHILD, node) for slots
+    # that branch further
+    __slots__ = ("bitmap", "array")
+
+    def __init__(self, bitmap: int, array: tuple):
+        self.bitmap = bitmap
+        self.array = array
+
+    def _position(self, bit):
+        return 2 * (self.bitmap & (bit - 1)).bit_count()
+
+    def get(self, shift, key_hash, key, default):
+        bit = 1 << ((key_hash >> shift) & _MASK)
+        if not self.bitmap & bit:
+            return default
+        index = self._position(bit)
+        stored, value = self.array[index], self.array[index + 1]
+        if stored is _CHILD:
+            return value.get(shift + _BITS, key_hash, key, default)
+        if stored is key or stored == key:
+            return value
+        return default
+
+    def assoc(self, shift, key_hash, key, value):
+        # Returns the new node and whether the key was added
+        bit = 1 << ((key_hash >> shift) & _MASK)
+        index = self._position(bit)
+        if not self.bitmap & bit:
+            return _Node(self.bitmap | bit, self.array[:index] + (key, value) + self.array[index:]), True
+        stored, current = self.array[index], self.array[index + 1]
+        if stored is _CHILD:
+            child, added = current.assoc(shift + _BITS, key_hash, key, value)
+            if child is current:
+                return self, False
+            return self._replace(index, _CHILD, child), added
+        if stored is key or stored == key:
+            if current is value:
+                return self, False
+            return self._replace(index, stored, value), False
+        child = _pair(shift + _BITS, _hash(stored), stored, current, key_hash, key, value)
+        return self._replace(index, _CHILD, child), True
+
+    def without(self, shift, key_hash, key):
+        # Returns the node without the key, self if it was missing, or None
+        # if the node became empty
+        bit = 1 << ((key_hash >> shift) & _MASK)
+        if not self.bitmap & bit:
+            return self
+        index = self._position(bit)
+        stored, current = self.array[index], self.array[index + 1]
+        if stored is _CHILD:
+            child = current.without(shift + _BITS, key_hash, key)
+            if child is current:
+                return self
+            if child is not None:
+                single = child.single()
+                if single is None:
+                    return self._replace(index, _CHILD, child)
+                # Pull a lone remaining entry up into this node
+                return self._replace(index, *single)
+        elif not (stored is key or stored == key):
+            return self
+        if self.bitmap == bit:
+            return None
+        return _Node(self.bitmap ^ bit, self.array[:index] + self.array[index + 2:])
+
+    def _replace(self, index, key, value):
+        return _Node(self.bitmap, self.array[:index] + (key, value) + self.array[index + 2:])
+
+    def single(self):
+        # The only entry of the node if it is a key, otherwise None
+        if len(self.array) == 2 and self.array[0] is not _CHILD:
+            return self.array[0], self.array[1]
+        return None
+
+    def walk(self):
+        array = self.array
+        for index in range(0, len(array), 2):
+            if array[index] is _CHILD:
+                yield from array[index + 1].walk()
+            else:
+                yield array[index], array[index + 1]
+
+class _Collision:
+    # Keys whose hashes are equal in all bits
+    __slots__ = ("key_hash", "items")
+
+    def __init__(self, key_hash: int, items: tuple):
+        self.key_hash = key_hash
+        self.items = items
+
+    def _find(self, key):
+        for index, (stored, _) in enumerate(self.items):
+            if stored is key or stored == key:
+                return index
+        return -1
+
+    def get(self, shift, key_hash, key, default):
+        if key_hash == self.key_hash:
+            index = self._find(key)
+            if index >= 0:
+                return self.items[index][1]
+        return default
+
+    def assoc(self, shift, key_hash, key, value):
+        if key_hash != self.key_hash:
+            # Branch on the hash bits at this level, with this node as one side
+            node = _Node(1 << ((self.key_hash >> shift) & _MASK), (_CHILD, self))
+            return node.assoc(shift, key_hash, key, value)
+        index = self._find(key)
+        if index < 0:
+            return _Collision(self.key_hash, self.items + ((key, value),)), True
+        if self.items[index][1] is value:
+            return self, False
+        return _Collision(self.key_hash, self.items[:index] + ((key, value),) + self.items[index + 1:]), False
+
+    def without(self, shift, key_hash, key):
+        index = self._find(key) if key_hash == self.key_hash else -1
+        if index < 0:
+            return self
+        if len(self.items) == 1:
+            return None
+        return _Collision(self.key_hash, self.items[:index] + self.items[index + 1:])
+
+    def single(self):
+        return self.items[0] if len(self.items) == 1 else None
+
+    def walk(self):
+        yield from self.items
+
+def _pair(shift, first_hash, first_key, first_value, second_hash, second_key, second_value):
+    # Builds the node holding two keys that share a slot at the level above
+    if first_hash == second_hash:
+        return _Collision(first_hash, ((first_key, first_value), (second_key, second_value)))
+    first_slot = (first_hash >> shift) & _MASK
+    second_slot = (second_hash >> shift) & _MASK
+    if first_slot == second_slot:
+        child = _pair(shift + _BITS, first_hash, first_key, first_value, second_hash, second_key, second_value)
+        return _Node(1 << first_slot, (_CHILD, child))
+    if first_slot < second_slot:
+        array = (first_key, first_value, second_key, second_value)
+    else:
+        array = (second_key, second_value, first_key, first_value)
+    return _Node((1 << first_slot) | (1 << second_slot), array)
+
+def _build(shift, entries):
+    # Builds a node from (hash, key, value) entries with distinct keys in one pass
+    if len(entries) > 1 and (shift >= _HASH_BITS or all(entry[0] == entries[0][0] for entry in entries)):
+        return _Collision(entries[0][0], tuple((key, value) for _, key, value in entries))
+    slots = {}
+    for entry in entries:
+        slots.setdefault((entry[0] >> shift) & _MASK, []).append(entry)
+    bitmap = 0
+    array = []
+    for slot in sorted(slots):
+        bitmap |= 1 << slot
+        grouped = slots[slot]
+        if len(grouped) == 1:
+            array.extend(grouped[0][1:])
+        else:
+            array.extend((_CHILD, _build(shift + _BITS, grouped)))
+    return _Node(bitmap, tuple(array))
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping._root.walk() if self._mapping._root is not None else iter(())
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        for _, value in self._mapping.items():
+            yield value
+
+class PMap(Mapping):
+    """An immutable mapping with cheap modified copies.
+
+    `set`, `delete` and `update` return a new PMap and leave this one
+    unchanged. The new map shares all but O(log32 n) nodes per changed key
+    with the old one, so deriving a version costs O(changed keys) and old
+    versions stay valid for as long as someone holds them. Keys must be
+    hashable; values are stored as they are and not copied.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, items=()):
+        if isinstance(items, PMap):
+            self._root, self._size = items._root, items._size
+            return
+        entries = {}
+        for key, value in (items.items() if isinstance(items, Mapping) else items):
+            entries[key] = value
+        self._root = _build(0, [(_hash(key), key, value) for key, value in entries.items()]) if entries else None
+        self._size = len(entries)
+
+    @classmethod
+    def _derive(cls, root, size):
+        derived = cls.__new__(cls)
+        derived._root = root
+        derived._size = size
+        return derived
+
+    def __getitem__(self, key):
+        if self._root is not None:
+            value = self._root.get(0, _hash(key), key, _MISSING)
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if self._root is None:
+            return default
+        return self._root.get(0, _hash(key), key, default)
+
+    def __contains__(self, key):
+        return self._root is not None and self._root.get(0, _hash(key), key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def set(self, key, value) -> "PMap":
+        if self._root is None:
+            return self._derive(_Node(0, ()).assoc(0, _hash(key), key, value)[0], 1)
+        root, added = self._root.assoc(0, _hash(key), key, value)
+        return self if root is self._root else self._derive(root, self._size + added)
+
+    def delete(self, key) -> "PMap":
+        # Deleting a missing key returns the map unchanged
+        if self._root is None:
+            return self
+        root = self._root.without(0, _hash(key), key)
+        return self if root is self._root else self._derive(root, self._size - 1)
+
+    def update(self, changed=(), deleted=()) -> "PMap":
+        # Sets the keys of changed, then removes the keys in deleted
+        result = self
+        for key, value in (changed.items() if isinstance(changed, Mapping) else changed):
+            result = result.set(key, value)
+        for key in deleted:
+            result = result.delete(key)
+        return result
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __reduce__(self):
+        return type(self), (dict(self.items()),)
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError(f"'{type(self).__name__}' object is immutable")
+
+class FrozenDict(dict):
+    """A dict that cannot be modified.
+
+    It compares, serializes and passes isinstance checks like the dict it was
+    built from, but every method that would change it raises TypeError.
+    """
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+class FrozenList(list):
+    """A list that cannot be modified, see FrozenDict."""
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+def freeze(value):
+    # Returns a deep copy of a decoded value in which dicts, lists and sets
+    # cannot be modified. Frozen values are returned as they are.
+    if isinstance(value, (FrozenDict, FrozenList, frozenset)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    if type(value) is tuple:
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+class Snapshot(Mapping):
+    """A read-only view of a context at one version.
+
+    Returned by Contextd.get_context. A snapshot never changes: applying an
+    update derives a new snapshot that shares the unchanged keys with this
+    one, so readers can hold on to it without copying or locking. Values are
+    frozen (see freeze) when they enter a snapshot, so neither a reader
+    mutating a value nor a later in-place change of the context can alter it.
+    """
+
+    __slots__ = ("map", "version")
+
+    def __init__(self, items=(), version=None):
+        # A PMap is taken as it is; it must only hold frozen values
+        if not isinstance(items, PMap):
+            items = PMap((key, freeze(value)) for key, value in (items.items() if isinstance(items, Mapping) else items))
+        self.map = items
+        self.version = version
+
+    def __getitem__(self, key):
+        return self.map[key]
+
+    def get(self, key, default=None):
+        return self.map.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+    def __iter__(self):
+        return iter(self.map)
+
+    def items(self):
+        return self.map.items()
+
+    def values(self):
+        return self.map.values()
+
+    def evolve(self, changed=(), deleted=(), version=None) -> "Snapshot":
+        changed = ((key, freeze(value)) for key, value in (changed.items() if isinstance(changed, Mapping) else changed))
+        return Snapshot(self.map.update(changed, deleted), version)
+
+    def __repr__(self):
+        return f"Snapshot({dict(self.map.items())!r}, version={self.version!r})"
@@ -0,0 +1,68 @@
+import asyncio
+from common.logger import configure_logging
+
+logger = configure_logging()
+
+class CoalescingScheduler:
+    """Runs an async action on request, never more than one at a time.
+
+    Requests that arrive while a run is pending are collapsed into it, and
+    requests that arrive while a run is in flight collapse into a single
+    trailing run. With a debounce window, a run starts `debounce` seconds
+    after the first request so that a burst is folded into one run.
+    """
+
+    def __init__(self, action, debounce: float = 0.0):
+        self.action = action
+        self.debounce = debounce
+        self.requests = 0
+        self.collapsed = 0  # Requests folded into an already pending run
+        self.runs = 0
+        self.failures = 0
+        self.last_lag = 0.0  # Seconds from the first request of a run to its completion
+        self.max_lag = 0.0
+        self._pending_since = None
+        self._task = None
+
+    def schedule(self):
+        self.requests += 1
+        if self._pending_since is not None:
+            self.collapsed += 1
+            return
+        self._pending_since = asyncio.get_running_loop().time()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._pending_since is not None:
+            if self.debounce:
+                await asyncio.sleep(self.debounce)
+            requested_at, self._pending_since = self._pending_since, None
+            try:
+                await self.action()
+            except Exception:
+                self.failures += 1
+                logger.exception("Scheduled action failed")
+            self.runs += 1
+            self.last_lag = loop.time() - requested_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    async def wait_idle(self):
+        while self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._pending_since = None
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "collapsed": self.collapsed,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
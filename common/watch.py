@@ -0,0 +1,152 @@
+import asyncio
+import inspect
+from common.logger import configure_logging
+
+logger = configure_logging()
+
+# Marks the old value of a key that did not exist, or the new value of a
+# deleted key, in a KeyChange
+ABSENT = object()
+
+class KeyChange:
+    """A change of one context key, passed to watch callbacks.
+
+    `old` is ABSENT if the key was added and `new` is ABSENT if it was
+    deleted. `version` is the context version that contains the change, and
+    `local` tells whether this instance made it.
+    """
+
+    def __init__(self, context_key: str, key: str, old, new, version, local: bool):
+        self.context_key = context_key
+        self.key = key
+        self.old = old
+        self.new = new
+        self.version = version
+        self.local = local
+
+    @property
+    def deleted(self):
+        return self.new is ABSENT
+
+    @property
+    def added(self):
+        return self.old is ABSENT
+
+    def __repr__(self):
+        return f"KeyChange({self.context_key!r}, {self.key!r}, old={self.old!r}, new={self.new!r}, version={self.version})"
+
+class Watch:
+    """Handle of a registered callback; `cancel()` stops the callbacks."""
+
+    def __init__(self, watchers, context_key: str, pattern: str, callback):
+        self.watchers = watchers
+        self.context_key = context_key
+        self.pattern = pattern
+        self.callback = callback
+
+    def cancel(self):
+        self.watchers._remove(self)
+
+class _WatchIndex:
+    # The watches of one context: exact keys in a dict, and prefixes in a
+    # dict looked up once per distinct prefix length
+    def __init__(self):
+        self.keys = {}  # key -> [Watch]
+        self.prefixes = {}  # prefix -> [Watch]
+        self.prefix_lengths = set()
+
+    def add(self, watch: Watch):
+        if watch.pattern.endswith("*"):
+            prefix = watch.pattern[:-1]
+            self.prefixes.setdefault(prefix, []).append(watch)
+            self.prefix_lengths.add(len(prefix))
+        else:
+            self.keys.setdefault(watch.pattern, []).append(watch)
+
+    def remove(self, watch: Watch):
+        if watch.pattern.endswith("*"):
+            prefix = watch.pattern[:-1]
+            watches = self.prefixes.get(prefix, [])
+            if watch in watches:
+                watches.remove(watch)
+            if not watches:
+                self.prefixes.pop(prefix, None)
+                self.prefix_lengths = {len(prefix) for prefix in self.prefixes}
+        else:
+            watches = self.keys.get(watch.pattern, [])
+            if watch in watches:
+                watches.remove(watch)
+            if not watches:
+                self.keys.pop(watch.pattern, None)
+
+    def __bool__(self):
+        return bool(self.keys or self.prefixes)
+
+    def matching(self, key: str):
+        watches = list(self.keys.get(key, ()))
+        for length in self.prefix_lengths:
+            if len(key) >= length:
+                watches.extend(self.prefixes.get(key[:length], ()))
+        return watches
+
+class Watchers:
+    """Routes key changes to the callbacks watching them.
+
+    Watches are indexed by context key, and within a context by key or key
+    prefix. A pattern ending in "*" watches every key starting with the rest
+    of it, so "*" alone watches the whole context. Callbacks receive a
+    KeyChange; coroutine callbacks are run as tasks. One Watchers can be
+    shared by many Contextd instances, e.g. those of a ContextRegistry.
+    """
+
+    def __init__(self):
+        self._indexes = {}  # context key -> _WatchIndex
+        self._tasks = set()
+
+    def watch(self, context_key: str, pattern: str, callback) -> Watch:
+        watch = Watch(self, context_key, pattern, callback)
+        self._indexes.setdefault(context_key, _WatchIndex()).add(watch)
+        return watch
+
+    def _remove(self, watch: Watch):
+        index = self._indexes.get(watch.context_key)
+        if index is not None:
+            index.remove(watch)
+            if not index:
+                del self._indexes[watch.context_key]
+
+    def watching(self, context_key: str) -> bool:
+        return context_key in self._indexes
+
+    def notify(self, context_key: str, keys, old: dict, new: dict, version, local: bool):
+        """Calls the watches of the given keys whose value differs between
+        the `old` and `new` mappings. Unwatched keys are not compared."""
+        index = self._indexes.get(context_key)
+        if index is None:
+            return
+        for key in keys:
+            watches = index.matching(key)
+            if not watches:
+                continue
+            old_value, new_value = old.get(key, ABSENT), new.get(key, ABSENT)
+            if old_value is new_value or old_value == new_value:
+                continue
+            change = KeyChange(context_key, key, old_value, new_value, version, local)
+            for watch in watches:
+                self._call(watch, change)
+
+    def _call(self, watch: Watch, change: KeyChange):
+        try:
+            result = watch.callback(change)
+        except Exception:
+            logger.exception("Watch callback for %s failed", watch.pattern)
+            return
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Watch callback failed: %r", task.exception())
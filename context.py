@@ -1,81 +1,780 @@
+import time
 import uuid
+import zlib
 import asyncio
 from backends.base import StorageBackend
 from common.logger import configure_logging
 from common.event import event_emitter 
+from common.scheduler import CoalescingScheduler
+from common.group_commit import GroupCommit
+from common.lazy import KeyCache, LazyContext
+from common.lock_wait import ExponentialBackoff, FixedDelay
+from common.metrics import Metrics
+from common.operations import operation
+from common.pmap import Snapshot
+from common.watch import ABSENT, Watchers
 
 # Configure the logger
 logger = configure_logging()
 
+LOCK_MODES = ("context", "key", "striped")
+WRITE_MODES = ("lock", "optimistic")
+
+# Marks a key whose fetch in lazy mode may have read a value that is older
+# than the context, so the value is returned but not cached
+_STALE = object()
+
 class Contextd:
-    def __init__(self, context_key: str, storage_backend: StorageBackend, enable_notifications=True):
+    def __init__(self, context_key: str, storage_backend: StorageBackend, enable_notifications=True, reload_debounce=0.0, lock_mode="context", lock_stripes=64, write_mode="lock", max_write_retries=10, write_backoff=None, lock_wait=None, lock_wakeups=False, fair_locks=False, compact_interval=None, renew_leases=True, metrics=None, group_commit=False, commit_window=0.0, max_batch_size=64, watchers=None, lazy=False, cache_keys=None, cache_bytes=None):
+        if lock_mode not in LOCK_MODES:
+            raise ValueError(f"Unknown lock mode: {lock_mode}")
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode: {write_mode}")
+        if lock_mode != "context" and not storage_backend.field_level:
+            # Without a field-level layout every write rewrites the whole
+            # context, so writers holding different key locks would overwrite
+            # each other's changes.
+            raise ValueError(f"Lock mode '{lock_mode}' requires a backend with a field-level layout")
+        if lazy and not storage_backend.field_level:
+            # Writes to a blob layout rewrite the whole context, which a lazy
+            # instance does not hold
+            raise ValueError("Lazy mode requires a backend with a field-level layout")
+        if lock_wakeups and not storage_backend.supports_publish:
+            # Release messages would never reach the waiters
+            raise ValueError("Lock wakeups require a backend that can publish messages, such as Redis")
         self.context_key = context_key
         self.context = {}
+        self.version = None  # Storage version the local context reflects, None if unknown
         self.storage = storage_backend
         self.lock_key = f"{self.context_key}_lock"
         self.lock_value = str(uuid.uuid4())  # Unique identifier for the lock owner
+        self.lock_mode = lock_mode
+        self.lock_stripes = lock_stripes
+        self.write_mode = write_mode
+        self.max_write_retries = max_write_retries
+        self.write_backoff = write_backoff or ExponentialBackoff()  # Delays between optimistic write attempts, see common.lock_wait
+        self.lock_wait = lock_wait or FixedDelay()  # Delays between lock attempts, see common.lock_wait
+        self.lock_wakeups = lock_wakeups  # Wake lock waiters when the holder publishes a release
+        self.fair_locks = fair_locks  # Grant locks to waiters in arrival order
+        self.lock_channel = f"{self.lock_key}_events"
+        self._lock_released = {}  # lock name -> asyncio.Event set when the lock is released
+        self._local_lock_queues = {}  # lock name -> asyncio.Lock queueing local waiters in FIFO order
+        self.renew_leases = renew_leases  # Keep extending the leases of held locks
+        self._fences = {}  # lock name -> fencing token of the held lock
+        self._renewals = {}  # lock name -> task renewing its lease
         self.enable_notifications = enable_notifications
-        logger.debug(f"Initialized Contextd with context_key: {self.context_key}")
+        self._dirty_keys = set()  # Keys changed locally but not yet persisted
+        self._deleted_keys = set()  # Keys removed locally but not yet persisted
+        self._own_versions = set()  # Versions we wrote ahead of versions we have not seen yet
+        # Reloads requested by notifications are coalesced so a burst of
+        # updates costs at most one reload in flight plus one trailing reload
+        self._reloads = CoalescingScheduler(self.load_context, debounce=reload_debounce)
+        self._subscription = None
+        self._lock_subscription = None
+        self.compact_interval = compact_interval  # Seconds between change log compactions, None to never compact
+        self._compaction = None
+        self.metrics = metrics or Metrics()  # See common.metrics
+        self._held_since = {}  # lock name -> start of the hold, while metrics are observed
+        # With group commit, updates that arrive within commit_window seconds
+        # or while a commit is in flight share one lock-and-save cycle
+        self.watchers = watchers or Watchers()  # Key-scoped change callbacks, see common.watch
+        self._committed_values = {}  # key -> value before its unsaved local change, ABSENT if it did not exist
+        # get_context derives a new snapshot from the last one by re-reading
+        # only the keys changed since, see common.pmap
+        self._snapshot = Snapshot()
+        self._snapshot_source = None  # The context dict the snapshot was derived from
+        self._snapshot_keys = set()  # Keys committed since the snapshot was taken
+        # In lazy mode the context holds only the cached keys: at most
+        # cache_keys keys, or cache_bytes of encoded values. Other keys are
+        # fetched from the backend on first access, see get and prefetch.
+        self.lazy = lazy
+        if lazy:
+            sizeof = (lambda value: len(storage_backend.codec.encode(value))) if cache_bytes is not None else None
+            self.context = KeyCache(cache_keys, cache_bytes, sizeof, pinned=self._dirty_keys)
+        self._fetches = {}  # key -> (task fetching it, overrides of that fetch)
+        self._cache_counts = {"hits": 0, "misses": 0, "fetches": 0, "invalidations": 0}
+        self._group_commit = GroupCommit(self._commit, window=commit_window, max_batch_size=max_batch_size) if group_commit else None
+        logger.debug("Initialized Contextd with context_key: %s", self.context_key)
 
-    async def initialize(self):
+    async def initialize(self, state=None):
+        # state is an already loaded (context, version) pair, e.g. from a bulk read
         logger.debug("Initializing context")
-        self.context = await self.storage.load_context(self.context_key)
+        if not self.lazy:
+            self.context, self.version = state if state is not None else await self.storage.load_versioned(self.context_key)
+        elif state is not None:
+            context, self.version = state
+            self.context.update(context)
+        else:
+            # Only the version is read, keys are fetched on first access
+            self.version = await self.storage.get_version(self.context_key)
         if self.enable_notifications:
-            await self.storage.subscribe_to_updates(self.context_key, self.load_context)
+            self._subscription = await self.storage.subscribe_to_updates(self.context_key, self.handle_update)
+        if self.lock_wakeups:
+            self._lock_subscription = await self.storage.subscribe_to_updates(self.lock_channel, self.handle_lock_event)
+        if self.compact_interval:
+            self._compaction = asyncio.create_task(self._compact_periodically())
         logger.debug("Context initialized and subscription to updates set")
 
+    async def close(self):
+        self._reloads.cancel()
+        if self._group_commit is not None:
+            self._group_commit.cancel()
+        if self._compaction is not None:
+            self._compaction.cancel()
+            self._compaction = None
+        for renewal in self._renewals.values():
+            renewal.cancel()
+        self._renewals.clear()
+        for subscription in (self._subscription, self._lock_subscription):
+            if subscription is not None:
+                subscription.cancel()
+        self._subscription = None
+        self._lock_subscription = None
+
     async def load_context(self):
+        started = self.metrics.start()
+        source = await self._load_context()
+        self.metrics.elapsed("contextd_load_seconds", started, source=source)
+
+    async def _load_context(self):
+        # Returns where the context came from, for the load metrics
         logger.debug("Loading context")
-        self.context = await self.storage.load_context(self.context_key)
-        logger.debug(f"Context loaded: {self.context}")
+        if self.version is not None:
+            # Catch up from the change log if it still reaches back to our
+            # version, so only the missed changes are read
+            changes = await self.storage.changes_since(self.context_key, self.version)
+            if changes is not None and self._replay(changes):
+                logger.debug("Caught up to version %s from %s logged changes", self.version, len(changes))
+                return "change_log"
+            version = await self.storage.get_version(self.context_key)
+            if version == self.version:
+                logger.debug("Context unchanged at version %s, skipping reload", version)
+                return "unchanged"
+        elif self.lazy:
+            version = await self.storage.get_version(self.context_key)
+        if self.lazy:
+            self._invalidate_cache(version)
+            return "invalidated"
+        context, version = await self.storage.load_versioned(self.context_key)
+        if version is not None and self.version is not None and version < self.version:
+            # Deltas applied while the load was in flight are newer than it
+            logger.debug("Discarding loaded version %s, already at %s", version, self.version)
+            return "full"
+        previous, self.context, self.version = self.context, context, version
+        self._notify_remote(previous.keys() | context.keys(), previous)
+        # Unsaved local changes, such as those of a save still in flight,
+        # stay on top of the loaded context
+        for key in self._dirty_keys:
+            context[key] = previous[key]
+        for key in self._deleted_keys:
+            context.pop(key, None)
+        self._own_versions = {own for own in self._own_versions if version is None or own > version}
+        self._skip_own_versions()
+        logger.debug("Context loaded at version %s: %s", self.version, self.context)
+        return "full"
+
+    def _invalidate_cache(self, version):
+        # Any cached key may have changed in the versions we missed, so all
+        # of them are dropped, except for unsaved local changes
+        for key in [key for key in self.context if key not in self._dirty_keys]:
+            del self.context[key]
+        for key, (_, overrides) in self._fetches.items():
+            overrides[key] = _STALE
+        self.version = version
+        self._own_versions = {own for own in self._own_versions if version is None or own > version}
+        self._skip_own_versions()
+        self._cache_counts["invalidations"] += 1
+        logger.debug("Cache invalidated at version %s", self.version)
+
+    async def wait_for_reload(self):
+        await self._reloads.wait_idle()
+
+    def reload_stats(self):
+        return self._reloads.stats()
+
+    async def handle_update(self, message=None):
+        version = message.get("version") if message else None
+        if self.metrics.observers and message and "sent" in message:
+            # Publisher and subscriber clocks may differ by a few milliseconds
+            self.metrics.timing("contextd_notification_lag_seconds", max(0.0, time.time() - message["sent"]))
+        if version is not None and self.version is not None and version <= self.version:
+            logger.debug("Ignoring update for version %s, already at %s", version, self.version)
+            return
+        if version in self._own_versions:
+            logger.debug("Ignoring update for own version %s", version)
+            return
+        if version is None or "changed" not in message or self.version is None or version != self.version + 1:
+            # No delta to apply, or we missed a version in between
+            self.metrics.count("contextd_reloads_total")
+            self._reloads.schedule()
+            return
+        self._apply_delta(message)
+        self._skip_own_versions()
+        self.metrics.count("contextd_deltas_applied_total")
+        logger.debug("Applied update for version %s, changed keys: %s", version, list(message['changed']))
+
+    def _apply_delta(self, message):
+        changed, deleted = message["changed"], message["deleted"]
+        keys = (*changed, *deleted)
+        previous = {key: self.context.get(key, ABSENT) for key in keys}
+        for key, value in changed.items():
+            # A lazy instance only keeps the keys it has cached up to date
+            if not self.lazy or key in self.context:
+                self.context[key] = value
+        for key in deleted:
+            self.context.pop(key, None)
+        self._override_fetches(changed, deleted)
+        self._snapshot_keys.update(keys)
+        self.version = message["version"]
+        self._notify_remote(keys, previous, changed)
+
+    def _notify_remote(self, keys, previous, current=None):
+        # previous holds the values of keys before a remote change. Unsaved
+        # local changes were never reported, so their keys are compared with
+        # the values they replaced, and the remote values become the ones
+        # later local saves are reported against.
+        if self._committed_values:
+            previous = {**previous, **self._committed_values}
+            for key in self._committed_values.keys() & set(keys):
+                self._committed_values[key] = self.context.get(key, ABSENT)
+        if self.watchers.watching(self.context_key):
+            self.watchers.notify(self.context_key, keys, previous, self.context if current is None else current, self.version, local=False)
+
+    def _replay(self, messages):
+        # Applies change log messages in order. Returns False if one of them
+        # was a full rewrite, which needs a full load.
+        for message in messages:
+            if message["version"] <= self.version:
+                continue
+            if "changed" not in message:
+                return False
+            self._apply_delta(message)
+        self._own_versions = {own for own in self._own_versions if own > self.version}
+        self._skip_own_versions()
+        return True
+
+    async def _compact_periodically(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.storage.compact_change_log(self.context_key)
+            except Exception as error:
+                logger.warning(f"Compacting the change log of {self.context_key} failed: {error!r}")
 
     async def save_context(self):
-        logger.debug(f"Saving context: {self.context}")
-        await self.storage.save_context(self.context_key, self.context)
+        if self.lazy:
+            raise ValueError("save_context rewrites the whole context, which a lazy instance does not hold")
+        logger.debug("Saving context: %s", self.context)
+        started = self.metrics.start()
+        self.version = await self.storage.save_context(self.context_key, self.context)
+        self.metrics.elapsed("contextd_save_seconds", started, operation="save_context")
+        self._snapshot_keys.update(self._dirty_keys, self._deleted_keys)
+        self._dirty_keys.clear()
+        self._deleted_keys.clear()
+        self._notify_saved(list(self._committed_values))
         event_emitter.emit('context_updated', self.context)  # Emit the event using the global event emitter
         logger.debug("Context saved")
 
-    async def acquire_lock(self, lock_timeout=10000, retry_delay=0.1, max_retries=50):
-        logger.debug(f"Acquiring lock with key: {self.lock_key}")
-        for _ in range(max_retries):
-            lock_acquired = await self.storage.acquire_lock(self.lock_key, self.lock_value, lock_timeout)
-            if lock_acquired:
-                logger.debug("Lock acquired")
-                return True
-            await asyncio.sleep(retry_delay)
-        logger.debug("Failed to acquire lock")
-        return False
-
-    async def release_lock(self):
-        logger.debug(f"Releasing lock with key: {self.lock_key}")
-        await self.storage.release_lock(self.lock_key, self.lock_value)
-        logger.debug("Lock released")
+    async def save_changes(self, keys=None):
+        changed, deleted = self.pending_changes(keys)
+        logger.debug("Saving changed keys: %s, deleted keys: %s", list(changed), list(deleted))
+        fence = {name: self._fences[name] for name in self.lock_names(keys) if name in self._fences}
+        started = self.metrics.start()
+        try:
+            if fence:
+                version = await self.storage.save_keys(self.context_key, changed, deleted, self.context_for_write(), fence=fence)
+            else:
+                version = await self.storage.save_keys(self.context_key, changed, deleted, self.context_for_write())
+        except BaseException:
+            self.changes_failed(changed, deleted)
+            raise
+        self.metrics.elapsed("contextd_save_seconds", started, operation="save_keys")
+        self.changes_saved(changed, deleted, version)
+        logger.debug("Changes saved")
+
+    def pending_changes(self, keys=None):
+        # Only the given keys are flushed when set, so writers holding
+        # different key locks never persist each other's pending changes
+        dirty = self._dirty_keys if keys is None else self._dirty_keys.intersection(keys)
+        changed = {key: self.context[key] for key in dirty}
+        deleted = set(self._deleted_keys if keys is None else self._deleted_keys.intersection(keys))
+        return changed, deleted
+
+    def context_for_write(self):
+        # The full context passed along with locked writes, so that backends
+        # need not read it to rewrite it. None in lazy mode, where it is not
+        # resident, and in key and striped lock modes, where only the written
+        # keys are locked and the rest of the local copy may be stale.
+        return None if self.lazy or self.lock_mode != "context" else self.context
+
+    def changes_saved(self, changed, deleted, version):
+        self._advance_version(version)
+        self._snapshot_keys.update((*changed, *deleted))
+        self._dirty_keys.difference_update(changed)
+        self._deleted_keys.difference_update(deleted)
+        self._notify_saved([*changed, *deleted])
+        event_emitter.emit('context_updated', self.context)
+
+    def changes_failed(self, changed, deleted):
+        # Rolls back local changes whose save failed to the values the keys
+        # were last committed with, so the cache only holds what was stored
+        for key in (*changed, *deleted):
+            committed = self._committed_values.pop(key, ABSENT)
+            if committed is ABSENT:
+                # Absent, or in lazy mode possibly just not cached
+                self.context.pop(key, None)
+            else:
+                self.context[key] = committed
+            if key in self._fetches:
+                # A fetch in flight reads the stored value, but must not cache it
+                self._fetches[key][1][key] = _STALE
+        self._dirty_keys.difference_update(changed)
+        self._deleted_keys.difference_update(deleted)
+
+    def _notify_saved(self, keys):
+        # Reports local changes once they are saved, against the values the
+        # keys had before they were first changed locally
+        old = {key: self._committed_values.pop(key, ABSENT) for key in keys}
+        if self.watchers.watching(self.context_key):
+            self.watchers.notify(self.context_key, old, old, self.context, self.version, local=True)
+
+    def _advance_version(self, version):
+        if version is None:
+            self.version = None
+        elif not self.storage.field_level:
+            # The write replaced the stored context with our local copy
+            self.version = version
+        elif self.version is not None:
+            if version <= self.version + 1:
+                # The notification for this write may already have been applied
+                self.version = max(self.version, version)
+            else:
+                # Other writers committed versions we have not seen yet; their
+                # deltas arrive as notifications and ours is skipped then
+                self._own_versions.add(version)
+
+    def _skip_own_versions(self):
+        while self.version is not None and self.version + 1 in self._own_versions:
+            self.version += 1
+            self._own_versions.discard(self.version)
+
+    def apply_changes(self, operations, deletions=()):
+        # Changes the cached context only; save_changes persists it
+        for key, value in operations.items():
+            self._set_key(key, value)
+        for key in deletions:
+            self._delete_key(key)
+
+    def _set_key(self, key: str, value):
+        self._committed_values.setdefault(key, self.context.get(key, ABSENT))
+        self.context[key] = value
+        self._override_fetches({key: value}, ())
+        self._dirty_keys.add(key)
+        self._deleted_keys.discard(key)
+
+    def _delete_key(self, key: str):
+        self._committed_values.setdefault(key, self.context.get(key, ABSENT))
+        self.context.pop(key, None)
+        self._override_fetches({}, (key,))
+        self._deleted_keys.add(key)
+        self._dirty_keys.discard(key)
+
+    def lock_names(self, keys=None):
+        # Lock names are sorted so that writers taking several locks always
+        # take them in the same order and cannot deadlock each other
+        if self.lock_mode == "context" or keys is None:
+            return [self.lock_key]
+        if self.lock_mode == "key":
+            names = {f"{self.lock_key}:{key}" for key in keys}
+        else:
+            names = {f"{self.lock_key}:{zlib.crc32(key.encode('utf-8')) % self.lock_stripes}" for key in keys}
+        return sorted(names)
+
+    def flush_scope(self, keys):
+        return None if self.lock_mode == "context" else keys
+
+    async def acquire_lock(self, lock_timeout=10000, retry_delay=None, max_retries=None, key=None):
+        wait = None
+        if retry_delay is not None or max_retries is not None:
+            wait = FixedDelay(0.1 if retry_delay is None else retry_delay, 50 if max_retries is None else max_retries)
+        return await self._acquire_locks(self.lock_names(None if key is None else [key]), lock_timeout, wait)
+
+    async def release_lock(self, key=None):
+        await self._release_locks(self.lock_names(None if key is None else [key]))
+
+    async def _acquire_locks(self, lock_names, lock_timeout=10000, wait=None):
+        acquired = []
+        for lock_name in lock_names:
+            logger.debug("Acquiring lock with key: %s", lock_name)
+            started = self.metrics.start()
+            if self.fair_locks:
+                # Only the longest waiting local coroutine competes for the lock
+                queue = self._local_lock_queues.setdefault(lock_name, asyncio.Lock())
+                async with queue:
+                    lock_acquired = await self._acquire_one(lock_name, lock_timeout, wait or self.lock_wait)
+            else:
+                lock_acquired = await self._acquire_one(lock_name, lock_timeout, wait or self.lock_wait)
+            self.metrics.elapsed("contextd_lock_wait_seconds", started, acquired=str(bool(lock_acquired)).lower())
+            if not lock_acquired:
+                logger.debug("Failed to acquire lock")
+                await self._release_locks(acquired)
+                return False
+            logger.debug("Lock acquired")
+            acquired.append(lock_name)
+            self._hold_lease(lock_name, lock_acquired, lock_timeout)
+            if started is not None:
+                self._held_since[lock_name] = self.metrics.start()
+        return True
+
+    def _hold_lease(self, lock_name, token, lock_timeout):
+        # Backends return a fencing token from acquire_lock; True means the
+        # backend does not fence
+        if type(token) is int:
+            self._fences[lock_name] = token
+        if self.renew_leases:
+            self._renewals[lock_name] = asyncio.create_task(self._renew_lease(lock_name, lock_timeout))
+
+    async def _renew_lease(self, lock_name, lock_timeout):
+        # Renews well before the lease runs out, so a long transaction keeps
+        # its lock while a crashed holder's lock expires after lock_timeout
+        while True:
+            await asyncio.sleep(lock_timeout / 3000)
+            try:
+                renewed = await self.storage.renew_lock(lock_name, self.lock_value, lock_timeout)
+            except Exception as error:
+                logger.warning(f"Renewing the lease on {lock_name} failed: {error!r}")
+                continue
+            if not renewed:
+                # A fenced write with the old token will be rejected
+                logger.warning(f"Lost the lease on {lock_name}")
+                return
+
+    async def _acquire_one(self, lock_name, lock_timeout, wait):
+        acquire = self.storage.acquire_lock_fair if self.fair_locks else self.storage.acquire_lock
+        released = self._lock_released.setdefault(lock_name, asyncio.Event()) if self.lock_wakeups else None
+        delays = wait.delays()
+        while True:
+            if released is not None:
+                # Cleared before the attempt so a release that happens between
+                # a failed attempt and the wait still wakes us up
+                released.clear()
+            self.metrics.count("contextd_lock_attempts_total")
+            token = await acquire(lock_name, self.lock_value, lock_timeout)
+            if token:
+                return token
+            delay = next(delays, None)
+            if delay is None:
+                if self.fair_locks:
+                    await self.storage.leave_lock_queue(lock_name, self.lock_value)
+                return False
+            if released is None:
+                await asyncio.sleep(delay)
+            else:
+                # The delay still bounds the wait in case a release message is lost
+                try:
+                    await asyncio.wait_for(released.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release_locks(self, lock_names):
+        for lock_name in reversed(lock_names):
+            logger.debug("Releasing lock with key: %s", lock_name)
+            renewal = self._renewals.pop(lock_name, None)
+            if renewal is not None:
+                renewal.cancel()
+            self._fences.pop(lock_name, None)
+            await self.storage.release_lock(lock_name, self.lock_value)
+            self.metrics.elapsed("contextd_lock_hold_seconds", self._held_since.pop(lock_name, None))
+            if self.lock_wakeups:
+                self._wake_lock_waiters(lock_name)
+                await self.storage.publish_update(self.lock_channel, {"released": lock_name})
+            logger.debug("Lock released")
+
+    async def handle_lock_event(self, message=None):
+        if message and "released" in message:
+            self._wake_lock_waiters(message["released"])
+
+    def _wake_lock_waiters(self, lock_name):
+        released = self._lock_released.get(lock_name)
+        if released is not None:
+            released.set()
 
     async def update_context(self, key: str, value):
-        logger.debug(f"Updating context key: {key} with value: {value}")
-        if await self.acquire_lock():
+        logger.debug("Updating context key: %s with value: %s", key, value)
+        started = self.metrics.start()
+        await self._submit({key: value}, ())
+        self.metrics.elapsed("contextd_update_seconds", started, operation="update_context")
+
+    async def transactional_update(self, operations, deletions=()):
+        logger.debug("Performing transactional update with operations: %s, deletions: %s", operations, deletions)
+        started = self.metrics.start()
+        await self._submit(operations, deletions)
+        self.metrics.elapsed("contextd_update_seconds", started, operation="transactional_update")
+
+    async def _submit(self, operations, deletions):
+        # With group commit, concurrent updates are merged into one commit
+        # and this returns once the commit holding the update is saved
+        if self._group_commit is not None:
+            await self._group_commit.submit(operations, deletions)
+        else:
+            await self._commit(operations, deletions)
+
+    async def _commit(self, operations, deletions):
+        if self.write_mode == "optimistic":
+            await self._optimistic_update(operations, deletions)
+            return
+        keys = [*operations, *deletions]
+        lock_names = self.lock_names(keys)
+        if await self._acquire_locks(lock_names):
             try:
-                self.context[key] = value
-                await self.save_context()
+                self.apply_changes(operations, deletions)
+                await self.save_changes(self.flush_scope(keys))
             finally:
-                await self.release_lock()
+                await self._release_locks(lock_names)
         else:
             logger.error("Failed to acquire lock for updating context")
             raise Exception("Failed to acquire lock for updating context")
 
-    async def transactional_update(self, operations):
-        logger.debug(f"Performing transactional update with operations: {operations}")
-        if await self.acquire_lock():
-            try:
-                for key, value in operations.items():
-                    self.context[key] = value
-                await self.save_context()
-            finally:
-                await self.release_lock()
-        else:
-            logger.error("Failed to acquire lock for transactional update")
-            raise Exception("Failed to acquire lock for transactional update")
+    def group_commit_stats(self):
+        return self._group_commit.stats() if self._group_commit is not None else None
+
+    async def _optimistic_update(self, operations, deletions):
+        # Apply the change to the cached context and commit it only if the
+        # stored version is still the one the cache reflects. On a conflict
+        # the context is refreshed after a backoff delay, so that contending
+        # writers spread out, and the change applied again.
+        keys = [*operations, *deletions]
+        try:
+            await self._optimistic_attempts(keys, operations, deletions)
+        except BaseException:
+            self.changes_failed(self._dirty_keys.intersection(keys), self._deleted_keys.intersection(keys))
+            raise
+
+    async def _optimistic_attempts(self, keys, operations, deletions):
+        delays = self.write_backoff.delays()
+        for attempt in range(self.max_write_retries):
+            if self.version is None:
+                await self.load_context()
+            expected_version = self.version
+            self.apply_changes(operations, deletions)
+            changed = {key: self.context[key] for key in self._dirty_keys.intersection(keys)}
+            deleted = self._deleted_keys.intersection(keys)
+            started = self.metrics.start()
+            # The write only commits against the version the context was read
+            # at, so the full local copy is safe to pass in any lock mode
+            version = await self.storage.compare_and_save(self.context_key, changed, deleted, expected_version, None if self.lazy else self.context)
+            self.metrics.elapsed("contextd_save_seconds", started, operation="compare_and_save")
+            if version is not None:
+                self.version = version
+                self._snapshot_keys.update((*changed, *deleted))
+                self._dirty_keys.difference_update(changed)
+                self._deleted_keys.difference_update(deleted)
+                self._notify_saved([*changed, *deleted])
+                event_emitter.emit('context_updated', self.context)
+                logger.debug("Committed version %s", version)
+                return
+            logger.debug("Version conflict on version %s, refreshing context", expected_version)
+            self.metrics.count("contextd_write_conflicts_total")
+            delay = next(delays, None)
+            if delay is None or attempt + 1 == self.max_write_retries:
+                break
+            await asyncio.sleep(delay)
+            await self.load_context()
+        logger.error("Failed to commit update due to repeated version conflicts")
+        raise Exception("Failed to commit update due to repeated version conflicts")
+
+    async def apply_atomic(self, operations):
+        # Runs (name, path, argument) operations (see common.operations) in
+        # the backend, in order and atomically, without taking a lock. Other
+        # instances receive the outcome as a delta. Returns the result of
+        # every operation. A locked write of a key that read the key before an
+        # atomic operation changed it still overwrites that change.
+        operations = [operation(*op) for op in operations]
+        logger.debug("Applying atomic operations: %s", operations)
+        started = self.metrics.start()
+        version, results, changed, deleted = await self.storage.apply_operations(self.context_key, operations)
+        self.metrics.elapsed("contextd_atomic_seconds", started)
+        if changed or deleted:
+            self._atomic_applied(changed, deleted, version)
+        return results
+
+    def _atomic_applied(self, changed, deleted, version):
+        for key in (*changed, *deleted):
+            self._committed_values.setdefault(key, self.context.get(key, ABSENT))
+        for key, value in changed.items():
+            self.context[key] = value
+        for key in deleted:
+            self.context.pop(key, None)
+        self._snapshot_keys.update((*changed, *deleted))
+        self._override_fetches(changed, deleted)
+        if self.version is None or (version is not None and version > self.version + 1):
+            # Versions of other writers we have not seen yet come first. This
+            # delta is not skipped as one of our own versions, so it is
+            # applied again after theirs when its notification arrives.
+            self._dirty_keys.difference_update(changed)
+            self._deleted_keys.difference_update(deleted)
+            self._notify_saved([*changed, *deleted])
+            event_emitter.emit('context_updated', self.context)
+            return
+        self.changes_saved(changed, deleted, version)
+
+    async def increment(self, path, amount=1):
+        # Returns the new value; a missing value counts as 0
+        return (await self.apply_atomic([("increment", path, amount)]))[0]
+
+    async def append(self, path, value):
+        # Returns the new length of the list
+        return (await self.apply_atomic([("append", path, value)]))[0]
+
+    async def merge(self, path, values: dict):
+        # Returns the merged dict
+        return (await self.apply_atomic([("merge", path, values)]))[0]
+
+    async def set_if_absent(self, path, value):
+        # Returns whether the value was set
+        return (await self.apply_atomic([("set_if_absent", path, value)]))[0]
+
+    async def set_path(self, path, value):
+        await self.apply_atomic([("set", path, value)])
+
+    async def delete(self, path):
+        # Returns whether the key existed
+        return (await self.apply_atomic([("delete", path)]))[0]
+
+    def watch(self, key_or_prefix: str, callback):
+        # Calls callback with a common.watch.KeyChange whenever the key, or a
+        # key starting with the prefix if the pattern ends in "*", changes
+        # locally or remotely. Returns a handle whose cancel() stops it.
+        return self.watchers.watch(self.context_key, key_or_prefix, callback)
+
+    async def get(self, key: str, default=None):
+        # Returns the value of one key, fetching it first in lazy mode if it
+        # is not cached
+        if not self.lazy:
+            return self.context.get(key, default)
+        return (await self._load_keys([key])).get(key, default)
+
+    async def get_many(self, keys) -> dict:
+        # Returns {key: value} for the given keys that exist, fetching the
+        # ones that are not cached in one round trip
+        if not self.lazy:
+            return {key: self.context[key] for key in keys if key in self.context}
+        return await self._load_keys(list(dict.fromkeys(keys)))
+
+    async def prefetch(self, keys):
+        # Caches the given keys ahead of their use, in one round trip
+        if self.lazy:
+            await self._load_keys(list(dict.fromkeys(keys)))
+
+    async def _load_keys(self, keys):
+        values, missing = {}, []
+        for key in keys:
+            if key in self.context:
+                values[key] = self.context[key]
+            elif key not in self._deleted_keys:
+                missing.append(key)
+        self._cache_counts["hits"] += len(values)
+        if not missing:
+            return values
+        self._cache_counts["misses"] += len(missing)
+        # Keys another call is already fetching are not fetched again
+        new = [key for key in missing if key not in self._fetches]
+        if new:
+            overrides = {}
+            task = asyncio.ensure_future(self._fetch(new, overrides))
+            for key in new:
+                self._fetches[key] = (task, overrides)
+        for task in {self._fetches[key][0] for key in missing}:
+            # One caller giving up does not cancel a fetch others wait for
+            fetched = await asyncio.shield(task)
+            values.update((key, fetched[key]) for key in missing if key in fetched)
+        for key in missing:
+            # Local changes made while waiting are newer than the fetch
+            if key in self.context:
+                values[key] = self.context[key]
+            elif key in self._deleted_keys:
+                values.pop(key, None)
+        return values
+
+    async def _fetch(self, keys, overrides):
+        # Changes applied while the fetch is in flight are newer than what it
+        # reads; they are recorded in overrides and take precedence
+        started = self.metrics.start()
+        try:
+            fetched, _ = await self.storage.load_keys(self.context_key, keys)
+        finally:
+            for key in keys:
+                if self._fetches.get(key, (None, None))[1] is overrides:
+                    del self._fetches[key]
+        self.metrics.elapsed("contextd_fetch_seconds", started)
+        self.metrics.value("contextd_fetch_keys", len(keys))
+        self._cache_counts["fetches"] += 1
+        values = {}
+        for key in keys:
+            value = overrides.get(key, fetched.get(key, ABSENT))
+            if value is _STALE:
+                value = fetched.get(key, ABSENT)
+            elif value is not ABSENT and key not in self.context and key not in self._deleted_keys:
+                self.context[key] = value
+            if value is not ABSENT:
+                values[key] = value
+        return values
+
+    def _override_fetches(self, changed, deleted):
+        if not self._fetches:
+            return
+        for key, value in changed.items():
+            if key in self._fetches:
+                self._fetches[key][1][key] = value
+        for key in deleted:
+            if key in self._fetches:
+                self._fetches[key][1][key] = ABSENT
+
+    def cache_stats(self):
+        # Counts of the lazy mode cache, None if the instance is not lazy
+        if not self.lazy:
+            return None
+        return {**self.context.stats(), **self._cache_counts, "fetching": len(self._fetches)}
+
+    async def get_lazy_context(self, prefetch=()):
+        # Returns a common.lazy.LazyContext, whose reads fetch keys that are
+        # not cached, after fetching the keys in prefetch in one round trip.
+        # Works on any instance; without lazy mode every key is resident.
+        if prefetch:
+            await self.prefetch(prefetch)
+        return LazyContext(self)
+
+    def _committed_items(self, keys):
+        # The committed values of keys: unsaved local changes are replaced by
+        # the values they were made to, and keys without one are left out
+        for key in keys:
+            if key in self._dirty_keys or key in self._deleted_keys:
+                value = self._committed_values.get(key, ABSENT)
+            else:
+                value = self.context.get(key, ABSENT)
+            if value is not ABSENT:
+                yield key, value
 
     def get_context(self):
-        logger.debug(f"Getting context: {self.context}")
-        return self.context
\ No newline at end of file
+        # Returns an immutable common.pmap.Snapshot of the committed context
+        # at snapshot.version, without unsaved local changes. Later changes derive new snapshots that share the
+        # unchanged keys, so a snapshot can be held and read without copying
+        # or locking. Values are frozen copies (see common.pmap.freeze), so
+        # mutating them raises instead of changing the context.
+        if self.lazy:
+            raise ValueError("A lazy instance does not hold the whole context, use get_lazy_context")
+        if self.context is not self._snapshot_source:
+            # The context was replaced, e.g. by initialize or a full reload
+            unsaved = self._dirty_keys | self._deleted_keys
+            committed = {key: value for key, value in self.context.items() if key not in unsaved}
+            committed.update(self._committed_items(unsaved))
+            self._snapshot = Snapshot(committed, self.version)
+            self._snapshot_source = self.context
+            self._snapshot_keys.clear()
+        elif self._snapshot_keys or self._snapshot.version != self.version:
+            keys, self._snapshot_keys = self._snapshot_keys, set()
+            changed = dict(self._committed_items(keys))
+            deleted = [key for key in keys if key not in changed]
+            self._snapshot = self._snapshot.evolve(changed, deleted, self.version)
+        logger.debug("Getting context at version %s", self.version)
+        return self._snapshot
\ No newline at end of file
@@ -0,0 +1,246 @@
+import time
+import uuid
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from backends.base import StorageBackend
+from common.logger import configure_logging
+from common.lock_wait import FixedDelay
+from common.watch import Watchers
+from context import Contextd
+
+# Configure the logger
+logger = configure_logging()
+
+class ContextRegistry:
+    # Holds Contextd instances for many context keys on top of one shared
+    # storage backend, so they share its connection pool and its single
+    # pub/sub connection. Contexts are created on first use and evicted when
+    # there are more than max_active of them or when they have been idle for
+    # idle_timeout seconds.
+    def __init__(self, storage_backend: StorageBackend, max_active=None, idle_timeout=None, **context_options):
+        self.storage = storage_backend
+        self.max_active = max_active
+        self.idle_timeout = idle_timeout
+        # Watches live here rather than on the contexts, so they survive
+        # eviction and apply again when a context is loaded later
+        self.watchers = context_options.pop("watchers", None) or Watchers()
+        self.context_options = context_options
+        self._contexts = OrderedDict()  # context key -> Contextd, least recently used first
+        self._last_used = {}
+        self._pins = {}
+        self._creating = {}
+        self.stats = {"created": 0, "evicted": 0, "hits": 0}
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def __contains__(self, context_key: str):
+        return context_key in self._contexts
+
+    async def get(self, context_key: str) -> Contextd:
+        # Returns the initialized Contextd for context_key, creating it if needed
+        contextd = self._contexts.get(context_key)
+        if contextd is not None:
+            self.stats["hits"] += 1
+        else:
+            creating = self._creating.get(context_key)
+            if creating is None:
+                creating = asyncio.ensure_future(self._create(context_key))
+                self._creating[context_key] = creating
+                creating.add_done_callback(lambda _: self._creating.pop(context_key, None))
+            contextd = await asyncio.shield(creating)
+        self._touch(context_key)
+        await self._evict_surplus()
+        return contextd
+
+    async def get_many(self, context_keys) -> dict:
+        # Returns {context_key: Contextd}. Contexts that are not loaded yet
+        # are read from the backend in one batch.
+        context_keys = list(dict.fromkeys(context_keys))
+        missing = [key for key in context_keys if key not in self._contexts and key not in self._creating]
+        if missing:
+            batch = asyncio.ensure_future(self._create_many(missing))
+            for context_key in missing:
+                creating = asyncio.ensure_future(self._from_batch(batch, context_key))
+                self._creating[context_key] = creating
+                creating.add_done_callback(lambda _, context_key=context_key: self._creating.pop(context_key, None))
+        contexts = {}
+        for context_key in context_keys:
+            contextd = self._contexts.get(context_key)
+            if contextd is None:
+                contextd = await asyncio.shield(self._creating[context_key])
+            elif context_key not in missing:
+                self.stats["hits"] += 1
+            contexts[context_key] = contextd
+            self._touch(context_key)
+        await self._evict_surplus(keep=contexts)
+        return contexts
+
+    def watch(self, context_key: str, key_or_prefix: str, callback):
+        # Like Contextd.watch, for a context that does not need to be loaded
+        return self.watchers.watch(context_key, key_or_prefix, callback)
+
+    async def update_many(self, updates: dict, deletions: dict = None, lock_timeout=10000):
+        # Applies {context_key: operations} and {context_key: keys to delete}
+        # like transactional_update on each context, but takes all locks in
+        # one batch and writes all contexts with one backend call, fenced
+        # with the tokens of the batch's locks.
+        deletions = deletions or {}
+        context_keys = list(dict.fromkeys([*updates, *deletions]))
+        contexts = await self.get_many(context_keys)
+        if self.context_options.get("write_mode") == "optimistic" or self.context_options.get("fair_locks"):
+            # Fair locks are granted in arrival order one lock at a time,
+            # which a batch acquisition would bypass
+            await asyncio.gather(*(
+                contexts[key].transactional_update(updates.get(key, {}), deletions.get(key, ()))
+                for key in context_keys
+            ))
+            return
+        context_locks = {key: contexts[key].lock_names([*updates.get(key, {}), *deletions.get(key, ())]) for key in context_keys}
+        lock_names = sorted({name for key in context_keys for name in context_locks[key]})
+        lock_value = str(uuid.uuid4())
+        tokens = await self._acquire_batch(lock_names, lock_value, lock_timeout)
+        if tokens is None:
+            logger.error("Failed to acquire locks for bulk update")
+            raise Exception("Failed to acquire locks for bulk update")
+        renewal = None
+        if self.context_options.get("renew_leases", True):
+            renewal = asyncio.create_task(self._renew_batch(lock_names, lock_value, lock_timeout))
+        try:
+            changes = {}
+            fences = {}
+            for key in context_keys:
+                contextd = contexts[key]
+                keys = [*updates.get(key, {}), *deletions.get(key, ())]
+                contextd.apply_changes(updates.get(key, {}), deletions.get(key, ()))
+                changed, deleted = contextd.pending_changes(contextd.flush_scope(keys))
+                changes[key] = (changed, deleted, contextd.context_for_write())
+                # Backends that do not fence return True instead of a token
+                fences[key] = {name: tokens[name] for name in context_locks[key] if type(tokens[name]) is int}
+            try:
+                versions = await self.storage.save_many(changes, fences)
+            except BaseException:
+                for key, (changed, deleted, _) in changes.items():
+                    contexts[key].changes_failed(changed, deleted)
+                raise
+            for key, (changed, deleted, _) in changes.items():
+                contexts[key].changes_saved(changed, deleted, versions.get(key))
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+            await self.storage.release_locks(lock_names, lock_value)
+            for key in context_keys:
+                contextd = contexts[key]
+                if contextd.lock_wakeups:
+                    for lock_name in context_locks[key]:
+                        await self.storage.publish_update(contextd.lock_channel, {"released": lock_name})
+
+    async def _acquire_batch(self, lock_names, lock_value, lock_timeout):
+        # Returns {lock name: fencing token}, or None if the locks stayed taken
+        delays = (self.context_options.get("lock_wait") or FixedDelay()).delays()
+        while True:
+            tokens = await self.storage.acquire_locks(lock_names, lock_value, lock_timeout)
+            if tokens is not False:
+                return tokens
+            delay = next(delays, None)
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+
+    async def _renew_batch(self, lock_names, lock_value, lock_timeout):
+        # Like Contextd._renew_lease, for the locks of a bulk update
+        held = list(lock_names)
+        while held:
+            await asyncio.sleep(lock_timeout / 3000)
+            for lock_name in list(held):
+                try:
+                    renewed = await self.storage.renew_lock(lock_name, lock_value, lock_timeout)
+                except Exception as error:
+                    logger.warning(f"Renewing the lease on {lock_name} failed: {error!r}")
+                    continue
+                if not renewed:
+                    # The fenced write with the old token will be rejected
+                    logger.warning(f"Lost the lease on {lock_name}")
+                    held.remove(lock_name)
+
+    @asynccontextmanager
+    async def use(self, context_key: str):
+        # Like get, but the context is not evicted while the block runs
+        contextd = await self.get(context_key)
+        self._pins[context_key] = self._pins.get(context_key, 0) + 1
+        try:
+            yield contextd
+        finally:
+            self._pins[context_key] -= 1
+            if not self._pins[context_key]:
+                del self._pins[context_key]
+            self._touch(context_key)
+
+    async def _create(self, context_key: str) -> Contextd:
+        contextd = Contextd(context_key, self.storage, watchers=self.watchers, **self.context_options)
+        await contextd.initialize()
+        self._contexts[context_key] = contextd
+        # Waiters of the creation touch it later; until then it counts as just used
+        self._touch(context_key)
+        self.stats["created"] += 1
+        logger.debug("Created context %s", context_key)
+        return contextd
+
+    async def _create_many(self, context_keys) -> dict:
+        # Lazy contexts read only their versions, so they are not bulk loaded
+        lazy = self.context_options.get("lazy")
+        states = {} if lazy else await self.storage.load_many(context_keys)
+        contexts = {}
+        for context_key in context_keys:
+            contexts[context_key] = Contextd(context_key, self.storage, watchers=self.watchers, **self.context_options)
+        await asyncio.gather(*(
+            contextd.initialize(states.get(context_key)) for context_key, contextd in contexts.items()
+        ))
+        self._contexts.update(contexts)
+        for context_key in contexts:
+            self._touch(context_key)
+        self.stats["created"] += len(contexts)
+        logger.debug("Created %s contexts", len(contexts))
+        return contexts
+
+    @staticmethod
+    async def _from_batch(batch, context_key: str) -> Contextd:
+        return (await asyncio.shield(batch))[context_key]
+
+    def _touch(self, context_key: str):
+        if context_key in self._contexts:
+            self._contexts.move_to_end(context_key)
+            self._last_used[context_key] = time.monotonic()
+
+    async def _evict_surplus(self, keep=()):
+        # The least recently used contexts come first, so stop at the first
+        # one that is still needed
+        now = time.monotonic()
+        for context_key in list(self._contexts):
+            if context_key in keep:
+                continue
+            over_limit = self.max_active is not None and len(self._contexts) > self.max_active
+            idle = self.idle_timeout is not None and now - self._last_used[context_key] > self.idle_timeout
+            if not (over_limit or idle):
+                break
+            if context_key not in self._pins:
+                await self.evict(context_key)
+
+    async def evict(self, context_key: str):
+        contextd = self._contexts.pop(context_key, None)
+        if contextd is None:
+            return False
+        self._last_used.pop(context_key, None)
+        await contextd.close()
+        self.stats["evicted"] += 1
+        logger.debug("Evicted context %s", context_key)
+        return True
+
+    async def evict_idle(self):
+        # Evicts idle contexts without waiting for the next get
+        await self._evict_surplus()
+
+    async def close(self):
+        for context_key in list(self._contexts):
+            await self.evict(context_key)
@@ -0,0 +1,49 @@
+import unittest
+from common.codec import Codec, msgpack, orjson, zstandard
+
+CONTEXT = {"user": {"name": "John Doe", "tags": ["a", "b"] * 200}, "count": 3, "ratio": 0.5, "active": True, "none": None}
+
+class TestCodec(unittest.TestCase):
+    def test_plain_json_has_no_header(self):
+        encoded = Codec().encode(CONTEXT)
+        self.assertEqual(encoded[:1], b"{")
+        self.assertEqual(Codec().decode(encoded), CONTEXT)
+
+    def test_decodes_legacy_json_strings(self):
+        self.assertEqual(Codec("json", "zlib").decode('{"key": "value"}'), {"key": "value"})
+
+    def test_compresses_above_threshold_only(self):
+        codec = Codec("json", "zlib", compress_threshold=100)
+        small = codec.encode({"key": "value"})
+        large = codec.encode(CONTEXT)
+        self.assertEqual(small[:1], b"{")
+        self.assertLess(len(large), len(Codec().encode(CONTEXT)))
+        self.assertEqual(codec.decode(large), CONTEXT)
+
+    def test_any_codec_decodes_any_format(self):
+        encoders = ["json"] + (["orjson"] if orjson else []) + (["msgpack"] if msgpack else [])
+        compressions = [None, "zlib"] + (["zstd"] if zstandard else [])
+        reader = Codec()
+        for encoder in encoders:
+            for compression in compressions:
+                with self.subTest(encoder=encoder, compression=compression):
+                    encoded = Codec(encoder, compression, compress_threshold=0).encode(CONTEXT)
+                    self.assertEqual(reader.decode(encoded), CONTEXT)
+
+    def test_json_round_trips_big_ints_and_non_finite_floats(self):
+        value = {"big": 2 ** 70, "negative": -(2 ** 64) - 1, "nan": float("nan"), "inf": float("inf"), "ninf": float("-inf")}
+        for compression in (None, "zlib"):
+            with self.subTest(compression=compression):
+                codec = Codec("json", compression, compress_threshold=0)
+                decoded = codec.decode(codec.encode(value))
+                self.assertEqual((2 ** 70, -(2 ** 64) - 1), (decoded["big"], decoded["negative"]))
+                self.assertIsInstance(decoded["big"], int)
+                self.assertNotEqual(decoded["nan"], decoded["nan"])
+                self.assertEqual((float("inf"), float("-inf")), (decoded["inf"], decoded["ninf"]))
+
+    def test_rejects_unknown_encoder(self):
+        with self.assertRaises(ValueError):
+            Codec("pickle")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,12 @@
 import unittest
 import asyncio
 from contextlib import ExitStack
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, patch
 from testcontainers.mongodb import MongoDbContainer
+from backends.base import LockLostError
 from backends.mongodb_backend import MongoDBBackend
 from context import Contextd
+from common.lock_wait import FixedDelay, ExponentialBackoff
 
 class TestContextd(unittest.TestCase):
     def setUp(self):
@@ -12,6 +14,7 @@ class TestContextd(unittest.TestCase):
         self.mongodb_container = self.stack.enter_context(MongoDbContainer())
         self.mongo_uri = self.mongodb_container.get_connection_url()
         self.storage_backend = Mock(spec=MongoDBBackend)
+        self.storage_backend.changes_since.return_value = None  # No change log
         self.context_key = "test_context"
         self.contextd = Contextd(self.context_key, self.storage_backend)
 
@@ -20,26 +23,160 @@ class TestContextd(unittest.TestCase):
 
     def test_initialize(self):
         async def run_test():
+            self.storage_backend.load_versioned.return_value = ({"key": "value"}, 3)
             await self.contextd.initialize()
-            self.storage_backend.load_context.assert_awaited_with(self.context_key)
-            self.storage_backend.subscribe_to_updates.assert_awaited_with(self.context_key, self.contextd.load_context)
+            self.storage_backend.load_versioned.assert_awaited_with(self.context_key)
+            self.assertEqual(self.contextd.version, 3)
+            self.storage_backend.subscribe_to_updates.assert_awaited_with(self.context_key, self.contextd.handle_update)
 
         asyncio.run(run_test())
 
     def test_load_context(self):
         async def run_test():
             context_data = {"key": "value"}
-            self.storage_backend.load_context.return_value = context_data
+            self.storage_backend.load_versioned.return_value = (context_data, 1)
             await self.contextd.load_context()
             self.assertEqual(self.contextd.context, context_data)
-            self.storage_backend.load_context.assert_awaited_with(self.context_key)
+            self.assertEqual(self.contextd.version, 1)
+            self.storage_backend.load_versioned.assert_awaited_with(self.context_key)
+
+        asyncio.run(run_test())
+
+    def test_load_context_skips_unchanged_version(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"key": "value"}, 4
+            self.storage_backend.get_version.return_value = 4
+            await self.contextd.load_context()
+            self.storage_backend.get_version.assert_awaited_with(self.context_key)
+            self.storage_backend.load_versioned.assert_not_awaited()
+
+        asyncio.run(run_test())
+
+    def test_own_write_advances_version(self):
+        async def run_test():
+            self.contextd.version = 4
+            self.storage_backend.acquire_lock.return_value = True
+            self.storage_backend.save_keys.return_value = 5
+            await self.contextd.update_context("key", "value")
+            self.assertEqual(self.contextd.version, 5)
+
+            # Another instance committed version 6 in between
+            self.storage_backend.save_keys.return_value = 7
+            await self.contextd.update_context("key", "value2")
+            self.assertEqual(self.contextd.version, 5)
+
+            # Our own notification is skipped, the missing delta fills the gap
+            await self.contextd.handle_update({"version": 7, "changed": {"key": "value2"}, "deleted": []})
+            await self.contextd.handle_update({"version": 6, "changed": {"other": 1}, "deleted": []})
+            self.assertEqual(self.contextd.version, 7)
+            self.assertEqual(self.contextd.context, {"key": "value2", "other": 1})
+            self.storage_backend.load_versioned.assert_not_awaited()
+
+        asyncio.run(run_test())
+
+    def test_handle_update_applies_delta(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"key1": "value1", "key2": "value2"}, 4
+            await self.contextd.handle_update({"version": 5, "changed": {"key1": "new"}, "deleted": ["key2"]})
+            self.assertEqual(self.contextd.context, {"key1": "new"})
+            self.assertEqual(self.contextd.version, 5)
+            self.storage_backend.get_version.assert_not_awaited()
+            self.storage_backend.load_versioned.assert_not_awaited()
+
+        asyncio.run(run_test())
+
+    def test_handle_update_ignores_applied_version(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"key": "value"}, 5
+            await self.contextd.handle_update({"version": 5, "changed": {"key": "stale"}, "deleted": []})
+            self.assertEqual(self.contextd.context, {"key": "value"})
+            self.storage_backend.load_versioned.assert_not_awaited()
+
+        asyncio.run(run_test())
+
+    def test_handle_update_reloads_on_version_gap(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"key": "value"}, 4
+            self.storage_backend.get_version.return_value = 6
+            self.storage_backend.load_versioned.return_value = ({"key": "latest"}, 6)
+            await self.contextd.handle_update({"version": 6, "changed": {"key": "partial"}, "deleted": []})
+            await self.contextd.wait_for_reload()
+            self.assertEqual(self.contextd.context, {"key": "latest"})
+            self.assertEqual(self.contextd.version, 6)
+
+        asyncio.run(run_test())
+
+    def test_version_gap_catches_up_from_change_log(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"key": "value", "old": 1}, 4
+            self.storage_backend.changes_since.return_value = [
+                {"version": 5, "changed": {"key": "v5"}, "deleted": ["old"]},
+                {"version": 6, "changed": {"new": True}, "deleted": []}
+            ]
+            await self.contextd.handle_update({"version": 6, "changed": {"new": True}, "deleted": []})
+            await self.contextd.wait_for_reload()
+            self.storage_backend.changes_since.assert_awaited_with(self.context_key, 4)
+            self.storage_backend.load_versioned.assert_not_awaited()
+            self.assertEqual(self.contextd.context, {"key": "v5", "new": True})
+            self.assertEqual(self.contextd.version, 6)
+
+        asyncio.run(run_test())
+
+    def test_trimmed_change_log_falls_back_to_full_load(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"key": "value"}, 4
+            self.storage_backend.changes_since.return_value = [{"version": 5}]
+            self.storage_backend.get_version.return_value = 5
+            self.storage_backend.load_versioned.return_value = ({"key": "latest"}, 5)
+            await self.contextd.load_context()
+            self.assertEqual(self.contextd.context, {"key": "latest"})
+
+        asyncio.run(run_test())
+
+    def test_handle_update_coalesces_reloads(self):
+        async def run_test():
+            self.contextd.version = 1
+            self.storage_backend.get_version.return_value = 200
+            self.storage_backend.load_versioned.return_value = ({"key": "latest"}, 200)
+            for _ in range(200):
+                await self.contextd.handle_update(None)
+            await self.contextd.wait_for_reload()
+            self.assertEqual(self.storage_backend.load_versioned.await_count, 1)
+            stats = self.contextd.reload_stats()
+            self.assertEqual(stats["requests"], 200)
+            self.assertEqual(stats["collapsed"], 199)
+            self.assertEqual(stats["runs"], 1)
+
+        asyncio.run(run_test())
+
+    def test_reload_requested_during_reload_runs_once_more(self):
+        async def run_test():
+            started = asyncio.Event()
+            release = asyncio.Event()
+
+            async def slow_load(context_key):
+                started.set()
+                await release.wait()
+                return {"key": "latest"}, 10
+
+            self.storage_backend.load_versioned.side_effect = slow_load
+            await self.contextd.handle_update(None)
+            await started.wait()
+            for _ in range(50):
+                await self.contextd.handle_update(None)
+            release.set()
+            await self.contextd.wait_for_reload()
+            self.assertEqual(self.contextd.reload_stats()["runs"], 2)
+            self.assertEqual(self.contextd.reload_stats()["collapsed"], 49)
 
         asyncio.run(run_test())
 
     def test_save_context(self):
         async def run_test():
             self.contextd.context = {"key": "value"}
+            self.storage_backend.save_context.return_value = 2
             await self.contextd.save_context()
+            self.assertEqual(self.contextd.version, 2)
             self.storage_backend.save_context.assert_awaited_with(self.context_key, self.contextd.context)
 
         asyncio.run(run_test())
@@ -65,7 +202,8 @@ class TestContextd(unittest.TestCase):
             self.storage_backend.acquire_lock.return_value = True
             await self.contextd.update_context("key", "value")
             self.assertEqual(self.contextd.context["key"], "value")
-            self.storage_backend.save_context.assert_awaited_with(self.context_key, self.contextd.context)
+            self.storage_backend.save_keys.assert_awaited_with(self.context_key, {"key": "value"}, set(), self.contextd.context)
+            self.storage_backend.save_context.assert_not_awaited()
             self.storage_backend.release_lock.assert_awaited_with(self.contextd.lock_key, self.contextd.lock_value)
 
         asyncio.run(run_test())
@@ -77,14 +215,329 @@ class TestContextd(unittest.TestCase):
             await self.contextd.transactional_update(operations)
             self.assertEqual(self.contextd.context["key1"], "value1")
             self.assertEqual(self.contextd.context["key2"], "value2")
-            self.storage_backend.save_context.assert_awaited_with(self.context_key, self.contextd.context)
+            self.storage_backend.save_keys.assert_awaited_with(self.context_key, operations, set(), self.contextd.context)
             self.storage_backend.release_lock.assert_awaited_with(self.contextd.lock_key, self.contextd.lock_value)
 
         asyncio.run(run_test())
 
+    def test_transactional_update_with_deletions(self):
+        async def run_test():
+            self.storage_backend.acquire_lock.return_value = True
+            self.contextd.context = {"key1": "value1", "key2": "value2"}
+            await self.contextd.transactional_update({"key3": "value3"}, deletions=["key1"])
+            self.assertEqual(self.contextd.context, {"key2": "value2", "key3": "value3"})
+            self.storage_backend.save_keys.assert_awaited_with(self.context_key, {"key3": "value3"}, {"key1"}, self.contextd.context)
+
+        asyncio.run(run_test())
+
+    def test_failed_save_rolls_back_the_change(self):
+        async def run_test():
+            self.contextd.context = {"key1": "old"}
+            self.storage_backend.acquire_lock.return_value = True
+            self.storage_backend.save_keys.side_effect = [ConnectionError, ConnectionError, None]
+            with self.assertRaises(ConnectionError):
+                await self.contextd.update_context("key1", "value1")
+            with self.assertRaises(ConnectionError):
+                await self.contextd.transactional_update({"key3": "value3"}, deletions=["key1"])
+            self.assertEqual(self.contextd.context, {"key1": "old"})
+            await self.contextd.update_context("key2", "value2")
+            self.storage_backend.save_keys.assert_awaited_with(
+                self.context_key, {"key2": "value2"}, set(), self.contextd.context
+            )
+
+        asyncio.run(run_test())
+
+    def test_full_reload_keeps_unsaved_changes(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"a": 1, "b": 2}, None
+            self.contextd.apply_changes({"a": 10}, deletions=["b"])
+            self.storage_backend.load_versioned.return_value = ({"a": 1, "b": 3, "c": 4}, 2)
+            await self.contextd.load_context()
+            self.assertEqual(self.contextd.context, {"a": 10, "c": 4})
+            self.assertEqual(self.contextd.pending_changes(), ({"a": 10}, {"b"}))
+
+        asyncio.run(run_test())
+
+    def test_key_lock_mode_locks_only_updated_key(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, lock_mode="key")
+            self.storage_backend.acquire_lock.return_value = True
+            await contextd.update_context("user", "value")
+            self.storage_backend.acquire_lock.assert_awaited_once_with(f"{contextd.lock_key}:user", contextd.lock_value, 10000)
+            self.storage_backend.release_lock.assert_awaited_once_with(f"{contextd.lock_key}:user", contextd.lock_value)
+            # Only the locked key is written, never the possibly stale rest of the context
+            self.storage_backend.save_keys.assert_awaited_once_with(self.context_key, {"user": "value"}, set(), None)
+
+        asyncio.run(run_test())
+
+    def test_transactional_update_takes_key_locks_in_order(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, lock_mode="key")
+            self.storage_backend.acquire_lock.return_value = True
+            await contextd.transactional_update({"b": 1, "a": 2}, deletions=["c"])
+            acquired = [call.args[0] for call in self.storage_backend.acquire_lock.await_args_list]
+            self.assertEqual(acquired, [f"{contextd.lock_key}:a", f"{contextd.lock_key}:b", f"{contextd.lock_key}:c"])
+
+        asyncio.run(run_test())
+
+    def test_striped_lock_mode_maps_keys_to_stripes(self):
+        contextd = Contextd(self.context_key, self.storage_backend, lock_mode="striped", lock_stripes=4)
+        names = contextd.lock_names([f"key{i}" for i in range(100)])
+        self.assertEqual(len(names), 4)
+        self.assertEqual(contextd.lock_names(["key1"]), contextd.lock_names(["key1"]))
+
+    def test_failed_lock_releases_acquired_locks(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, lock_mode="key", lock_wait=FixedDelay(0, 2))
+            self.storage_backend.acquire_lock.side_effect = lambda name, value, timeout: name.endswith(":a")
+            with self.assertRaises(Exception):
+                await contextd.transactional_update({"a": 1, "b": 2})
+            self.assertEqual(self.storage_backend.acquire_lock.await_count, 3)
+            self.storage_backend.release_lock.assert_awaited_once_with(f"{contextd.lock_key}:a", contextd.lock_value)
+
+        asyncio.run(run_test())
+
+    def test_key_lock_mode_requires_field_level_backend(self):
+        self.storage_backend.field_level = False
+        with self.assertRaises(ValueError):
+            Contextd(self.context_key, self.storage_backend, lock_mode="key")
+
+    def test_optimistic_update_commits_without_locks(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, write_mode="optimistic")
+            contextd.context, contextd.version = {"key": "value"}, 3
+            self.storage_backend.compare_and_save.return_value = 4
+            await contextd.update_context("key", "new")
+            self.storage_backend.compare_and_save.assert_awaited_once_with(self.context_key, {"key": "new"}, set(), 3, contextd.context)
+            self.storage_backend.acquire_lock.assert_not_awaited()
+            self.storage_backend.get_version.assert_not_awaited()
+            self.assertEqual(contextd.version, 4)
+
+        asyncio.run(run_test())
+
+    def test_optimistic_update_retries_on_conflict(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, write_mode="optimistic")
+            contextd.context, contextd.version = {"counter": 1}, 3
+            self.storage_backend.compare_and_save.side_effect = [None, 5]
+            self.storage_backend.get_version.return_value = 4
+            self.storage_backend.load_versioned.return_value = ({"counter": 1, "other": True}, 4)
+            await contextd.transactional_update({"counter": 2})
+            self.assertEqual(self.storage_backend.compare_and_save.await_args_list[1].args[3], 4)
+            self.assertEqual(contextd.context, {"counter": 2, "other": True})
+            self.assertEqual(contextd.version, 5)
+
+        asyncio.run(run_test())
+
+    def test_optimistic_update_gives_up_after_retries(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, write_mode="optimistic", max_write_retries=3)
+            contextd.version = 3
+            self.storage_backend.compare_and_save.return_value = None
+            self.storage_backend.get_version.return_value = 3
+            with self.assertRaises(Exception):
+                await contextd.update_context("key", "value")
+            self.assertEqual(self.storage_backend.compare_and_save.await_count, 3)
+
+        asyncio.run(run_test())
+
+    def test_optimistic_update_backs_off_between_conflicts(self):
+        async def run_test():
+            backoff = ExponentialBackoff(base_delay=0.001, jitter=False)
+            contextd = Contextd(self.context_key, self.storage_backend, write_mode="optimistic", max_write_retries=3, write_backoff=backoff)
+            contextd.version = 3
+            self.storage_backend.compare_and_save.return_value = None
+            self.storage_backend.load_versioned.return_value = ({}, 3)
+            with patch("context.asyncio.sleep", AsyncMock()) as sleep:
+                with self.assertRaises(Exception):
+                    await contextd.update_context("key", "value")
+            self.assertEqual([0.001, 0.002], [call.args[0] for call in sleep.await_args_list])
+
+        asyncio.run(run_test())
+
+    def test_acquire_lock_with_explicit_retries(self):
+        async def run_test():
+            self.storage_backend.acquire_lock.return_value = False
+            lock_acquired = await self.contextd.acquire_lock(retry_delay=0, max_retries=3)
+            self.assertFalse(lock_acquired)
+            self.assertEqual(self.storage_backend.acquire_lock.await_count, 3)
+
+        asyncio.run(run_test())
+
+    def test_exponential_backoff_respects_deadline(self):
+        delays = list(ExponentialBackoff(base_delay=0.001, max_delay=0.004, deadline=0.0).delays())
+        self.assertEqual(delays, [])
+        delays = ExponentialBackoff(base_delay=0.001, max_delay=0.004, deadline=10.0).delays()
+        first = [next(delays) for _ in range(5)]
+        self.assertTrue(all(0.0005 <= delay <= 0.004 for delay in first))
+        self.assertGreaterEqual(first[4], 0.002)
+
+    def test_lock_release_wakes_waiter(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, lock_wakeups=True, lock_wait=FixedDelay(60, 2))
+            attempts = iter([False, True])
+            self.storage_backend.acquire_lock.side_effect = lambda name, value, timeout: next(attempts)
+            waiter = asyncio.create_task(contextd.acquire_lock())
+            while self.storage_backend.acquire_lock.await_count < 1:
+                await asyncio.sleep(0)
+            await contextd.handle_lock_event({"released": contextd.lock_key})
+            self.assertTrue(await asyncio.wait_for(waiter, 1))
+
+        asyncio.run(run_test())
+
+    def test_release_lock_publishes_release(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, lock_wakeups=True)
+            await contextd.release_lock()
+            self.storage_backend.publish_update.assert_awaited_with(contextd.lock_channel, {"released": contextd.lock_key})
+
+        asyncio.run(run_test())
+
+    def test_lock_wakeups_need_a_publishing_backend(self):
+        self.storage_backend.supports_publish = False
+        with self.assertRaises(ValueError):
+            Contextd(self.context_key, self.storage_backend, lock_wakeups=True)
+
+    def test_fair_locks_use_waiter_queue(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, fair_locks=True, lock_wait=FixedDelay(0, 2))
+            self.storage_backend.acquire_lock_fair.return_value = False
+            self.assertFalse(await contextd.acquire_lock())
+            self.assertEqual(self.storage_backend.acquire_lock_fair.await_count, 2)
+            self.storage_backend.leave_lock_queue.assert_awaited_once_with(contextd.lock_key, contextd.lock_value)
+
+        asyncio.run(run_test())
+
+    def test_fenced_write_passes_lock_token(self):
+        async def run_test():
+            self.storage_backend.acquire_lock.return_value = 42
+            self.storage_backend.save_keys.return_value = 1
+            await self.contextd.update_context("key", "value")
+            self.storage_backend.save_keys.assert_awaited_with(
+                self.context_key, {"key": "value"}, set(), self.contextd.context, fence={self.contextd.lock_key: 42}
+            )
+            self.assertEqual(self.contextd._fences, {})
+
+        asyncio.run(run_test())
+
+    def test_lost_lock_rejects_write_and_releases(self):
+        async def run_test():
+            self.storage_backend.acquire_lock.return_value = 7
+            self.storage_backend.save_keys.side_effect = LockLostError
+            with self.assertRaises(LockLostError):
+                await self.contextd.transactional_update({"key": "value"})
+            self.storage_backend.release_lock.assert_awaited_with(self.contextd.lock_key, self.contextd.lock_value)
+
+        asyncio.run(run_test())
+
+    def test_held_lock_lease_is_renewed(self):
+        async def run_test():
+            self.storage_backend.acquire_lock.return_value = True
+            self.storage_backend.renew_lock.return_value = True
+            self.assertTrue(await self.contextd.acquire_lock(lock_timeout=30))
+            await asyncio.sleep(0.05)
+            self.storage_backend.renew_lock.assert_awaited_with(self.contextd.lock_key, self.contextd.lock_value, 30)
+            await self.contextd.release_lock()
+            renewals = self.storage_backend.renew_lock.await_count
+            await asyncio.sleep(0.03)
+            self.assertEqual(self.storage_backend.renew_lock.await_count, renewals)
+
+        asyncio.run(run_test())
+
+    def test_group_commit_merges_concurrent_updates(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, group_commit=True, max_batch_size=4)
+            self.storage_backend.acquire_lock.return_value = True
+            self.storage_backend.save_keys.side_effect = [1, 2, 3]
+            await asyncio.gather(
+                *(contextd.update_context(f"key{index}", index) for index in range(9)),
+                contextd.transactional_update({"key9": 9}, deletions=["key0"])
+            )
+            self.assertEqual(self.storage_backend.acquire_lock.await_count, 3)
+            self.assertEqual(self.storage_backend.save_keys.await_count, 3)
+            changed, deleted = self.storage_backend.save_keys.await_args.args[1:3]
+            self.assertEqual((changed, deleted), ({"key8": 8, "key9": 9}, {"key0"}))
+            self.assertNotIn("key0", contextd.get_context())
+            stats = contextd.group_commit_stats()
+            self.assertEqual((stats["requests"], stats["batches"]), (10, 3))
+            self.assertEqual(stats["batch_sizes"], {4: 2, 2: 1})
+            await contextd.close()
+
+        asyncio.run(run_test())
+
+    def test_group_commit_failure_fails_every_update_of_the_batch(self):
+        async def run_test():
+            contextd = Contextd(self.context_key, self.storage_backend, group_commit=True, commit_window=0.01)
+            self.storage_backend.acquire_lock.return_value = True
+            self.storage_backend.save_keys.side_effect = ConnectionError
+            results = await asyncio.gather(*(contextd.update_context("key", index) for index in range(3)), return_exceptions=True)
+            self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+            self.assertEqual(contextd.group_commit_stats()["failures"], 1)
+            self.storage_backend.release_lock.assert_awaited_once()
+
+        asyncio.run(run_test())
+
     def test_get_context(self):
         self.contextd.context = {"key": "value"}
         self.assertEqual(self.contextd.get_context(), {"key": "value"})
 
+    def test_lazy_context_reads_a_resident_context(self):
+        async def run_test():
+            self.contextd.context = {"key": "value"}
+            view = await self.contextd.get_lazy_context(prefetch=["key"])
+            self.assertEqual((await view.get("key"), await view.get("missing", 0)), ("value", 0))
+            self.storage_backend.load_keys.assert_not_awaited()
+
+        asyncio.run(run_test())
+
+    def test_get_context_returns_immutable_snapshots(self):
+        self.contextd.context, self.contextd.version = {"key": "value", "other": 1}, 4
+        before = self.contextd.get_context()
+        self.assertIs(self.contextd.get_context(), before)
+        self.contextd.apply_changes({"key": "changed"}, deletions=["other"])
+        asyncio.run(self.contextd.handle_update({"version": 5, "changed": {"remote": True}, "deleted": []}))
+        # Unsaved local changes are not part of a snapshot
+        after = self.contextd.get_context()
+        self.assertEqual((before, before.version), ({"key": "value", "other": 1}, 4))
+        self.assertEqual((after, after.version), ({"key": "value", "other": 1, "remote": True}, 5))
+        self.contextd.changes_saved({"key": "changed"}, {"other"}, 6)
+        saved = self.contextd.get_context()
+        self.assertEqual((saved, saved.version), ({"key": "changed", "remote": True}, 6))
+        with self.assertRaises(TypeError):
+            after["key"] = "value"
+
+    def test_snapshots_hold_only_committed_changes(self):
+        async def run_test():
+            self.contextd.context, self.contextd.version = {"x": 1}, 1
+            self.storage_backend.acquire_lock.return_value = True
+            self.storage_backend.save_keys.side_effect = ConnectionError
+            with self.assertRaises(ConnectionError):
+                await self.contextd.update_context("y", 10)
+            self.assertEqual(self.contextd.get_context(), {"x": 1})
+            contextd = Contextd(self.context_key, self.storage_backend, write_mode="optimistic", max_write_retries=1)
+            contextd.context, contextd.version = {"x": 1}, 1
+            self.storage_backend.compare_and_save.return_value = None
+            with self.assertRaises(Exception):
+                await contextd.update_context("y", 10)
+            self.assertEqual((contextd.get_context(), contextd.get_context().version), ({"x": 1}, 1))
+            # A snapshot taken while a save is in flight leaves its change out
+            self.contextd.apply_changes({"y": 10}, deletions=["x"])
+            self.contextd.context = dict(self.contextd.context)
+            self.assertEqual(self.contextd.get_context(), {"x": 1})
+
+        asyncio.run(run_test())
+
+    def test_mutating_a_snapshot_value_leaves_the_context_intact(self):
+        self.contextd.context, self.contextd.version = {"user": {"roles": ["reader"]}}, 1
+        snapshot = self.contextd.get_context()
+        with self.assertRaises(TypeError):
+            snapshot["user"]["roles"].append("admin")
+        with self.assertRaises(TypeError):
+            snapshot["user"]["name"] = "a"
+        self.assertEqual(self.contextd.context, {"user": {"roles": ["reader"]}})
+        # Nor does an in-place change of the context reach the snapshot
+        self.contextd.context["user"]["roles"].append("writer")
+        self.assertEqual(snapshot["user"], {"roles": ["reader"]})
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
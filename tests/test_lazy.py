@@ -0,0 +1,39 @@
+import unittest
+from common.lazy import KeyCache
+
+class TestKeyCache(unittest.TestCase):
+    def test_least_recently_used_keys_are_evicted(self):
+        cache = KeyCache(max_keys=2)
+        cache["a"], cache["b"] = 1, 2
+        cache["a"]
+        cache["c"] = 3
+        self.assertEqual(sorted(cache), ["a", "c"])
+        self.assertEqual(cache.get("a"), 1)
+        cache["d"] = 4
+        self.assertEqual(sorted(cache), ["c", "d"])
+        self.assertEqual(cache.stats(), {"keys": 2, "bytes": 0, "evictions": 2})
+
+    def test_size_bound(self):
+        cache = KeyCache(max_bytes=10, sizeof=len)
+        cache["a"] = "x" * 4
+        cache["b"] = "x" * 4
+        cache["a"] = "x" * 7
+        self.assertEqual((sorted(cache), cache.bytes), (["a"], 7))
+        del cache["a"]
+        self.assertEqual(cache.bytes, 0)
+
+    def test_pinned_keys_stay(self):
+        pinned = {"a"}
+        cache = KeyCache(max_keys=1, pinned=pinned)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(sorted(cache), ["a"])
+        pinned.add("c")
+        cache["c"] = 3
+        self.assertEqual(sorted(cache), ["a", "c"])
+        pinned.clear()
+        cache["d"] = 4
+        self.assertEqual(sorted(cache), ["d"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import asyncio
+from unittest.mock import Mock
+from backends.instrumented_backend import InstrumentedBackend
+from backends.memory_backend import MemoryBackend, MemoryBus, MemoryStore
+from common.metrics import Metrics, OpenTelemetryObserver, PrometheusObserver
+from context import Contextd
+
+class TestMetrics(unittest.TestCase):
+    def test_nothing_is_timed_without_observers(self):
+        metrics = Metrics()
+        self.assertIsNone(metrics.start())
+        metrics.elapsed("contextd_load_seconds", None)
+
+    def test_prometheus_rendering(self):
+        observer = PrometheusObserver(time_buckets=(0.1, 1.0))
+        metrics = Metrics(observer)
+        metrics.count("contextd_reloads_total")
+        metrics.count("contextd_reloads_total", 2)
+        metrics.timing("contextd_load_seconds", 0.5, source="full")
+        metrics.timing("contextd_load_seconds", 2.0, source="full")
+        lines = observer.render().splitlines()
+        self.assertIn("# TYPE contextd_reloads_total counter", lines)
+        self.assertIn("contextd_reloads_total 3", lines)
+        self.assertIn('contextd_load_seconds_bucket{source="full",le="0.1"} 0', lines)
+        self.assertIn('contextd_load_seconds_bucket{source="full",le="1.0"} 1', lines)
+        self.assertIn('contextd_load_seconds_bucket{source="full",le="+Inf"} 2', lines)
+        self.assertIn('contextd_load_seconds_sum{source="full"} 2.5', lines)
+        self.assertIn('contextd_load_seconds_count{source="full"} 2', lines)
+
+    def test_opentelemetry_observer(self):
+        meter, tracer = Mock(), Mock()
+        metrics = Metrics(OpenTelemetryObserver(meter, tracer))
+        metrics.timing("contextd_save_seconds", 0.25, operation="save_keys")
+        metrics.timing("contextd_save_seconds", 0.5, operation="save_keys")
+        metrics.count("contextd_reloads_total")
+        meter.create_histogram.assert_called_once_with("contextd_save_seconds", unit="s")
+        meter.create_histogram.return_value.record.assert_called_with(0.5, attributes={"operation": "save_keys"})
+        meter.create_counter.assert_called_once_with("contextd_reloads", unit="1")
+        self.assertEqual(tracer.start_span.call_count, 2)
+        tracer.start_span.return_value.end.assert_called()
+
+class TestInstrumentation(unittest.TestCase):
+    def test_context_and_backend_operations_are_observed(self):
+        async def run_test():
+            observer = PrometheusObserver()
+            metrics = Metrics(observer)
+            store, bus = MemoryStore(), MemoryBus()
+            writer = Contextd("ctx", InstrumentedBackend(MemoryBackend(store, bus), metrics), metrics=metrics)
+            reader = Contextd("ctx", MemoryBackend(store, bus), metrics=metrics)
+            await writer.initialize()
+            await reader.initialize()
+            await writer.update_context("a", {"nested": [1, 2, 3]})
+            await bus.join()
+            self.assertEqual(reader.get_context(), {"a": {"nested": [1, 2, 3]}})
+            text = observer.render()
+            for line in (
+                'contextd_update_seconds_count{operation="update_context"} 1',
+                'contextd_save_seconds_count{operation="save_keys"} 1',
+                'contextd_lock_wait_seconds_count{acquired="true"} 1',
+                "contextd_lock_hold_seconds_count 1",
+                'contextd_backend_seconds_count{backend="MemoryBackend",operation="save_keys"} 1',
+                'contextd_payload_bytes_count{backend="MemoryBackend",direction="encode"} 1',
+                "contextd_notification_lag_seconds_count 2",  # Both instances are notified
+                "contextd_deltas_applied_total 1",
+            ):
+                self.assertIn(line, text.splitlines())
+            await writer.close()
+            await reader.close()
+
+        asyncio.run(run_test())
+
+    def test_backend_errors_are_counted(self):
+        async def run_test():
+            observer = PrometheusObserver()
+            backend = InstrumentedBackend(MemoryBackend(failure_rate=1.0), Metrics(observer))
+            with self.assertRaises(ConnectionError):
+                await backend.get_version("ctx")
+            self.assertIn(
+                'contextd_backend_errors_total{backend="MemoryBackend",error="InjectedFailure",operation="get_version"} 1',
+                observer.render().splitlines()
+            )
+
+        asyncio.run(run_test())
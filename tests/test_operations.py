@@ -0,0 +1,40 @@
+import unittest
+from common.operations import apply_operations, operation, parse_path
+
+class TestOperations(unittest.TestCase):
+    def test_operations_apply_in_order(self):
+        context = {"count": 1, "user": {"name": "a"}, "old": None}
+        results, changed, deleted = apply_operations(context, [
+            operation("increment", "count", 2),
+            operation("set", "user.profile.email", "a@example.com"),
+            operation("append", "log", "x"),
+            operation("append", "log", "y"),
+            operation("merge", "user", {"name": "b"}),
+            operation("set_if_absent", "count", 0),
+            operation("set_if_absent", "old", 1),
+            operation("delete", "old"),
+            operation("delete", "missing.key"),
+        ])
+        self.assertEqual(results, [3, None, 1, 2, {"name": "b", "profile": {"email": "a@example.com"}}, False, True, True, False])
+        self.assertEqual(context, {"count": 3, "user": {"name": "b", "profile": {"email": "a@example.com"}}, "log": ["x", "y"]})
+        self.assertEqual((changed, deleted), ({"count", "user", "log"}, {"old"}))
+
+    def test_type_errors(self):
+        for op in (
+            operation("increment", "flag", 1),
+            operation("append", "count", 1),
+            operation("merge", "items", {}),
+            operation("set", "count.nested", 1),
+        ):
+            with self.assertRaises(TypeError):
+                apply_operations({"flag": True, "count": 1, "items": []}, [op])
+
+    def test_validation(self):
+        self.assertEqual(parse_path("a.b"), ("a", "b"))
+        self.assertEqual(parse_path(["a.b", "c"]), ("a.b", "c"))
+        with self.assertRaises(ValueError):
+            parse_path("a..b")
+        with self.assertRaises(ValueError):
+            operation("multiply", "a", 2)
+        with self.assertRaises(TypeError):
+            operation("increment", "a", "1")
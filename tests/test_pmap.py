@@ -0,0 +1,98 @@
+import random
+import unittest
+import json
+import pickle
+from common.pmap import _CHILD, FrozenDict, FrozenList, PMap, Snapshot, freeze
+
+class CollidingKey:
+    def __init__(self, name):
+        self.name = name
+
+    def __hash__(self):
+        return 7
+
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and other.name == self.name
+
+class TestPMap(unittest.TestCase):
+    def test_matches_dict_under_random_changes(self):
+        rng = random.Random(1)
+        expected, pmap = {}, PMap()
+        for _ in range(3000):
+            key = rng.randrange(500)
+            if rng.random() < 0.3:
+                expected.pop(key, None)
+                pmap = pmap.delete(key)
+            else:
+                expected[key] = rng.random()
+                pmap = pmap.set(key, expected[key])
+            self.assertEqual(len(pmap), len(expected))
+        self.assertEqual(pmap, expected)
+        self.assertEqual(PMap(expected), expected)
+        self.assertEqual(sorted(pmap), sorted(expected))
+
+    def test_changes_leave_the_original_untouched(self):
+        original = PMap({f"key{index}": index for index in range(1000)})
+        changed = original.update({"key1": "new", "extra": True}, deleted=["key2", "missing"])
+        self.assertEqual((original["key1"], original["key2"], "extra" in original), (1, 2, False))
+        self.assertEqual((changed["key1"], "key2" in changed, changed["extra"]), ("new", False, True))
+        self.assertEqual(len(changed), 1000)
+        self.assertIs(original.delete("missing"), original)
+        self.assertIs(original.set("key3", 3), original)
+
+    def test_unchanged_nodes_are_shared(self):
+        original = PMap({f"key{index}": index for index in range(1000)})
+        changed = original.set("key1", "new")
+        shared = {id(node) for _, node in _children(original._root)} & {id(node) for _, node in _children(changed._root)}
+        self.assertEqual(len(shared), len(original._root.array) // 2 - 1)
+
+    def test_hash_collisions(self):
+        first, second, third = CollidingKey("a"), CollidingKey("b"), CollidingKey("c")
+        pmap = PMap().set(first, 1).set(second, 2).set(third, 3).set("plain", 4)
+        self.assertEqual((pmap[first], pmap[second], pmap[third], pmap["plain"]), (1, 2, 3, 4))
+        pmap = pmap.delete(second)
+        self.assertEqual(dict(pmap.items()), {first: 1, third: 3, "plain": 4})
+        self.assertEqual(len(pmap.delete(first).delete(third).delete("plain")), 0)
+        with self.assertRaises(KeyError):
+            pmap[second]
+
+    def test_snapshot_evolves_with_a_version(self):
+        snapshot = Snapshot({"a": 1}, version=3)
+        evolved = snapshot.evolve({"b": 2}, ["a"], version=4)
+        self.assertEqual((snapshot, snapshot.version), ({"a": 1}, 3))
+        self.assertEqual((evolved, evolved.version), ({"b": 2}, 4))
+        with self.assertRaises(TypeError):
+            snapshot["a"] = 2
+
+    def test_snapshot_values_are_frozen_copies(self):
+        value = {"items": [1, {"nested": True}], "tags": {"a"}}
+        snapshot = Snapshot({"value": value})
+        frozen = snapshot["value"]
+        self.assertEqual(frozen, value)
+        for mutate in (
+            lambda: frozen.update(other=1),
+            lambda: frozen["items"].append(2),
+            lambda: frozen["items"][1].pop("nested"),
+            lambda: frozen["tags"].add("b"),
+        ):
+            with self.assertRaises((TypeError, AttributeError)):
+                mutate()
+        value["items"].append(3)
+        self.assertEqual(snapshot["value"]["items"], [1, {"nested": True}])
+        evolved = snapshot.evolve({"other": [1]})
+        self.assertIsInstance(evolved["other"], FrozenList)
+        self.assertIs(evolved["value"], frozen)
+
+    def test_frozen_values_serialize_like_plain_ones(self):
+        frozen = freeze({"a": [1, {"b": 2}]})
+        self.assertIsInstance(frozen, FrozenDict)
+        self.assertIs(freeze(frozen), frozen)
+        self.assertEqual(json.dumps(frozen), '{"a": [1, {"b": 2}]}')
+        self.assertEqual(pickle.loads(pickle.dumps(frozen)), frozen)
+
+def _children(node):
+    array = node.array
+    return [(array[index], array[index + 1]) for index in range(0, len(array), 2) if array[index] is _CHILD]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+import unittest
+import asyncio
+from unittest.mock import AsyncMock, Mock
+from backends.mongodb_backend import MongoDBBackend
+from backends.notifications import RedisNotification
+from registry import ContextRegistry
+from common.lock_wait import FixedDelay
+from common.watch import ABSENT
+
+class TestContextRegistry(unittest.TestCase):
+    def setUp(self):
+        self.storage_backend = Mock(spec=MongoDBBackend)
+        self.storage_backend.load_versioned.return_value = ({"key": "value"}, 1)
+
+    def test_contexts_are_created_once(self):
+        async def run_test():
+            registry = ContextRegistry(self.storage_backend)
+            first, second = await asyncio.gather(registry.get("tenant-1"), registry.get("tenant-1"))
+            self.assertIs(first, second)
+            self.assertEqual(first.context, {"key": "value"})
+            self.storage_backend.load_versioned.assert_awaited_once_with("tenant-1")
+            self.assertEqual(registry.stats["created"], 1)
+
+        asyncio.run(run_test())
+
+    def test_concurrent_gets_with_idle_timeout(self):
+        async def load_many(context_keys):
+            return {key: ({"key": key}, 1) for key in context_keys}
+
+        self.storage_backend.load_many.side_effect = load_many
+
+        async def run_test():
+            registry = ContextRegistry(self.storage_backend, idle_timeout=60)
+            contexts = await asyncio.gather(
+                *(registry.get(f"tenant-{index}") for index in range(5)),
+                registry.get_many(["tenant-5", "tenant-6"]),
+            )
+            self.assertEqual(len(registry), 7)
+            self.assertEqual(len(contexts), 6)
+
+        asyncio.run(run_test())
+
+    def test_least_recently_used_context_is_evicted(self):
+        async def run_test():
+            registry = ContextRegistry(self.storage_backend, max_active=2)
+            first = await registry.get("tenant-1")
+            await registry.get("tenant-2")
+            await registry.get("tenant-1")
+            await registry.get("tenant-3")
+            self.assertEqual(len(registry), 2)
+            self.assertIn("tenant-1", registry)
+            self.assertNotIn("tenant-2", registry)
+            self.assertIs(await registry.get("tenant-1"), first)
+
+        asyncio.run(run_test())
+
+    def test_pinned_context_is_not_evicted(self):
+        async def run_test():
+            registry = ContextRegistry(self.storage_backend, max_active=1)
+            async with registry.use("tenant-1"):
+                await registry.get("tenant-2")
+                self.assertIn("tenant-1", registry)
+            await registry.get("tenant-3")
+            self.assertEqual(len(registry), 1)
+
+        asyncio.run(run_test())
+
+    def test_evicted_context_is_closed(self):
+        async def run_test():
+            subscription = Mock()
+            self.storage_backend.subscribe_to_updates.return_value = subscription
+            registry = ContextRegistry(self.storage_backend)
+            await registry.get("tenant-1")
+            await registry.close()
+            subscription.cancel.assert_called_once()
+            self.assertEqual(len(registry), 0)
+
+        asyncio.run(run_test())
+
+class TestBulkOperations(unittest.TestCase):
+    def setUp(self):
+        self.storage_backend = Mock(spec=MongoDBBackend)
+        self.storage_backend.field_level = True
+
+        async def load_many(context_keys):
+            return {key: ({"key": key}, 1) for key in context_keys}
+
+        self.storage_backend.load_many.side_effect = load_many
+
+    def test_get_many_loads_missing_contexts_in_one_call(self):
+        async def run_test():
+            registry = ContextRegistry(self.storage_backend)
+            await registry.get_many(["tenant-1"])
+            contexts = await registry.get_many(["tenant-1", "tenant-2", "tenant-3"])
+            self.assertEqual(list(contexts), ["tenant-1", "tenant-2", "tenant-3"])
+            self.assertEqual(contexts["tenant-3"].context, {"key": "tenant-3"})
+            self.storage_backend.load_many.assert_awaited_with(["tenant-2", "tenant-3"])
+            self.storage_backend.load_versioned.assert_not_awaited()
+            self.assertEqual(registry.stats["hits"], 1)
+
+        asyncio.run(run_test())
+
+    def test_update_many_locks_and_writes_in_one_batch(self):
+        async def run_test():
+            self.storage_backend.acquire_locks.return_value = {"tenant-1_lock:a": 3, "tenant-2_lock:b": 4, "tenant-2_lock:key": 5}
+            self.storage_backend.save_many.return_value = {"tenant-1": 2, "tenant-2": 2}
+            registry = ContextRegistry(self.storage_backend, lock_mode="key")
+            await registry.update_many({"tenant-1": {"a": 1}, "tenant-2": {"b": 2}}, {"tenant-2": ["key"]})
+            lock_names, lock_value, _ = self.storage_backend.acquire_locks.await_args.args
+            self.assertEqual(lock_names, ["tenant-1_lock:a", "tenant-2_lock:b", "tenant-2_lock:key"])
+            self.storage_backend.release_locks.assert_awaited_once_with(lock_names, lock_value)
+            changes, fences = self.storage_backend.save_many.await_args.args
+            self.assertEqual(changes["tenant-2"][:2], ({"b": 2}, {"key"}))
+            self.assertEqual(fences, {"tenant-1": {"tenant-1_lock:a": 3}, "tenant-2": {"tenant-2_lock:b": 4, "tenant-2_lock:key": 5}})
+            contexts = await registry.get_many(["tenant-1", "tenant-2"])
+            self.assertEqual(contexts["tenant-2"].context, {"b": 2})
+            self.assertEqual(contexts["tenant-1"].version, 2)
+
+        asyncio.run(run_test())
+
+    def test_watches_are_registered_before_contexts_load(self):
+        async def run_test():
+            self.storage_backend.acquire_locks.return_value = {"tenant-1_lock": True, "tenant-2_lock": True}
+            self.storage_backend.save_many.return_value = {"tenant-1": 2, "tenant-2": 2}
+            registry = ContextRegistry(self.storage_backend)
+            changes = []
+            registry.watch("tenant-2", "*", changes.append)
+            await registry.update_many({"tenant-1": {"a": 1}, "tenant-2": {"b": 2}}, {"tenant-2": ["key"]})
+            self.assertEqual(
+                sorted((change.key, change.old, change.new, change.version, change.local) for change in changes),
+                [("b", ABSENT, 2, 2, True), ("key", "tenant-2", ABSENT, 2, True)]
+            )
+
+        asyncio.run(run_test())
+
+    def test_update_many_takes_fair_locks_per_context(self):
+        async def run_test():
+            self.storage_backend.acquire_lock_fair.return_value = 7
+            self.storage_backend.save_keys.return_value = 2
+            registry = ContextRegistry(self.storage_backend, fair_locks=True, renew_leases=False)
+            await registry.update_many({"tenant-1": {"a": 1}, "tenant-2": {"b": 2}})
+            self.storage_backend.acquire_locks.assert_not_awaited()
+            self.storage_backend.save_many.assert_not_awaited()
+            self.storage_backend.save_keys.assert_any_await("tenant-1", {"a": 1}, set(), {"key": "tenant-1", "a": 1}, fence={"tenant-1_lock": 7})
+
+        asyncio.run(run_test())
+
+    def test_update_many_fails_when_locks_are_taken(self):
+        async def run_test():
+            self.storage_backend.acquire_locks.return_value = False
+            registry = ContextRegistry(self.storage_backend, lock_wait=FixedDelay(0, 2))
+            with self.assertRaises(Exception):
+                await registry.update_many({"tenant-1": {"a": 1}})
+            self.storage_backend.save_many.assert_not_awaited()
+            self.assertEqual(self.storage_backend.acquire_locks.await_count, 2)
+
+        asyncio.run(run_test())
+
+def published_message(channel, data):
+    return {"type": "message", "pattern": None, "channel": channel.encode(), "data": data.encode()}
+
+class TestRedisNotificationMultiplexing(unittest.TestCase):
+    def test_channels_share_one_subscriber(self):
+        async def run_test():
+            published = asyncio.Queue()
+            subscriber = AsyncMock()
+            subscriber.get_message = lambda **kwargs: published.get()
+            subscriber.connection = Mock()
+            client = Mock()
+            client.pubsub.return_value = subscriber
+            received = []
+
+            async def callback(message):
+                received.append(message)
+
+            notification = RedisNotification("localhost", connection=client)
+            first = await notification.subscribe_to_updates("tenant-1", callback)
+            await notification.subscribe_to_updates("tenant-2", callback)
+            client.pubsub.assert_called_once()
+            self.assertEqual(notification.channel_count(), 2)
+            await published.put(published_message("tenant-1", '{"version": 2}'))
+            await published.put(published_message("tenant-3", "update"))
+            while published.qsize():
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertEqual(received, [{"version": 2}])
+            first.cancel()
+            await asyncio.sleep(0)
+            subscriber.unsubscribe.assert_awaited_once_with("tenant-1")
+            await notification.close()
+            subscriber.aclose.assert_awaited_once()
+
+        asyncio.run(run_test())
+
+    def test_reconnect_resubscribes_and_asks_for_catch_up(self):
+        async def run_test():
+            published = asyncio.Queue()
+
+            async def get_message(**kwargs):
+                reply = await published.get()
+                if isinstance(reply, Exception):
+                    raise reply
+                return reply
+
+            subscriber = AsyncMock()
+            subscriber.get_message = get_message
+            subscriber.connection = Mock()
+            client = Mock()
+            client.pubsub.return_value = subscriber
+            received = []
+
+            async def callback(message):
+                received.append(message)
+
+            notification = RedisNotification("localhost", connection=client)
+            await notification.subscribe_to_updates("tenant-1", callback)
+            await published.put(ConnectionError())
+            while not received:
+                await asyncio.sleep(0)
+            self.assertEqual(client.pubsub.call_count, 2)
+            subscriber.subscribe.assert_awaited_with("tenant-1")
+            self.assertEqual(received, [None])
+            await notification.close()
+
+        asyncio.run(run_test())
+
+    def test_client_reconnect_asks_for_catch_up(self):
+        async def run_test():
+            subscriber = AsyncMock()
+            subscriber.get_message = lambda **kwargs: asyncio.Future()
+            subscriber.connection = Mock()
+            client = Mock()
+            client.pubsub.return_value = subscriber
+            received = []
+
+            async def callback(message):
+                received.append(message)
+
+            notification = RedisNotification("localhost", connection=client)
+            await notification.subscribe_to_updates("tenant-1", callback)
+            on_reconnect = subscriber.connection.register_connect_callback.call_args.args[0]
+            on_reconnect(subscriber.connection)
+            while not received:
+                await asyncio.sleep(0)
+            self.assertEqual(received, [None])
+            await notification.close()
+            subscriber.connection.deregister_connect_callback.assert_called_once_with(on_reconnect)
+
+        asyncio.run(run_test())
+
+if __name__ == "__main__":
+    unittest.main()
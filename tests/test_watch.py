@@ -0,0 +1,51 @@
+import unittest
+import asyncio
+from common.watch import ABSENT, Watchers
+
+class TestWatchers(unittest.TestCase):
+    def test_changes_are_routed_by_key_and_prefix(self):
+        watchers = Watchers()
+        exact, prefixed, everything, other = [], [], [], []
+        watchers.watch("ctx", "user", exact.append)
+        watchers.watch("ctx", "user.*", prefixed.append)
+        watchers.watch("ctx", "*", everything.append)
+        watchers.watch("other", "*", other.append)
+        old = {"user": 1, "user.name": "a", "count": 1, "same": [1]}
+        new = {"user": 2, "user.email": "b", "count": 1, "same": [1]}
+        watchers.notify("ctx", old.keys() | new.keys(), old, new, 5, local=False)
+        self.assertEqual([(change.old, change.new) for change in exact], [(1, 2)])
+        self.assertEqual(
+            sorted((change.key, change.old, change.new) for change in prefixed),
+            [("user.email", ABSENT, "b"), ("user.name", "a", ABSENT)]
+        )
+        self.assertEqual(sorted(change.key for change in everything), ["user", "user.email", "user.name"])
+        self.assertTrue(all(change.version == 5 and not change.local for change in everything))
+        self.assertEqual(other, [])
+
+    def test_cancelled_watches_stop(self):
+        watchers = Watchers()
+        changes = []
+        watch = watchers.watch("ctx", "a", changes.append)
+        watch.cancel()
+        self.assertFalse(watchers.watching("ctx"))
+        watchers.notify("ctx", ["a"], {}, {"a": 1}, 1, local=True)
+        self.assertEqual(changes, [])
+
+    def test_coroutine_callbacks_and_failures(self):
+        async def run_test():
+            watchers = Watchers()
+            received = []
+
+            async def record(change):
+                received.append(change.new)
+
+            def fail(change):
+                raise ValueError("callback failed")
+
+            watchers.watch("ctx", "a", fail)
+            watchers.watch("ctx", "a", record)
+            watchers.notify("ctx", ["a"], {}, {"a": 1}, 1, local=True)
+            await asyncio.sleep(0)
+            self.assertEqual(received, [1])
+
+        asyncio.run(run_test())